@@ -1,5 +1,7 @@
 from .sparse_layer import Sparse, SparseConv2D, SparseDepthwiseConv2D
 from .rewiring_callback import RewiringCallback
+from .profiling_callback import StepTimingCallback
+from .checkpoint_callback import CompactModelCheckpoint, DeltaModelCheckpoint
 import keras_rewiring.utilities
 import keras_rewiring.optimizers
 import keras_rewiring.activations
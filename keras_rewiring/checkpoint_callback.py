@@ -0,0 +1,89 @@
+from keras.callbacks import Callback
+from keras_rewiring.utilities.compact_checkpoint import \
+    write_compact_checkpoint, snapshot_model_state, DeltaCheckpointWriter
+
+
+class CompactModelCheckpoint(Callback):
+    """Save compact checkpoints of a (sparse) model during training.
+
+    Unlike `ModelCheckpoint`, masks are stored as bitsets and kernels as
+    their active values, and the checkpoint includes the optimizer weights,
+    the state of the `RewiringCallback` and the global NumPy RNG state, so
+    that training resumed with `load_compact_checkpoint` continues exactly
+    as it would have. This callback should come after the
+    `RewiringCallback` in the callback list.
+
+    `filepath` can contain named formatting options, filled with the epoch
+    number and the keys of the logs (e.g. `weights.{epoch:02d}.h5`).
+
+    If a `BackgroundWriter` is provided, only the snapshot is taken on the
+    training thread and the file is written in the background.
+    """
+
+    def __init__(self, filepath, rewiring_callback=None, period=1,
+                 background_writer=None):
+        super(CompactModelCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.rewiring_callback = rewiring_callback
+        self.period = period
+        self.background_writer = background_writer
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        if (epoch + 1) % self.period != 0:
+            return
+        filename = self.filepath.format(epoch=epoch + 1, **logs)
+        snapshot = snapshot_model_state(self.model, epoch + 1,
+                                        self.rewiring_callback)
+        if self.background_writer is None:
+            write_compact_checkpoint(filename, snapshot)
+        else:
+            self.background_writer.submit(write_compact_checkpoint,
+                                          filename, snapshot)
+
+    def on_train_end(self, logs=None):
+        if self.background_writer is not None:
+            self.background_writer.flush()
+
+
+class DeltaModelCheckpoint(Callback):
+    """Keep the history of a training run in a single delta checkpoint.
+
+    The first checkpoint is saved in full and the following ones only as the
+    changes in the masks plus the active kernel values and the other weights
+    (see `DeltaCheckpointWriter`). Any of the saved epochs can then be
+    restored with `load_compact_checkpoint(filename, model, epoch=...)`.
+    This callback should come after the `RewiringCallback` in the callback
+    list. Deltas can be written by a `BackgroundWriter`, as for
+    `CompactModelCheckpoint`.
+    """
+
+    def __init__(self, filename, rewiring_callback=None, period=1,
+                 include_optimizer=False, background_writer=None):
+        """
+        :param include_optimizer: save the optimizer weights and the
+            host-side rewiring state at every epoch, so that training can be
+            resumed exactly from any of them (rather than only from the
+            first one)
+        :type include_optimizer: bool
+        """
+        super(DeltaModelCheckpoint, self).__init__()
+        self.writer = DeltaCheckpointWriter(filename, include_optimizer)
+        self.rewiring_callback = rewiring_callback
+        self.period = period
+        self.background_writer = background_writer
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.period != 0:
+            return
+        snapshot = snapshot_model_state(self.model, epoch + 1,
+                                        self.rewiring_callback)
+        if self.background_writer is None:
+            self.writer.write(snapshot)
+        else:
+            # deltas are computed by the writer, in order
+            self.background_writer.submit(self.writer.write, snapshot)
+
+    def on_train_end(self, logs=None):
+        if self.background_writer is not None:
+            self.background_writer.flush()
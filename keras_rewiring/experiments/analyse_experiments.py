@@ -23,6 +23,7 @@ from sklearn.metrics import classification_report, confusion_matrix
 
 from keras_rewiring.optimizers import NoisySGD
 from keras_rewiring.utilities.load_dataset import load_and_preprocess_dataset
+from keras_rewiring.utilities.event_log import replay_event_log
 
 mlib.use('Agg')
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -83,6 +84,8 @@ def analyse_experiment(in_file, results_dir):
         csv_analysis(in_file, results_dir)
     elif ext in ["hdf5", "h5"]:
         keras_model_analysis(in_file, results_dir)
+    elif ext in ["evt"]:
+        event_log_analysis(in_file, results_dir)
     print("=" * 80)
 
 def check_for_dir(dir):
@@ -190,6 +193,42 @@ def csv_analysis(in_file, results_dir):
                 results_dir=results_dir)
 
 
+def event_log_analysis(in_file, results_dir):
+    split_fname = ntpath.basename(in_file).split(".")
+    results_dir = os.path.join(results_dir, split_fname[0])
+    check_for_dir(results_dir)
+    # replay the connectivity and record, per epoch, the number of rewires
+    # and the proportion of the initial connections which are still active
+    initial_masks = {}
+    rewires = {}
+    survival = {}
+    for event, masks in replay_event_log(in_file):
+        mask = masks[event.layer]
+        if event.kind == 'initial':
+            initial_masks[event.layer] = mask.copy()
+            rewires.setdefault(event.layer, {})
+            survival.setdefault(event.layer, {})
+            continue
+        per_epoch = rewires[event.layer]
+        per_epoch[event.epoch] = per_epoch.get(event.epoch, 0) + \
+            event.regrown.size
+        initial = initial_masks[event.layer]
+        survival[event.layer][event.epoch] = \
+            np.count_nonzero(mask & initial) / \
+            float(max(np.count_nonzero(initial), 1))
+    layer_names = sorted(rewires.keys())
+    plot_single([pd.Series(rewires[l]) for l in layer_names],
+                filename="rewires_per_layer",
+                xlabel="Epoch", ylabel="# of rewires",
+                labels=layer_names,
+                results_dir=results_dir)
+    plot_single([pd.Series(survival[l]) for l in layer_names],
+                filename="initial_connections_surviving",
+                xlabel="Epoch", ylabel="Proportion of initial connections",
+                labels=layer_names,
+                results_dir=results_dir)
+
+
 if __name__ == "__main__":
     if (analysis_args.input and len(analysis_args.input) > 0 and
             not analysis_args.compare):
@@ -8,6 +8,19 @@ import numpy as np
 from keras_rewiring.sparse_layer import Sparse, SparseConv2D, SparseDepthwiseConv2D
 from keras_rewiring.utilities.replace_dense_with_sparse import replace_dense_with_sparse
 from keras_rewiring.rewiring_callback import RewiringCallback
+from keras_rewiring.profiling_callback import StepTimingCallback
+from keras_rewiring.checkpoint_callback import CompactModelCheckpoint, \
+    DeltaModelCheckpoint
+from keras_rewiring.utilities.compact_checkpoint import \
+    load_compact_checkpoint, read_compact_checkpoint_epoch
+from keras_rewiring.utilities.background_writer import BackgroundWriter, \
+    BackgroundCSVLogger, BackgroundModelCheckpoint, save_model_in_background
+from keras_rewiring.utilities.event_log import RewiringEventLog
+from keras_rewiring.utilities.structured_sparsity import NMSparsity, BlockSparsity
+from keras_rewiring.utilities.regrowth import GradientMagnitudeRegrowth
+from keras_rewiring.utilities.data_parallel import MPICommunicator, \
+    BroadcastWeightsCallback, distributed_optimizer, \
+    launch_local_replicas, synchronise_random_seed
 # Import OS to deal with directories
 import os
 import sys
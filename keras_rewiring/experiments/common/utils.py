@@ -1,10 +1,12 @@
 from .imports import *
 
 
-def set_nslots():
+def set_nslots(replicas=1):
     # Get number of cores reserved by the batch system
     # (NSLOTS is automatically set, or use 4 otherwise)
     NUMCORES = int(os.getenv("NSLOTS", 4))
+    # replicas running on this host share its cores
+    NUMCORES = max(NUMCORES // replicas, 1)
     print("=" * 60)
     print("Using", NUMCORES, "core(s)")
     print("-" * 60)
@@ -17,6 +19,19 @@ def set_nslots():
 
     # Set the Keras TF session
     tf.compat.v1.keras.backend.set_session(sess)
+    return NUMCORES
+
+
+def run_data_parallel(train_function, *function_args):
+    # Data-parallel training on every process of the MPI job, on
+    # args.replicas processes of this host, or not at all
+    if args.mpi:
+        return train_function(*function_args,
+                              communicator=MPICommunicator())
+    if args.replicas > 1:
+        return launch_local_replicas(train_function, args.replicas,
+                                     *function_args)
+    return train_function(*function_args)
 
 
 def reports():
@@ -72,6 +87,24 @@ def extract_optimizer_from_args(learning_rate=None):
     return optimizer, optimizer_name
 
 
+def extract_rewiring_structure_from_args():
+    if args.nm_sparsity and args.block_sparsity:
+        raise ValueError("Only one of N:M and block sparsity can be used")
+    if args.nm_sparsity:
+        return NMSparsity(*args.nm_sparsity)
+    if args.block_sparsity:
+        return BlockSparsity(args.block_sparsity)
+    return None
+
+
+def extract_regrowth_policy_from_args():
+    if args.regrowth == 'gradient':
+        return GradientMagnitudeRegrowth()
+    if args.regrowth != 'random':
+        raise ValueError("Unknown regrowth policy {}".format(args.regrowth))
+    return None
+
+
 def extract_loss_from_args():
     pass
 
@@ -102,6 +135,12 @@ def generate_sparsity_suffix():
                 sparse_name = "sparse_decay"
             else:
                 sparse_name = "sparse_hard"
+        if args.nm_sparsity:
+            sparse_name += "_{}of{}".format(*args.nm_sparsity)
+        elif args.block_sparsity:
+            sparse_name += "_block{}x{}".format(*args.block_sparsity)
+        if args.regrowth != 'random':
+            sparse_name += "_{}_regrowth".format(args.regrowth)
     else:
         sparse_name = "dense"
     return sparse_name
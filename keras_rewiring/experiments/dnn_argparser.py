@@ -53,10 +53,135 @@ parser.add_argument('--asserts_on',
                     help='turn on all asserts',
                     action="store_true")
 
+parser.add_argument('--kernel_format', type=str,
+                    help='storage of the kernels of the Sparse layers: dense '
+                         '(kernel and mask) or coo (active values and '
+                         'indices, with a sparse matmul)',
+                    default='dense')
+
+parser.add_argument('--sparse_gradient',
+                    help='only compute the gradient of the active connections '
+                         'of the dense format sparse layers (SDDMM)',
+                    action="store_true")
+
+parser.add_argument('--mask_dtype', type=str,
+                    help='type of the masks of the sparse layers, e.g. uint8 '
+                         'for a quarter of the size of the default float32 '
+                         'masks',
+                    default=None)
+
+parser.add_argument('--cache_kernel',
+                    help='cache the masked kernels of the sparse layers '
+                         'for inference',
+                    action="store_true")
+
+parser.add_argument('--in_graph_rewiring',
+                    help='perform rewiring inside the train step '
+                         '(rather than in the callback)',
+                    action="store_true")
+
 parser.add_argument('--soft_rewiring',
                     help='rewiring without a target number of synapses',
                     action="store_true")
 
+parser.add_argument('--rewire_every_n_batches', type=int,
+                    help='number of batches between rewiring points',
+                    default=1)
+
+parser.add_argument('--adaptive_rewiring_interval',
+                    help='lengthen the rewiring interval of a layer as its '
+                         'rate of sign flips drops',
+                    action="store_true")
+
+parser.add_argument('--async_rewiring',
+                    help='compute rewiring on a background thread while the '
+                         'next batch trains (masks applied one batch late)',
+                    action="store_true")
+
+parser.add_argument('--rewiring_workers', type=int,
+                    help='number of threads used to rewire layers in '
+                         'parallel (capped at the number of cores)',
+                    default=1)
+
+parser.add_argument('--layers_per_batch', type=int,
+                    help='maximum number of layers rewired after each batch',
+                    default=None)
+
+parser.add_argument('--layer_schedule', type=str,
+                    help='how the layers rewired after each batch are '
+                         'chosen: round_robin, size or flip_rate',
+                    default='round_robin')
+
+parser.add_argument('--global_budget', type=str,
+                    help='regrow pruned connections in any layer, keeping '
+                         'the total number of parameters or FLOPs of the '
+                         'active connections fixed: params or flops',
+                    default=None)
+
+parser.add_argument('--connection_budget', type=float,
+                    help='total cost of the active connections for '
+                         '--global_budget (defaults to the initial cost)',
+                    default=None)
+
+parser.add_argument('--regrowth', type=str,
+                    help='how hard rewiring regrows connections: random or '
+                         'gradient (largest accumulated gradient magnitude)',
+                    default='random')
+
+parser.add_argument('--nm_sparsity', type=int, nargs=2,
+                    metavar=('N', 'M'),
+                    help='structured rewiring: at most N active connections '
+                         'in every group of M consecutive inputs',
+                    default=None)
+
+parser.add_argument('--block_sparsity', type=int, nargs=2,
+                    metavar=('ROWS', 'COLS'),
+                    help='structured rewiring: connections are rewired in '
+                         'whole ROWS x COLS blocks',
+                    default=None)
+
+parser.add_argument('--compact_checkpoints',
+                    help='save compact checkpoints (bitset masks, active '
+                         'weights and rewiring state) instead of full models',
+                    action="store_true")
+
+parser.add_argument('--delta_checkpoints',
+                    help='keep the history of the run in a single checkpoint '
+                         'made of a base snapshot and per-epoch deltas',
+                    action="store_true")
+
+parser.add_argument('--background_writes', type=int,
+                    help='write checkpoints and CSV logs on a background '
+                         'thread, training blocks only when this many '
+                         'snapshots are waiting to be written (0 to write '
+                         'them synchronously)',
+                    default=0)
+
+parser.add_argument('--event_log',
+                    help='record the connections dropped and regrown after '
+                         'every batch in a compressed binary log (.evt)',
+                    action="store_true")
+
+parser.add_argument('--resume_checkpoint', type=str,
+                    help='resume training exactly from a compact checkpoint '
+                         '(or the last epoch of a delta checkpoint)',
+                    default=None)
+
+parser.add_argument('--replicas', type=int,
+                    help='data-parallel training on this many processes of '
+                         'this host (the cores are split between them)',
+                    default=1)
+
+parser.add_argument('--mpi',
+                    help='data-parallel training on every process of the MPI '
+                         'job (requires mpi4py)',
+                    action="store_true")
+
+parser.add_argument('--profile_steps',
+                    help='record a per-batch time breakdown (train step, '
+                         'rewiring, data loading)',
+                    action="store_true")
+
 parser.add_argument('--tensorboard',
                     help='Whether to create tensorboard statistics',
                     action="store_true")
@@ -131,3 +256,7 @@ parser.add_argument('--test_as_dense',
                     action="store_true")
 
 args = parser.parse_args()
+
+if args.in_graph_rewiring and args.disable_rewiring:
+    parser.error("--in_graph_rewiring rewires inside the train step, so it "
+                 "cannot be combined with --disable_rewiring")
@@ -56,7 +56,13 @@ def generate_sparse_lenet_300_100_model(activation='relu',
                                         categorical_output=True,
                                         builtin_sparsity=None,
                                         conn_decay=None,
-                                        num_classes=10):
+                                        num_classes=10,
+                                        in_graph_rewiring=False,
+                                        kernel_format='dense',
+                                        sparse_gradient=False,
+                                        mask_dtype=None,
+                                        cache_kernel=False,
+                                        rewiring_noise_coeff=10 ** -6):
     '''
     Model is defined in LeCun et al. 1998
     Gradient-Based Learning Applied to Document Recognition
@@ -85,6 +91,12 @@ def generate_sparse_lenet_300_100_model(activation='relu',
                      # consume the first entry in builtin_sparsity
                      connectivity_level=builtin_sparsity.pop(0) or None,
                      connectivity_decay=conn_decay.pop(0) or None,
+                     in_graph_rewiring=in_graph_rewiring,
+                     rewiring_noise_coeff=rewiring_noise_coeff,
+                     kernel_format=kernel_format,
+                     sparse_gradient=sparse_gradient,
+                     mask_dtype=mask_dtype,
+                     cache_kernel=cache_kernel,
                      input_shape=input_shape,
                      # use_bias=False,
                      activation=activation,
@@ -96,6 +108,12 @@ def generate_sparse_lenet_300_100_model(activation='relu',
                      # consume the 2nd entry in builtin_sparsity
                      connectivity_level=builtin_sparsity.pop(0) or None,
                      connectivity_decay=conn_decay.pop(0) or None,
+                     in_graph_rewiring=in_graph_rewiring,
+                     rewiring_noise_coeff=rewiring_noise_coeff,
+                     kernel_format=kernel_format,
+                     sparse_gradient=sparse_gradient,
+                     mask_dtype=mask_dtype,
+                     cache_kernel=cache_kernel,
                      activation=activation,
                      kernel_regularizer=keras.regularizers.l1(reg_coeff)))
     # Fully-connected (FC) layer
@@ -104,6 +122,12 @@ def generate_sparse_lenet_300_100_model(activation='relu',
                      # consume the last entry in builtin_sparsity
                      connectivity_level=builtin_sparsity.pop(0) or None,
                      connectivity_decay=conn_decay.pop(0) or None,
+                     in_graph_rewiring=in_graph_rewiring,
+                     rewiring_noise_coeff=rewiring_noise_coeff,
+                     kernel_format=kernel_format,
+                     sparse_gradient=sparse_gradient,
+                     mask_dtype=mask_dtype,
+                     cache_kernel=cache_kernel,
                      kernel_constraint=keras.constraints.NonNeg(),
                      activation='softmax'))
 
@@ -136,9 +160,9 @@ def convert_model_to_tf(model):
         # l300_indices = tf.constant(np.where(layers[0].get_weights()[-1] > 0.5), dtype=tf.int64)
         # l100_indices = tf.constant(np.where(layers[1].get_weights()[-1] > 0.5), dtype=tf.int64)
         # l10_indices = tf.constant(np.where(layers[-1].get_weights()[-1] > 0.5), dtype=tf.int64)
-        l300_indices = tf.where(tf.not_equal(layers[0].get_weights()[-1], 0.0))
-        l100_indices = tf.where(tf.not_equal(layers[1].get_weights()[-1], 0.0))
-        l10_indices = tf.where(tf.not_equal(layers[-1].get_weights()[-1], 0.0))
+        l300_indices = tf.where(tf.not_equal(layers[0].get_weights()[-1], 0))
+        l100_indices = tf.where(tf.not_equal(layers[1].get_weights()[-1], 0))
+        l10_indices = tf.where(tf.not_equal(layers[-1].get_weights()[-1], 0))
 
         l300_values = tf.gather_nd(tf.constant(layers[0].get_weights()[0]), l300_indices)
         l100_values = tf.gather_nd(tf.constant(layers[1].get_weights()[0]), l100_indices)
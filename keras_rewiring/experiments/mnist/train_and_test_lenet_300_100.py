@@ -6,18 +6,25 @@ from keras_rewiring.experiments.mnist.lenet_300_100_model_setup import \
     generate_sparse_lenet_300_100_model
 
 
-def train_and_test_lenet_300_100(filename):
+def train_and_test_lenet_300_100(filename, communicator=None):
     print(filename)
     start_time = plt.datetime.datetime.now()
     # Setting number of CPUs to use
-    set_nslots()
+    num_cores = set_nslots(args.replicas)
+    # Data-parallel training: only rank 0 reports, validates and saves
+    is_root = communicator is None or communicator.is_root
+    if communicator is not None:
+        synchronise_random_seed(communicator)
 
-    # Setting up directory structure
-    setup_directory_structure()
+    if is_root:
+        # Setting up directory structure
+        setup_directory_structure()
 
     is_output_categorical = True
     dataset_info = load_and_preprocess_dataset(
-        'mnist', categorical_output=is_output_categorical)
+        'mnist', categorical_output=is_output_categorical,
+        shard_index=communicator.rank if communicator is not None else 0,
+        num_shards=communicator.size if communicator is not None else 1)
     x_train, y_train = dataset_info['train']
     x_test, y_test = dataset_info['test']
     num_classes = dataset_info['num_classes']
@@ -33,6 +40,8 @@ def train_and_test_lenet_300_100(filename):
 
     # Retrieve optimizer and its name (for files and reports)
     optimizer, optimizer_name = extract_optimizer_from_args(learning_rate)
+    if communicator is not None:
+        optimizer = distributed_optimizer(optimizer, communicator)
 
     loss = keras.losses.categorical_crossentropy
 
@@ -47,6 +56,8 @@ def train_and_test_lenet_300_100(filename):
         conn_decay_values = (np.log(1. / final_conns) / epochs).tolist()
         builtin_sparsity = np.ones(len(conn_decay_values)).tolist()
 
+    # soft rewiring noise, used by the callback and by in-graph rewiring
+    noise_coeff = 10 ** -5
     if not args.sparse_layers:
         model = generate_lenet_300_100_model(
             activation=args.activation,
@@ -60,31 +71,69 @@ def train_and_test_lenet_300_100(filename):
                 categorical_output=is_output_categorical,
                 builtin_sparsity=builtin_sparsity,
                 conn_decay=conn_decay_values,
-                num_classes=num_classes)
+                num_classes=num_classes,
+                in_graph_rewiring=args.in_graph_rewiring,
+                kernel_format=args.kernel_format,
+                sparse_gradient=args.sparse_gradient,
+                mask_dtype=args.mask_dtype,
+                cache_kernel=args.cache_kernel,
+                rewiring_noise_coeff=noise_coeff)
         else:
             model = generate_sparse_lenet_300_100_model(
                 activation=args.activation,
                 categorical_output=is_output_categorical,
                 builtin_sparsity=builtin_sparsity,
-                num_classes=num_classes)
+                num_classes=num_classes,
+                in_graph_rewiring=args.in_graph_rewiring,
+                kernel_format=args.kernel_format,
+                sparse_gradient=args.sparse_gradient,
+                mask_dtype=args.mask_dtype,
+                cache_kernel=args.cache_kernel,
+                rewiring_noise_coeff=noise_coeff)
     else:
         print("Soft rewiring enabled", args.soft_rewiring)
         model = generate_sparse_lenet_300_100_model(
             activation=args.activation,
             categorical_output=is_output_categorical,
-            num_classes=num_classes)
+            num_classes=num_classes,
+            in_graph_rewiring=args.in_graph_rewiring,
+            kernel_format=args.kernel_format,
+            sparse_gradient=args.sparse_gradient,
+            mask_dtype=args.mask_dtype,
+            cache_kernel=args.cache_kernel,
+            rewiring_noise_coeff=noise_coeff)
     model.summary()
 
     # disable rewiring with sparse layers to see the performance of the layer
     # when 90% of connections are disabled and static
+    regrowth_policy = extract_regrowth_policy_from_args()
     deep_r = RewiringCallback(fixed_conn=args.disable_rewiring,
                               soft_limit=args.soft_rewiring,
-                              noise_coeff=10 ** -5,
-                              asserts_on=args.asserts_on)
+                              noise_coeff=noise_coeff,
+                              asserts_on=args.asserts_on,
+                              rewire_every_n_batches=args.rewire_every_n_batches,
+                              adaptive_interval=args.adaptive_rewiring_interval,
+                              asynchronous=args.async_rewiring,
+                              workers=min(args.rewiring_workers, num_cores),
+                              structure=extract_rewiring_structure_from_args(),
+                              layers_per_batch=args.layers_per_batch,
+                              layer_schedule=args.layer_schedule,
+                              global_budget=args.global_budget,
+                              connection_budget=args.connection_budget,
+                              regrowth_policy=regrowth_policy,
+                              communicator=communicator)
     model.compile(
         optimizer=optimizer,
         loss=loss,
         metrics=['accuracy', keras.metrics.top_k_categorical_accuracy])
+    if args.sparse_layers and regrowth_policy is not None:
+        regrowth_policy.attach(model)
+
+    initial_epoch = 0
+    if args.resume_checkpoint:
+        initial_epoch = load_compact_checkpoint(
+            args.resume_checkpoint, model,
+            deep_r if args.sparse_layers else None)
 
     suffix = ""
     if args.suffix:
@@ -108,17 +157,44 @@ def train_and_test_lenet_300_100(filename):
     else:
         output_filename = "results_for_" + model_name + __filename
 
+    writer = None
+    if args.background_writes and is_root:
+        writer = BackgroundWriter(args.background_writes)
+
     csv_path = os.path.join(args.result_dir, output_filename + ".csv")
-    csv_logger = keras.callbacks.CSVLogger(
-        csv_path,
-        separator=',',
-        append=False)
+    if writer is not None:
+        csv_logger = BackgroundCSVLogger(
+            csv_path, writer,
+            separator=',',
+            append=bool(args.resume_checkpoint))
+    else:
+        csv_logger = keras.callbacks.CSVLogger(
+            csv_path,
+            separator=',',
+            append=bool(args.resume_checkpoint))
 
     callback_list = []
+    if communicator is not None:
+        callback_list.append(BroadcastWeightsCallback(communicator))
+    if args.profile_steps:
+        # first in the list, so that it is closest to the train step
+        step_timer = StepTimingCallback(
+            filename=os.path.join(args.result_dir,
+                                  output_filename + "_step_times.csv"),
+            background_writer=writer)
+        deep_r.profiler = step_timer
+        callback_list.append(step_timer)
     if args.sparse_layers:
+        if args.event_log and is_root:
+            deep_r.event_log = RewiringEventLog(
+                os.path.join(args.result_dir,
+                             output_filename + "_events.evt"),
+                background_writer=writer,
+                resume_epoch=(initial_epoch if args.resume_checkpoint
+                              else None))
         callback_list.append(deep_r)
 
-    if args.tensorboard:
+    if args.tensorboard and is_root:
         tb_log_filename = "./sparse_logs" if args.sparse_layers else "./dense_logs"
 
         tb = keras.callbacks.TensorBoard(
@@ -132,14 +208,34 @@ def train_and_test_lenet_300_100(filename):
             profile_batch='500,520')
         callback_list.append(tb)
 
-    callback_list.append(csv_logger)
+    if is_root:
+        callback_list.append(csv_logger)
+    if args.compact_checkpoints and is_root:
+        callback_list.append(CompactModelCheckpoint(
+            os.path.join(args.model_dir,
+                         "compact_" + output_filename + ".{epoch:02d}.h5"),
+            rewiring_callback=deep_r if args.sparse_layers else None,
+            background_writer=writer))
+    if args.delta_checkpoints and is_root:
+        callback_list.append(DeltaModelCheckpoint(
+            os.path.join(args.model_dir,
+                         "history_" + output_filename + ".h5"),
+            rewiring_callback=deep_r if args.sparse_layers else None,
+            background_writer=writer))
     model.fit(x_train, y_train,
               batch_size=batch,
               epochs=epochs,
-              verbose=1,
+              verbose=1 if is_root else 0,
               callbacks=callback_list,
-              validation_data=(x_test, y_test),
+              validation_data=(x_test, y_test) if is_root else None,
+              initial_epoch=initial_epoch,
               )
+    if args.sparse_layers and deep_r.event_log is not None:
+        deep_r.event_log.close()
+    if writer is not None:
+        writer.close()
+    if not is_root:
+        return
 
     score = model.evaluate(x_test, y_test, verbose=1, batch_size=batch)
     print('Test Loss:', score[0])
@@ -249,4 +345,4 @@ if __name__ == "__main__":
             s, t = test_lenet_300_100(i, no_runs)
             print("The score are:", s)
         else:
-            train_and_test_lenet_300_100(i)
+            run_data_parallel(train_and_test_lenet_300_100, i)
@@ -1,17 +1,27 @@
 from keras_rewiring.experiments.common import *
 
 
-def train_and_test_mobilenet():
+def train_and_test_mobilenet(communicator=None):
     start_time = plt.datetime.datetime.now()
     # Setting number of CPUs to use
-    set_nslots()
-
-    # Setting up directory structure
-    setup_directory_structure()
-
-    # Print some reports
-    reports()
-
+    num_cores = set_nslots(args.replicas)
+    # Data-parallel training: only rank 0 reports, validates and saves
+    is_root = communicator is None or communicator.is_root
+    num_replicas = communicator.size if communicator is not None else 1
+    if communicator is not None:
+        synchronise_random_seed(communicator)
+
+    if is_root:
+        # Setting up directory structure
+        setup_directory_structure()
+
+        # Print some reports
+        reports()
+
+    if args.resume_checkpoint:
+        # the learning rate schedule is replayed up to the saved epoch
+        args.continue_from_epoch = read_compact_checkpoint_epoch(
+            args.resume_checkpoint)
     epochs = args.epochs or 10
     if args.continue_from_epoch:
         epochs += args.continue_from_epoch
@@ -93,28 +103,42 @@ def train_and_test_mobilenet():
                 builtin_sparsity=builtin_sparsity,
                 reg_coeffs=alphas,
                 conn_decay=conn_decay_values, no_cache=args.no_cache,
-                random_weights=args.random_weights)
+                random_weights=args.random_weights,
+                in_graph_rewiring=args.in_graph_rewiring,
+                sparse_gradient=args.sparse_gradient,
+                mask_dtype=args.mask_dtype,
+                cache_kernel=args.cache_kernel)
         else:
             model = replace_dense_with_sparse(
                 model,
                 activation=args.activation, batch_size=batch,
                 builtin_sparsity=builtin_sparsity,
                 reg_coeffs=alphas, no_cache=args.no_cache,
-                random_weights=args.random_weights)
+                random_weights=args.random_weights,
+                in_graph_rewiring=args.in_graph_rewiring,
+                sparse_gradient=args.sparse_gradient,
+                mask_dtype=args.mask_dtype,
+                cache_kernel=args.cache_kernel)
     elif args.sparse_layers and args.soft_rewiring:
         print("Soft rewiring enabled", args.soft_rewiring)
         model = replace_dense_with_sparse(
             model,
             activation=args.activation, batch_size=batch,
             reg_coeffs=alphas, no_cache=args.no_cache,
-            random_weights=args.random_weights)
+            random_weights=args.random_weights,
+            in_graph_rewiring=args.in_graph_rewiring,
+            sparse_gradient=args.sparse_gradient,
+            mask_dtype=args.mask_dtype,
+            cache_kernel=args.cache_kernel)
 
     model.summary()
 
     dataset_info = load_and_preprocess_dataset(
         'imagenet', batch_size=batch, path=args.dataset_path,
         steps_per_epoch=args.steps_per_epoch,
-        val_steps_per_epoch=args.val_steps_per_epoch)
+        val_steps_per_epoch=args.val_steps_per_epoch,
+        shard_index=communicator.rank if communicator is not None else 0,
+        num_shards=num_replicas)
     train_gen = dataset_info['train']
     val_gen = dataset_info['val']
     input_shape = dataset_info['input_shape']
@@ -123,7 +147,8 @@ def train_and_test_mobilenet():
     no_val = dataset_info['no_val']
 
     # set up steps_per_epoch
-    steps_per_epoch = args.steps_per_epoch or no_train // batch
+    steps_per_epoch = args.steps_per_epoch or \
+                      no_train // (batch * num_replicas)
     validation_steps_per_epoch = args.val_steps_per_epoch or no_val // batch
 
     print("=" * 60)
@@ -141,14 +166,28 @@ def train_and_test_mobilenet():
 
     # Retrieve optimizer and its name (for files and reports)
     optimizer, optimizer_name = extract_optimizer_from_args(learning_rate)
+    if communicator is not None:
+        optimizer = distributed_optimizer(optimizer, communicator)
 
     loss = keras.losses.categorical_crossentropy
 
     # disable rewiring with sparse layers to see the performance of the layer
     # when 90% of connections are disabled and static
+    regrowth_policy = extract_regrowth_policy_from_args()
     deep_r = RewiringCallback(fixed_conn=args.disable_rewiring,
                               soft_limit=args.soft_rewiring,
-                              asserts_on=args.asserts_on)
+                              asserts_on=args.asserts_on,
+                              rewire_every_n_batches=args.rewire_every_n_batches,
+                              adaptive_interval=args.adaptive_rewiring_interval,
+                              asynchronous=args.async_rewiring,
+                              workers=min(args.rewiring_workers, num_cores),
+                              structure=extract_rewiring_structure_from_args(),
+                              layers_per_batch=args.layers_per_batch,
+                              layer_schedule=args.layer_schedule,
+                              global_budget=args.global_budget,
+                              connection_budget=args.connection_budget,
+                              regrowth_policy=regrowth_policy,
+                              communicator=communicator)
 
     lr_schedule = LearningRateScheduler(lr_reduction_schedule,
                                         verbose=args.verbose)
@@ -157,6 +196,12 @@ def train_and_test_mobilenet():
         optimizer=optimizer,
         loss=loss,
         metrics=['accuracy', keras.metrics.top_k_categorical_accuracy])
+    if args.sparse_layers and regrowth_policy is not None:
+        regrowth_policy.attach(model)
+
+    if args.resume_checkpoint:
+        load_compact_checkpoint(args.resume_checkpoint, model,
+                                deep_r if args.sparse_layers else None)
 
     suffix = ""
     if args.suffix:
@@ -176,21 +221,61 @@ def train_and_test_mobilenet():
         optimizer_name, activation_name, sparse_name, loss_name, suffix,
         args.random_weights,
         acronym=True)
-    checkpoint_filename = __acr_filename + \
-                          "_weights.{epoch:02d}-{val_acc:.2f}.hdf5"
-    checkpoint_callback = ModelCheckpoint(checkpoint_filename, period=5)
+    writer = None
+    if args.background_writes and is_root:
+        writer = BackgroundWriter(args.background_writes)
+
+    if args.compact_checkpoints:
+        checkpoint_filename = __acr_filename + \
+                              "_compact.{epoch:02d}-{val_acc:.2f}.h5"
+        checkpoint_callback = CompactModelCheckpoint(
+            checkpoint_filename,
+            rewiring_callback=deep_r if args.sparse_layers else None,
+            period=5, background_writer=writer)
+    else:
+        checkpoint_filename = __acr_filename + \
+                              "_weights.{epoch:02d}-{val_acc:.2f}.hdf5"
+        if writer is not None:
+            checkpoint_callback = BackgroundModelCheckpoint(
+                checkpoint_filename, writer, period=5)
+        else:
+            checkpoint_callback = ModelCheckpoint(checkpoint_filename,
+                                                  period=5)
 
     csv_path = os.path.join(args.result_dir, output_filename + ".csv")
-    csv_logger = keras.callbacks.CSVLogger(
-        csv_path,
-        separator=',',
-        append=True)
+    if writer is not None:
+        csv_logger = BackgroundCSVLogger(
+            csv_path, writer,
+            separator=',',
+            append=True)
+    else:
+        csv_logger = keras.callbacks.CSVLogger(
+            csv_path,
+            separator=',',
+            append=True)
 
     callback_list = []
+    if communicator is not None:
+        callback_list.append(BroadcastWeightsCallback(communicator))
+    if args.profile_steps:
+        # first in the list, so that it is closest to the train step
+        step_timer = StepTimingCallback(
+            filename=os.path.join(args.result_dir,
+                                  output_filename + "_step_times.csv"),
+            background_writer=writer)
+        deep_r.profiler = step_timer
+        callback_list.append(step_timer)
     if args.sparse_layers:
+        if args.event_log and is_root:
+            deep_r.event_log = RewiringEventLog(
+                os.path.join(args.result_dir,
+                             output_filename + "_events.evt"),
+                background_writer=writer,
+                resume_epoch=(args.continue_from_epoch if args.resume_checkpoint
+                              else None))
         callback_list.append(deep_r)
 
-    if args.tensorboard:
+    if args.tensorboard and is_root:
         tb_log_filename = "./sparse_logs" if args.sparse_layers else "./dense_logs"
 
         tb = keras.callbacks.TensorBoard(
@@ -203,8 +288,14 @@ def train_and_test_mobilenet():
             update_freq='epoch')
         callback_list.append(tb)
 
-    callback_list.append(csv_logger)
-    callback_list.append(checkpoint_callback)
+    if is_root:
+        callback_list.append(csv_logger)
+        callback_list.append(checkpoint_callback)
+        if args.delta_checkpoints:
+            callback_list.append(DeltaModelCheckpoint(
+                __acr_filename + "_history.h5",
+                rewiring_callback=deep_r if args.sparse_layers else None,
+                background_writer=writer))
     callback_list.append(lr_schedule)
 
     # record weight information before learning
@@ -215,9 +306,9 @@ def train_and_test_mobilenet():
         model.fit_generator(train_gen,
                             steps_per_epoch=steps_per_epoch,
                             epochs=epochs,
-                            verbose=args.verbose,
+                            verbose=args.verbose if is_root else 0,
                             callbacks=callback_list,
-                            validation_data=val_gen,
+                            validation_data=val_gen if is_root else None,
                             validation_steps=validation_steps_per_epoch,
                             shuffle=True,
                             max_queue_size=10,
@@ -229,16 +320,25 @@ def train_and_test_mobilenet():
         raise NotImplementedError("Data augmentation not currently supported for "
                                   "Mobilenet trained on Imagenet")
 
+    if args.sparse_layers and deep_r.event_log is not None:
+        deep_r.event_log.close()
+
     end_time = plt.datetime.datetime.now()
     total_time = end_time - start_time
 
     print("Total time elapsed -- " + str(total_time))
+    if not is_root:
+        return
 
     model_path = os.path.join(
         args.model_dir,
         "trained_model_of_" + model_name + __filename + ".h5")
 
-    model.save(model_path)
+    if writer is not None:
+        # written while the model is evaluated
+        save_model_in_background(model, model_path, writer)
+    else:
+        model.save(model_path)
 
     print("Results (csv) saved at", csv_path)
     print("Model saved at", model_path)
@@ -250,7 +350,9 @@ def train_and_test_mobilenet():
                                      verbose=args.verbose)
     print('Test Loss:', score[0])
     print('Test Accuracy:', score[1])
+    if writer is not None:
+        writer.close()
 
 
 if __name__ == "__main__":
-    train_and_test_mobilenet()
+    run_data_parallel(train_and_test_mobilenet)
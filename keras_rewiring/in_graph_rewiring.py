@@ -0,0 +1,95 @@
+import tensorflow as tf
+from keras import backend as K
+
+
+def add_in_graph_rewiring(layer, kernel, mask):
+    """Attach a rewiring step to the training updates of a sparse layer.
+
+    Sign-flip detection, mask clearing and regrowth are all expressed as
+    TensorFlow ops, so they execute inside the train step and the kernel and
+    the mask never have to be copied to the host.
+
+    :param layer: sparse layer being built
+    :type layer: keras.layers.Layer
+    :param kernel: the (unmasked) kernel variable of the layer
+    :param mask: the connectivity mask variable of the layer
+    """
+    # sign of each weight at the previous step (0 = unknown / zero weight)
+    layer.kernel_sign = K.zeros(K.int_shape(kernel),
+                                name=layer.name + '_kernel_sign')
+    # number of rewirings performed since the last time it was reset
+    layer.rewirings = K.variable(0, dtype='int64',
+                                 name=layer.name + '_rewirings')
+    layer.add_update(updates=in_graph_rewiring_updates(
+        kernel, mask, layer.kernel_sign, layer.rewirings,
+        hard_limit=bool(layer.connectivity_level),
+        noise_coeff=layer.rewiring_noise_coeff))
+
+
+def in_graph_rewiring_updates(kernel, mask, kernel_sign, rewirings,
+                              hard_limit=True, noise_coeff=10 ** -6):
+    """Build the update ops performing a single rewiring step.
+
+    Mirrors the host-side logic in `RewiringCallback.on_batch_end`: active
+    connections whose weight changed sign are made dormant; with a hard limit
+    the same number of dormant connections is regrown uniformly at random,
+    otherwise (soft limit) dormant weights are perturbed with Gaussian noise
+    and the ones that change sign become active.
+
+    :return: list of update ops
+    :rtype: list
+    """
+    kernel_shape = K.shape(kernel)
+    flat_kernel = K.reshape(kernel, (-1,))
+    flat_mask = K.reshape(mask, (-1,))
+    flat_sign = K.reshape(kernel_sign, (-1,))
+
+    new_sign = K.sign(flat_kernel)
+    # retrieve active synapses which require rewiring
+    flipped = tf.logical_and(K.greater(flat_mask, 0),
+                             K.less(flat_sign * new_sign, 0))
+    number_needing_rewiring = K.sum(K.cast(flipped, 'int32'))
+    post_m = tf.where(flipped, K.zeros_like(flat_mask), flat_mask)
+    dormant = K.equal(post_m, 0)
+
+    updates = []
+    if hard_limit:
+        # HARD REWIRING
+        # random scores for dormant connections, -1 for the active ones so
+        # that top_k only ever selects dormant connections
+        scores = tf.where(dormant,
+                          K.random_uniform(K.shape(flat_mask)),
+                          -K.ones_like(flat_kernel))
+        _, chosen_partners = tf.math.top_k(scores, k=number_needing_rewiring)
+        regrown = tf.scatter_nd(K.expand_dims(chosen_partners, -1),
+                                K.ones_like(chosen_partners, dtype=K.dtype(mask)),
+                                K.shape(flat_mask))
+        new_m = post_m + regrown
+        new_kernel = flat_kernel
+    else:
+        # SOFT REWIRING
+        # Apply noise only to dormant connections, including the ones which
+        # were just dropped, as `LayerRewiringState.perturb_dormant` does
+        # after deactivating them. The sign change is measured against the
+        # pre-noise kernel, so a dropped connection is only regrown if the
+        # noise flips it back
+        candidates = dormant
+        noise = K.random_normal(K.shape(flat_kernel), stddev=noise_coeff)
+        noisy_kernel = flat_kernel + noise
+        # dormant connections whose sign is changed by the noise become
+        # active, then they are clipped so that they don't drift too far
+        # from 0
+        regrown = tf.logical_and(
+            candidates, K.less(K.sign(flat_kernel) * K.sign(noisy_kernel), 0))
+        new_kernel = tf.where(candidates,
+                              K.clip(noisy_kernel, -1.5, 1.5),
+                              flat_kernel)
+        new_m = tf.where(regrown, K.ones_like(post_m), post_m)
+        updates.append(K.update(kernel, K.reshape(new_kernel, kernel_shape)))
+
+    updates.append(K.update(mask, K.reshape(new_m, kernel_shape)))
+    updates.append(K.update(kernel_sign,
+                            K.reshape(K.sign(new_kernel), kernel_shape)))
+    updates.append(K.update_add(rewirings,
+                                K.cast(number_needing_rewiring, 'int64')))
+    return updates
@@ -0,0 +1,145 @@
+import os
+import time
+import threading
+from collections import defaultdict
+import numpy as np
+from keras.callbacks import Callback
+
+
+class StepTimingCallback(Callback):
+    """Per-batch wall-clock breakdown of a training run.
+
+    Three phases are recorded for every batch:
+        - `train_step`: from `on_batch_begin` to `on_batch_end`, i.e. the
+          forward / backward pass and the optimizer update
+        - `rewiring`: host work done by an instrumented `RewiringCallback`
+          (pass this object as its `profiler`)
+        - `data`: the rest of the time between the end of a batch and the
+          beginning of the next one (mostly retrieving the next batch from
+          the data generator)
+
+    Per-layer rewiring time and flip counts are also recorded. At the end of
+    each epoch the mean, p50, p95 and p99 of every phase are added to the
+    logs (and therefore to the `CSVLogger` output) and, if `filename` is
+    provided, appended to a separate CSV file along with the per-layer
+    summaries.
+
+    This callback should be the first one in the callback list so that its
+    `on_batch_begin` / `on_batch_end` are the closest to the train step.
+    The CSV file can be written by a `BackgroundWriter`.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, filename=None, log_summaries=True,
+                 background_writer=None):
+        super(StepTimingCallback, self).__init__()
+        self.filename = filename
+        self.log_summaries = log_summaries
+        self.background_writer = background_writer
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.phases = defaultdict(list)
+        self.layer_times = defaultdict(list)
+        self.layer_flips = defaultdict(list)
+        self._batch_begin = None
+        self._last_batch_end = None
+        self._rewiring_time = 0.
+        # the rewiring time of a batch is complete at the beginning of the
+        # next one (or at the end of the epoch)
+        self._rewiring_pending = False
+
+    def record_rewiring(self, seconds):
+        self._rewiring_time += seconds
+
+    def record_layer(self, layer_name, seconds, flips):
+        # can be called from the rewiring worker threads
+        with self._lock:
+            self.layer_times[layer_name].append(seconds)
+            self.layer_flips[layer_name].append(flips)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._reset()
+        self._last_batch_end = time.perf_counter()
+
+    def _flush_rewiring(self):
+        if self._rewiring_pending:
+            self.phases['rewiring'].append(self._rewiring_time)
+            self._rewiring_pending = False
+
+    def on_batch_begin(self, batch, logs=None):
+        now = time.perf_counter()
+        if self._last_batch_end is not None:
+            self.phases['data'].append(
+                now - self._last_batch_end - self._rewiring_time)
+        self._flush_rewiring()
+        self._rewiring_time = 0.
+        self._batch_begin = now
+
+    def on_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        if self._batch_begin is not None:
+            self.phases['train_step'].append(now - self._batch_begin)
+        self._last_batch_end = now
+        self._rewiring_pending = True
+
+    @staticmethod
+    def summarise(values):
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return {}
+        summary = {'count': values.size, 'mean': np.mean(values)}
+        for p, v in zip(StepTimingCallback.PERCENTILES,
+                        np.percentile(values, StepTimingCallback.PERCENTILES)):
+            summary['p{}'.format(p)] = v
+        return summary
+
+    def summaries(self):
+        summaries = {}
+        for phase, values in self.phases.items():
+            summaries['time_' + phase] = self.summarise(values)
+        for name in self.layer_times.keys():
+            summaries['time_rewiring_' + name] = \
+                self.summarise(self.layer_times[name])
+            summaries['flips_' + name] = \
+                self.summarise(self.layer_flips[name])
+        return summaries
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        # rewiring done after the last batch of the epoch
+        self._flush_rewiring()
+        summaries = self.summaries()
+        stats = ['mean'] + ['p{}'.format(p) for p in self.PERCENTILES]
+        if self.log_summaries:
+            for phase in self.phases.keys():
+                for stat in stats:
+                    logs['time_{}_{}'.format(phase, stat)] = \
+                        summaries['time_' + phase][stat]
+        if not self.filename:
+            return
+        if self.background_writer is None:
+            self.write_summaries(epoch, summaries)
+        else:
+            self.background_writer.submit(self.write_summaries,
+                                          epoch, summaries)
+
+    def write_summaries(self, epoch, summaries):
+        stats = ['mean'] + ['p{}'.format(p) for p in self.PERCENTILES]
+        write_header = not os.path.exists(self.filename)
+        with open(self.filename, 'a') as f:
+            if write_header:
+                f.write(",".join(['epoch', 'quantity', 'count'] + stats)
+                        + "\n")
+            for name, summary in sorted(summaries.items()):
+                if not summary:
+                    continue
+                f.write(",".join(
+                    [str(epoch), name, str(summary['count'])] +
+                    ["{:.6g}".format(summary[s]) for s in stats]) + "\n")
+
+    def on_train_end(self, logs=None):
+        if self.background_writer is not None:
+            self.background_writer.flush()
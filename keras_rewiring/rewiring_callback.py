@@ -1,17 +1,340 @@
+from collections import namedtuple
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import time
+import warnings
 import keras
 from keras.callbacks import Callback
 import tensorflow as tf
 import numpy as np
 from keras import backend as K
+from keras_rewiring.utilities.sign_bitmap import SignBitmap
+from keras_rewiring.utilities.index_pool import ConnectionIndexPool
+from keras_rewiring.utilities.scatter_update import scatter_update
+from keras_rewiring.utilities import event_log as events
+from keras_rewiring.utilities.regrowth import RandomRegrowth
+from keras_rewiring.sparse_layer import invalidate_kernel_caches
+
+# Result of rewiring a single layer: flat indices of the connections that were
+# made dormant (dropped) or active (regrown) and, with soft rewiring (which
+# perturbs every dormant entry), the new value of the whole kernel
+LayerRewiring = namedtuple('LayerRewiring',
+                           ['state', 'number_rewired', 'dropped', 'regrown',
+                            'kernel'])
+
+
+class LayerRewiringState(object):
+    """Host-side rewiring state kept for a single sparse layer.
+
+    The mask is only ever changed by the rewiring callback, so a host copy of
+    it is kept between batches (alongside a packed version used to select
+    active connections and a `ConnectionIndexPool` of the active and dormant
+    connections) instead of being retrieved from the backend. Kernel signs
+    are tracked using a `SignBitmap`.
+
+    If a structure is provided (see `structured_sparsity`), the mask is first
+    projected onto it, so the caller has to write `mask` back to the layer.
+    """
+
+    def __init__(self, layer, kernel, mask, interval=1, structure=None):
+        self.layer = layer
+        self.structure = None
+        if structure is not None:
+            self.structure = structure.bind(np.shape(mask))
+            mask = self.structure.project(mask, kernel)
+        self.mask = np.array(mask)
+        # flat view of the mask, modified in place by rewiring
+        self.flat_mask = self.mask.reshape(-1)
+        self.packed_mask = SignBitmap.pack(self.flat_mask != 0)
+        self.pool = ConnectionIndexPool(self.flat_mask)
+        self.sign_bitmap = SignBitmap(self.mask.size)
+        self.sign_bitmap.update(kernel)
+        # seeded from the global RNG so that np.random.seed still applies
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31 - 1))
+        # number of batches between rewiring points, and batches elapsed
+        # since the last one
+        self.interval = interval
+        self.batches_since_rewiring = 0
+        # layer scheduling: weight accumulated since the last rewiring, and
+        # moving average of the flip rate (per active connection per batch)
+        self.schedule_credit = 0.
+        self.flip_rate = 0.
+        # global connection budget: cost of a connection of this layer, and
+        # budget allocated to this layer but not yet spent on regrowth
+        self.connection_cost = 1.
+        self.budget_credit = 0.
+        # value of the score variable of the regrowth policy (if any) at the
+        # last rewiring step
+        self.regrowth_scores = None
+        self._soft_buffers = None
+        if self.structure is not None:
+            self.structure.initialise(self)
+
+    def soft_rewiring_buffers(self, no_dormant, dtype):
+        """Preallocated buffers used by soft rewiring, cut to `no_dormant`."""
+        if self._soft_buffers is None or self._soft_buffers[1].dtype != dtype:
+            size = self.mask.size
+            self._soft_buffers = (np.empty(size, dtype=np.int64),
+                                  np.empty(size, dtype=dtype),
+                                  np.empty(size, dtype=dtype),
+                                  np.empty(size, dtype=bool))
+        return tuple(b[:no_dormant] for b in self._soft_buffers)
+
+    def perturb_dormant(self, flat_kernel, noise_coeff):
+        """Soft rewiring step: add noise to the dormant connections.
+
+        All the work is done in place in buffers preallocated for this layer.
+
+        :return: dormant connections whose sign changed, and the dormant
+            kernel entries together with their new values
+        :rtype: tuple
+        """
+        rewiring_candidates, dormant_k, noisy_k, sign_changed = \
+            self.soft_rewiring_buffers(self.pool.no_dormant, flat_kernel.dtype)
+        rewiring_candidates[:] = self.pool.dormant()
+        np.take(flat_kernel, rewiring_candidates, out=dormant_k)
+        # Apply noise only to dormant connections
+        self.rng.standard_normal(out=noisy_k, dtype=noisy_k.dtype)
+        noisy_k *= noise_coeff
+        noisy_k += dormant_k
+        # dormant connections whose sign changed become active
+        np.multiply(noisy_k, dormant_k, out=dormant_k)
+        np.less(dormant_k, 0, out=sign_changed)
+        chosen_partners = rewiring_candidates[sign_changed]
+        # clip dormant connections so that they don't drift too far
+        # from 0, active connections keep their post-batch values
+        np.clip(noisy_k, -1.5, 1.5, out=noisy_k)
+        self.sign_bitmap.set(rewiring_candidates, noisy_k)
+        return chosen_partners, rewiring_candidates, noisy_k
+
+    def reset_pools(self):
+        """Rebuild the connection pools in their canonical order (sorted
+        active connections, then sorted dormant ones), which is how they
+        are built from the mask when training is resumed."""
+        self.pool = ConnectionIndexPool(self.flat_mask)
+        if self.structure is not None:
+            self.structure.initialise(self)
+
+    def get_state(self):
+        """State needed to resume rewiring exactly, e.g. from a checkpoint.
+
+        The mask itself is saved with the model, and the connection pools
+        are rebuilt from it, so this has to be called while the pools are in
+        their canonical order, i.e. at the end of an epoch (see
+        `reset_pools`). Only the signs of the active connections are saved,
+        as the others are recorded again before they are compared.
+        """
+        active = SignBitmap.unpack_indices(self.packed_mask)
+        state = {'interval': self.interval,
+                 'batches_since_rewiring': self.batches_since_rewiring,
+                 'schedule_credit': self.schedule_credit,
+                 'flip_rate': self.flip_rate,
+                 'budget_credit': self.budget_credit,
+                 'rng': self.rng.bit_generator.state,
+                 'active_sign_positive': SignBitmap.pack(SignBitmap.get_bits(
+                     self.sign_bitmap.positive, active)),
+                 'active_sign_negative': SignBitmap.pack(SignBitmap.get_bits(
+                     self.sign_bitmap.negative, active))}
+        if self.regrowth_scores is not None:
+            state['regrowth_scores'] = np.array(self.regrowth_scores)
+        return state
+
+    def set_state(self, state):
+        self.interval = state['interval']
+        self.batches_since_rewiring = state['batches_since_rewiring']
+        self.schedule_credit = state['schedule_credit']
+        self.flip_rate = state['flip_rate']
+        self.budget_credit = state.get('budget_credit', 0.)
+        self.rng.bit_generator.state = state['rng']
+        if 'active_sign_positive' in state:
+            active = SignBitmap.unpack_indices(self.packed_mask)
+            for name in ('positive', 'negative'):
+                bits = np.zeros_like(self.packed_mask)
+                SignBitmap.assign_bits(bits, active, np.unpackbits(
+                    state['active_sign_' + name],
+                    count=active.size).astype(bool))
+                setattr(self.sign_bitmap, name, bits)
+        else:
+            # signs of every entry of the kernel
+            self.sign_bitmap.positive = np.array(state['sign_positive'],
+                                                 dtype=np.uint8)
+            self.sign_bitmap.negative = np.array(state['sign_negative'],
+                                                 dtype=np.uint8)
+        self.regrowth_scores = state.get('regrowth_scores')
+
+    def deactivate(self, flat_indices):
+        self.flat_mask[flat_indices] = 0
+        SignBitmap.assign_bits(self.packed_mask, flat_indices, False)
+        self.pool.deactivate(flat_indices)
+
+    def activate(self, flat_indices):
+        self.flat_mask[flat_indices] = 1
+        SignBitmap.assign_bits(self.packed_mask, flat_indices, True)
+        self.pool.activate(flat_indices)
+
+
+class CooRewiringState(object):
+    """Host-side rewiring state of a sparse layer in the 'coo' format.
+
+    The layer holds a fixed number of slots, each with a value and the
+    (row, column) index of a connection. Rewiring a connection overwrites
+    the index of its slot with a dormant connection, found by rejection
+    sampling against the occupied indices, and resets its value to 0, so
+    nothing of the size of the dense kernel is stored on the host either.
+    """
+
+    def __init__(self, layer, values, indices, interval=1):
+        self.layer = layer
+        self.shape = tuple(int(d) for d in layer.kernel_shape)
+        self.size = int(np.prod(self.shape))
+        # flat index of the connection held by each slot
+        self.flat_indices = np.ravel_multi_index(
+            tuple(np.asarray(indices, dtype=np.int64).T), self.shape)
+        self.signs = np.sign(values).astype(np.int8)
+        # seeded from the global RNG so that np.random.seed still applies
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31 - 1))
+        self.interval = interval
+        self.batches_since_rewiring = 0
+
+    def flips(self, values):
+        """Slots whose value changed sign since the last call (a value of
+        0 never counts as a change)."""
+        signs = np.sign(values).astype(np.int8)
+        flipped = np.flatnonzero(signs * self.signs < 0)
+        self.signs = signs
+        return flipped
+
+    def sample_dormant(self, k, occupied):
+        """Sample k distinct connections, none of them in `occupied`."""
+        chosen = np.empty(0, dtype=np.int64)
+        while chosen.size < k:
+            # draw more than needed, as some are rejected
+            candidates = self.rng.integers(0, self.size,
+                                           2 * (k - chosen.size) + 8)
+            candidates = candidates[~np.isin(candidates, occupied)]
+            chosen = np.concatenate((chosen, candidates))
+            _, first = np.unique(chosen, return_index=True)
+            chosen = chosen[np.sort(first)]
+        return chosen[:k]
+
+    def swap(self, slots, flat_indices):
+        self.flat_indices[slots] = flat_indices
+        self.signs[slots] = 0
+
+    def get_state(self):
+        return {'interval': self.interval,
+                'batches_since_rewiring': self.batches_since_rewiring,
+                'rng': self.rng.bit_generator.state,
+                'sign_values': self.signs.copy()}
+
+    def set_state(self, state):
+        self.interval = state['interval']
+        self.batches_since_rewiring = state['batches_since_rewiring']
+        self.rng.bit_generator.state = state['rng']
+        self.signs = np.array(state['sign_values'], dtype=np.int8)
 
 
 class RewiringCallback(Callback):
 
+    LAYER_SCHEDULES = ('round_robin', 'size', 'flip_rate')
+    GLOBAL_BUDGETS = ('params', 'flops')
+
     def __init__(self, connectivity_proportion=None,
                  soft_limit=False,
                  fixed_conn=False,
                  noise_coeff=10 ** -6,
-                 asserts_on=False):
+                 asserts_on=False,
+                 rewire_every_n_batches=1,
+                 adaptive_interval=False,
+                 max_rewire_interval=64,
+                 target_flip_rate=10 ** -4,
+                 asynchronous=False,
+                 workers=1,
+                 profiler=None,
+                 structure=None,
+                 layers_per_batch=None,
+                 layer_schedule='round_robin',
+                 schedule_window=None,
+                 communicator=None,
+                 event_log=None,
+                 global_budget=None,
+                 connection_budget=None,
+                 regrowth_policy=None):
+        """
+        :param rewire_every_n_batches: number of batches between rewiring
+            points. Sign changes are accumulated in between.
+        :type rewire_every_n_batches: int
+        :param adaptive_interval: double the interval of a layer (up to
+            `max_rewire_interval`) when its flip rate drops below
+            `target_flip_rate` and halve it (down to
+            `rewire_every_n_batches`) when it exceeds twice that rate
+        :type adaptive_interval: bool
+        :param target_flip_rate: sign flips per active connection per batch
+        :type target_flip_rate: float
+        :param asynchronous: compute the new masks on a background thread
+            while the next batch trains. Masks are applied with a lag of one
+            batch, at the end of the batch following the one they were
+            computed for.
+        :type asynchronous: bool
+        :param workers: number of threads used to rewire layers in parallel.
+            Layers are independent and NumPy releases the GIL, so this can be
+            set up to the number of cores reserved for training (NSLOTS).
+        :type workers: int
+        :param profiler: records the host time spent in this callback and the
+            per-layer rewiring times and flip counts
+        :type profiler: keras_rewiring.profiling_callback.StepTimingCallback
+        :param structure: rewire whole groups of connections so that the
+            masks follow a hardware-friendly pattern. Masks are projected
+            onto the structure when training begins. Not supported together
+            with connectivity decay or in-graph rewiring.
+        :type structure: keras_rewiring.utilities.structured_sparsity.NMSparsity
+            or keras_rewiring.utilities.structured_sparsity.BlockSparsity
+        :param layers_per_batch: maximum number of layers rewired after each
+            batch (all the due layers if None). The layers which are skipped
+            keep accumulating sign changes until they are rewired.
+        :type layers_per_batch: int
+        :param layer_schedule: how layers are chosen when more than
+            `layers_per_batch` are due. Every layer accumulates a weight per
+            batch since it was last rewired and the highest totals are
+            chosen: the weight is 1 for 'round_robin', the number of kernel
+            entries for 'size' and the recent flip rate (at least
+            `target_flip_rate`) for 'flip_rate'.
+        :type layer_schedule: str
+        :param schedule_window: a layer which is overdue by this many
+            batches is rewired before any other. Defaults to twice the
+            number of batches needed to visit every layer once.
+        :type schedule_window: int
+        :param communicator: for data-parallel training. Rank 0 decides the
+            rewiring of every layer and broadcasts the changed indices to the
+            other replicas (once per batch and once per epoch), which only
+            apply them, so masks are identical on every replica.
+        :type communicator: keras_rewiring.utilities.data_parallel.Communicator
+        :param event_log: records the connections dropped and regrown in
+            every layer after every batch (and by connectivity decay), on
+            rank 0 only
+        :type event_log: keras_rewiring.utilities.event_log.RewiringEventLog
+        :param global_budget: regrow the pruned connections in any layer
+            rather than in the one they were pruned from, keeping the total
+            cost of the active connections within `connection_budget`. The
+            cost of a connection is 1 for 'params' and the FLOPs it adds to
+            a forward pass (2 per output position) for 'flops'. The freed
+            budget is shared between the layers in proportion to the cost
+            of their dormant connections (i.e. as if regrown connections
+            were drawn uniformly from the whole model) and the share a layer
+            cannot spend yet is carried over. Requires hard rewiring, not
+            supported together with structure or connectivity decay. Layers
+            in the 'coo' format keep their number of connections and are
+            not part of the budget.
+        :type global_budget: str
+        :param connection_budget: total cost of the active connections.
+            Defaults to the cost of the initial connectivity, if higher the
+            remainder is regrown over the first rewiring steps.
+        :type connection_budget: float
+        :param regrowth_policy: how hard rewiring chooses the dormant
+            connections to regrow (uniformly at random by default, and
+            always for layers in the 'coo' format)
+        :type regrowth_policy: keras_rewiring.utilities.regrowth.RandomRegrowth
+        """
         super(RewiringCallback, self).__init__()
         self.connectivity_proportion = connectivity_proportion
         self.soft_limit = soft_limit
@@ -20,135 +343,709 @@ class RewiringCallback(Callback):
         self._batch_rewires = {}
         self.noise_coeff = noise_coeff
         self.asserts_on = asserts_on
+        self.rewire_every_n_batches = rewire_every_n_batches
+        self.adaptive_interval = adaptive_interval
+        self.max_rewire_interval = max_rewire_interval
+        self.target_flip_rate = target_flip_rate
+        if asynchronous and soft_limit:
+            raise ValueError("Soft rewiring writes the whole kernel, which "
+                             "would undo a batch of training if applied "
+                             "asynchronously")
+        self.asynchronous = asynchronous
+        self.workers = workers
+        self.profiler = profiler
+        self.structure = structure
+        if layer_schedule not in RewiringCallback.LAYER_SCHEDULES:
+            raise ValueError("Unknown layer schedule {}, expected one of "
+                             "{}".format(layer_schedule,
+                                         RewiringCallback.LAYER_SCHEDULES))
+        self.layers_per_batch = layers_per_batch
+        self.layer_schedule = layer_schedule
+        self.schedule_window = schedule_window
+        if global_budget is not None:
+            if global_budget not in RewiringCallback.GLOBAL_BUDGETS:
+                raise ValueError("Unknown global budget {}, expected one of "
+                                 "{}".format(global_budget,
+                                             RewiringCallback.GLOBAL_BUDGETS))
+            if soft_limit or structure is not None:
+                raise ValueError("A global budget requires hard, "
+                                 "unstructured rewiring")
+        self.global_budget = global_budget
+        self.connection_budget = connection_budget
+        if regrowth_policy is not None and \
+                (soft_limit or structure is not None):
+            raise ValueError("Regrowth policies require hard, unstructured "
+                             "rewiring")
+        self.regrowth_policy = regrowth_policy or RandomRegrowth()
+        # remainder of an explicit budget, regrown at the next rewiring step
+        self._spare_budget = 0.
+        self.communicator = communicator
+        # mask changes to broadcast at the next synchronisation point
+        self._outbox = []
+        # checksum of the masks once the changes in the outbox are applied
+        self._outbox_checksum = None
+        # state loaded by `set_state`, restored when training begins
+        self._restored_state = None
+        self.event_log = event_log
+        # position in training of the events
+        self._epoch = 0
+        self._batches_in_epoch = 0
+        self._log_initial_masks = False
+
+        # host-side rewiring state of each (host-rewired) sparse layer, and
+        # of each sparse layer in the 'coo' format
+        self.layer_states = []
+        self.coo_states = []
+        self._executor = None
+        self._pending_rewiring = None
+        self._layer_executor = None
 
-        self.pre_kernels = None
-        self.pre_masks = None
+    @staticmethod
+    def get_sparse_layers(model):
+        return [layer for layer in model.layers if hasattr(layer, "mask")]
+
+    @staticmethod
+    def get_coo_layers(model):
+        return [layer for layer in model.layers
+                if getattr(layer, "kernel_format", 'dense') == 'coo']
 
     @staticmethod
-    def get_kernels_and_masks(model):
-        kernels = []
-        masks = []
+    def get_kernels_and_masks(model, skip_in_graph=False):
         layers = []
-        for layer in model.layers:
-            if hasattr(layer, "mask"):
-                kernels.append(layer.get_weights()[0])
-                masks.append(K.get_value(layer.mask))
-                layers.append(layer)
+        for layer in RewiringCallback.get_sparse_layers(model):
+            if skip_in_graph and getattr(layer, "in_graph_rewiring", False):
+                # rewiring for this layer happens inside the train step
+                continue
+            layers.append(layer)
+        # retrieve all kernels and masks in a single call to the backend
+        values = K.batch_get_value(
+            [v for l in layers for v in (l.original_kernel, l.mask)])
+        kernels = values[0::2]
+        masks = values[1::2]
         return kernels, masks, layers
 
+    def reset_layer_states(self):
+        """(Re-)initialise the host-side state of every host-rewired layer.
+
+        Has to be called if the masks are modified by anything other than
+        this callback (e.g. when loading weights).
+        """
+        kernels, masks, layers = \
+            RewiringCallback.get_kernels_and_masks(self.model,
+                                                   skip_in_graph=True)
+        if self.structure is not None or self.global_budget is not None:
+            for l in layers:
+                if getattr(l, "connectivity_decay", None):
+                    raise ValueError(
+                        "{} rewiring does not support connectivity "
+                        "decay (layer {})".format(
+                            "Structured" if self.structure is not None
+                            else "Global budget", l.name))
+        self.layer_states = [
+            LayerRewiringState(l, k, m, interval=self.rewire_every_n_batches,
+                               structure=self.structure)
+            for k, m, l in zip(kernels, masks, layers)]
+        if self.structure is not None:
+            # write back the masks projected onto the structure
+            K.batch_set_value([(s.layer.mask, s.mask)
+                               for s in self.layer_states])
+        coo_layers = RewiringCallback.get_coo_layers(self.model)
+        if coo_layers and self.soft_limit:
+            raise ValueError("Layers in the 'coo' format only support hard "
+                             "rewiring")
+        values = K.batch_get_value(
+            [v for l in coo_layers for v in (l.kernel_values,
+                                              l.kernel_indices)])
+        self.coo_states = [
+            CooRewiringState(l, v, i, interval=self.rewire_every_n_batches)
+            for l, v, i in zip(coo_layers, values[0::2], values[1::2])]
+
+    def _layer_state(self, layer):
+        for s in self.layer_states + self.coo_states:
+            if s.layer is layer:
+                return s
+        return None
+
+    def on_train_begin(self, logs=None):
+        if self.fixed_conn and not self.asserts_on:
+            # static sparsity: no per-batch host work, only the epoch-level
+            # connection statistics are collected
+            self.layer_states = []
+            self.coo_states = []
+            self._restore_layer_states()
+            return
+        self.reset_layer_states()
+        self._restore_layer_states()
+        if self.global_budget is not None:
+            self._initialise_budget()
+        # the initial masks are recorded once the epoch is known
+        self._log_initial_masks = True
+        if self.asynchronous and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        if self.workers > 1 and self._layer_executor is None:
+            self._layer_executor = ThreadPoolExecutor(
+                max_workers=self.workers)
+
+    def _connection_cost(self, layer):
+        if self.global_budget == 'params':
+            return 1.
+        # one multiply-add per output position (for convolutions)
+        positions = layer.output_shape[1:-1]
+        if None in positions:
+            raise ValueError("A FLOP budget requires the output shape of "
+                             "layer {}".format(layer.name))
+        return 2. * np.prod(positions)
+
+    def _active_cost(self):
+        return sum(s.pool.no_active * s.connection_cost
+                   for s in self.layer_states)
+
+    def _initialise_budget(self):
+        for s in self.layer_states:
+            s.connection_cost = self._connection_cost(s.layer)
+        # the credit of the layers is only non-zero when resuming
+        committed = self._active_cost() + sum(s.budget_credit
+                                              for s in self.layer_states)
+        if self.connection_budget is None:
+            self.connection_budget = committed
+        if self.connection_budget < committed:
+            raise ValueError(
+                "The connection budget ({}) is lower than the cost of the "
+                "active connections ({})".format(self.connection_budget,
+                                                 committed))
+        self._spare_budget = self.connection_budget - committed
+
+    def _share_budget(self, amount):
+        """Share freed budget between layers, in proportion to the cost of
+        their dormant connections."""
+        weights = np.array([s.pool.no_dormant * s.connection_cost
+                            for s in self.layer_states], dtype=float)
+        if not weights.sum():
+            return
+        for s, share in zip(self.layer_states,
+                            amount * weights / weights.sum()):
+            s.budget_credit += share
+
+    def _regrow_globally(self, results):
+        """Regrow connections pruned by `_rewire_layer_state` in any layer
+        that has enough budget credit."""
+        freed = sum(r.dropped.size * r.state.connection_cost
+                    for r in results) + self._spare_budget
+        self._spare_budget = 0.
+        self._share_budget(freed)
+        results = {r.state: r for r in results}
+        empty = np.array([], dtype=np.int64)
+        for s in self.layer_states:
+            no_regrown = min(int(s.budget_credit // s.connection_cost),
+                             s.pool.no_dormant)
+            if no_regrown == 0:
+                continue
+            s.budget_credit -= no_regrown * s.connection_cost
+            r = results.get(s, LayerRewiring(s, 0, empty, empty, None))
+            chosen_partners = self.regrowth_policy.regrow(
+                s, no_regrown, s.regrowth_scores, exclude=r.dropped)
+            s.activate(chosen_partners)
+            results[s] = r._replace(regrown=chosen_partners)
+        return list(results.values())
+
+    @property
+    def _is_follower(self):
+        return self.communicator is not None and \
+               not self.communicator.is_root
+
+    def _record_delta(self, layer, number_rewired, dropped, regrown,
+                      slots=None, kernel=None):
+        if self.communicator is None or self.communicator.size == 1:
+            return
+        # copies, as some of these arrays are buffers reused by the next
+        # rewiring step
+        self._outbox.append((
+            layer.name, number_rewired,
+            np.asarray(dropped, dtype=np.int64).astype(np.int32),
+            np.asarray(regrown, dtype=np.int64).astype(np.int32),
+            None if slots is None else np.asarray(slots).astype(np.int32),
+            None if kernel is None else np.array(kernel)))
+        if self.asserts_on:
+            # taken now, as the host masks can be modified by an
+            # asynchronous rewiring step by the time they are broadcast
+            self._outbox_checksum = self._masks_checksum()
+
+    def _log_event(self, kind, s, dropped=(), regrown=()):
+        if self.event_log is None or self._is_follower:
+            return
+        shape = s.shape if isinstance(s, CooRewiringState) else s.mask.shape
+        self.event_log.record(kind, self._epoch, self._batches_in_epoch,
+                              s.layer.name, shape, dropped, regrown)
+
+    def _masks_checksum(self):
+        checksum = 0
+        for s in self.layer_states:
+            checksum = zlib.crc32(s.packed_mask.tobytes(), checksum)
+        for s in self.coo_states:
+            checksum = zlib.crc32(s.flat_indices.tobytes(), checksum)
+        return checksum
+
+    def _synchronise(self):
+        """Broadcast the mask changes made by rank 0 since the last call.
+
+        Called at the same points by every replica.
+        """
+        if self.communicator is None or self.communicator.size == 1:
+            return
+        if not self._is_follower:
+            message = (self._outbox, self._outbox_checksum)
+            self.communicator.broadcast(message)
+            self._outbox = []
+            return
+        deltas, checksum = self.communicator.broadcast()
+        for name, number_rewired, dropped, regrown, \
+                slots, kernel in deltas:
+            l = self.model.get_layer(name)
+            self._batch_rewires["rewirings_for_layer_{}".format(name)] += \
+                number_rewired
+            s = self._layer_state(l)
+            if isinstance(s, CooRewiringState):
+                self._apply_coo_swap(s, slots, regrown)
+                continue
+            if s is not None:
+                s.deactivate(dropped)
+                s.activate(regrown)
+            # in this order, as a connection can be dropped and regrown
+            scatter_update(l.mask, dropped, 0)
+            scatter_update(l.mask, regrown, 1)
+            if kernel is not None:
+                K.set_value(l.original_kernel, kernel)
+        if checksum is not None:
+            assert checksum == self._masks_checksum(), \
+                "Masks of replica {} differ from rank 0".format(
+                    self.communicator.rank)
+
+    def get_state(self):
+        """Rewiring statistics and host-side state of every layer.
+
+        Together with the weights of the model (including masks), this is
+        what is needed to resume training exactly (see
+        `keras_rewiring.utilities.compact_checkpoint`).
+        """
+        self._apply_pending_rewiring()
+        layers = {s.layer.name: s.get_state()
+                  for s in self.layer_states + self.coo_states}
+        # scores accumulated by the regrowth policy since the last rewiring
+        # step of each layer
+        accumulators = self._regrowth_accumulators()
+        for (name, _), value in zip(accumulators, K.batch_get_value(
+                [v for _, v in accumulators])):
+            layers[name]['regrowth_accumulator'] = value
+        return {'epoch_data': dict(self._data),
+                'batch_data': dict(self._batch_rewires),
+                'layers': layers}
+
+    def _regrowth_accumulators(self):
+        accumulators = [(s.layer.name,
+                         self.regrowth_policy.score_variable(s.layer))
+                        for s in self.layer_states]
+        return [(name, v) for name, v in accumulators if v is not None]
+
+    def set_state(self, state, numpy_random_state=None):
+        """Restore the result of `get_state`.
+
+        The state of the layers is restored when training begins, after the
+        masks have been loaded. The global NumPy RNG state is restored at the
+        same time, as rebuilding the state of the layers draws from it.
+        """
+        self._data = dict(state['epoch_data'])
+        self._batch_rewires = dict(state['batch_data'])
+        self._restored_state = (state['layers'], numpy_random_state)
+
+    def _restore_layer_states(self):
+        if self._restored_state is None:
+            return
+        layer_states, numpy_random_state = self._restored_state
+        self._restored_state = None
+        for s in self.layer_states + self.coo_states:
+            if s.layer.name in layer_states:
+                s.set_state(layer_states[s.layer.name])
+        K.batch_set_value(
+            [(v, layer_states[name]['regrowth_accumulator'])
+             for name, v in self._regrowth_accumulators()
+             if 'regrowth_accumulator' in layer_states.get(name, {})])
+        if numpy_random_state is not None:
+            np.random.set_state(numpy_random_state)
+
+    def on_train_end(self, logs=None):
+        self._apply_pending_rewiring()
+        self._synchronise()
+        # masks written after the last training step
+        invalidate_kernel_caches(self.model)
+        if self.event_log is not None:
+            self.event_log.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._layer_executor is not None:
+            self._layer_executor.shutdown()
+            self._layer_executor = None
+
     def on_epoch_begin(self, epoch, logs=None):
         logs = logs or {}
-        _, _, layers = \
-            RewiringCallback.get_kernels_and_masks(self.model)
-        for l in layers:
+        for l in RewiringCallback.get_sparse_layers(self.model) + \
+                RewiringCallback.get_coo_layers(self.model):
             self._batch_rewires["rewirings_for_layer_{}".format(l.name)] = 0
+        self._epoch = epoch
+        self._batches_in_epoch = 0
+        if self._log_initial_masks:
+            self._log_initial_masks = False
+            for s in self.layer_states:
+                self._log_event(events.INITIAL, s,
+                                regrown=np.flatnonzero(s.flat_mask))
+            for s in self.coo_states:
+                self._log_event(events.INITIAL, s, regrown=s.flat_indices)
 
-    def on_batch_begin(self, batch, logs=None):
-        # save the weights before updating to compare sign later
-        self.pre_kernels, self.pre_masks, _ = \
-            RewiringCallback.get_kernels_and_masks(self.model)
+    def _adapt_interval(self, s, number_rewired):
+        flip_rate = number_rewired / float(
+            max(s.pool.no_active, 1) * s.batches_since_rewiring)
+        if flip_rate < self.target_flip_rate:
+            s.interval = min(s.interval * 2, self.max_rewire_interval)
+        elif flip_rate > 2 * self.target_flip_rate:
+            s.interval = max(s.interval // 2, self.rewire_every_n_batches)
 
     def on_batch_end(self, batch, logs=None):
-        logs = logs or {}
-        # retrieve the new weights (after a batch)
-        self.post_kernels, self.post_masks, self.layers = \
-            RewiringCallback.get_kernels_and_masks(self.model)
+        self._batches_in_epoch += 1
+        if self.profiler is None:
+            return self._on_batch_end(batch, logs)
+        start_time = time.perf_counter()
+        self._on_batch_end(batch, logs)
+        self.profiler.record_rewiring(time.perf_counter() - start_time)
 
+    def _on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        if not self.layer_states and not self.coo_states:
+            return
+        if self.asynchronous:
+            # apply the rewiring computed while this batch was training
+            self._apply_pending_rewiring()
         if self.asserts_on:
-            for k, m, l, i in zip(self.post_kernels, self.post_masks, self.layers,
-                                  np.arange(len(self.layers))):
-                # If you invert the mask, are all those entries in kernel == 0?
-                assumed_prop = np.sum(m) / float(m.size)
-
-                conn_prop = l.connectivity_level
-                if conn_prop and not l.connectivity_decay:
-                    assert (np.isclose(assumed_prop, conn_prop, 0.0001)), \
-                        "{} vs. {}".format(assumed_prop, conn_prop)
-
-            for pre_m, post_m in zip(self.pre_masks, self.post_masks):
-                # Check that the mask has not changed between batch begin and end
-                assert np.all(pre_m == post_m)
+            self._check_masks()
 
         if self.fixed_conn:
             # ASSESSING THE PERFORMANCE OF THE NETWORK WHEN THE CONNECTIVITY
             # IS SPARSE, BUT REWIRING IS DISABLED
             return
+        if self._is_follower:
+            # rewiring is decided by rank 0
+            self._synchronise()
+            logs.update(self._batch_rewires)
+            return
+
+        # only layers which reached the end of their rewiring interval are
+        # processed, the others accumulate sign changes until then
+        for s in self.layer_states + self.coo_states:
+            s.batches_since_rewiring += 1
+        due_states = self._schedule([s for s in self.layer_states
+                                     if s.batches_since_rewiring >= s.interval])
+        due_coo_states = [s for s in self.coo_states
+                          if s.batches_since_rewiring >= s.interval]
+        # retrieve the new weights (after a batch), and the scores of the
+        # regrowth policy, in a single call to the backend
+        score_variables = [self.regrowth_policy.score_variable(s.layer)
+                           for s in due_states]
+        values = K.batch_get_value(
+            [s.layer.original_kernel for s in due_states] +
+            [s.layer.kernel_values for s in due_coo_states] +
+            [v for v in score_variables if v is not None])
+        post_kernels = values[:len(due_states)]
+        post_values = values[len(due_states):
+                             len(due_states) + len(due_coo_states)]
+        scores = iter(values[len(due_states) + len(due_coo_states):])
+        for s, v in zip(due_states, score_variables):
+            if v is not None:
+                s.regrowth_scores = next(scores)
+        # swapping indices is O(nnz), so 'coo' layers are always rewired
+        # synchronously
+        for s, v in zip(due_coo_states, post_values):
+            self._rewire_coo(s, v)
 
         # Let's rewire!
-        for pre_m, post_m, pre_k, post_k, l in zip(
-                self.pre_masks, self.post_masks,
-                self.pre_kernels, self.post_kernels,
-                self.layers):
-            pre_sign = np.sign(pre_k)
-            post_sign = np.sign(post_k)
-
-            # retrieve indices of synapses which require rewiring
-            # save them in a variable and apply the mask
-            # (only rewire active conns)
-            masked_sign_diff = (pre_sign * post_sign) * post_m
-            need_rewiring = np.where(masked_sign_diff < 0)
-
-            # update the mask by selecting other synapses to be active
-            number_needing_rewiring = need_rewiring[0].size
-            self._batch_rewires["rewirings_for_layer_{}".format(l.name)] += \
-                number_needing_rewiring
+        if self.asynchronous:
+            self._pending_rewiring = self._executor.submit(
+                self._rewire, due_states, post_kernels)
+        else:
+            self._apply_rewiring(self._rewire(due_states, post_kernels))
+        self._synchronise()
+        logs.update(self._batch_rewires)
 
-            logs.update(self._batch_rewires)
-            if number_needing_rewiring == 0:
+    def _schedule_weight(self, s):
+        if self.layer_schedule == 'size':
+            return float(s.mask.size)
+        if self.layer_schedule == 'flip_rate':
+            return max(s.flip_rate, self.target_flip_rate)
+        return 1.
+
+    def _schedule(self, due_states):
+        """Choose which of the due layers are rewired after this batch."""
+        if not self.layers_per_batch:
+            return due_states
+        for s in self.layer_states:
+            s.schedule_credit += self._schedule_weight(s)
+        if len(due_states) > self.layers_per_batch:
+            window = self.schedule_window or 2 * int(np.ceil(
+                len(self.layer_states) / float(self.layers_per_batch)))
+
+            def priority(s):
+                # layers overdue by the window first (the oldest first), then
+                # the ones with the most credit
+                overdue = s.batches_since_rewiring - s.interval
+                if overdue >= window:
+                    return True, overdue, s.schedule_credit
+                return False, 0, s.schedule_credit
+
+            due_states = sorted(due_states, key=priority,
+                                reverse=True)[:self.layers_per_batch]
+        for s in due_states:
+            s.schedule_credit = 0.
+        return due_states
+
+    def _check_masks(self):
+        for s in self.layer_states:
+            l = s.layer
+            m = s.mask
+            # If you invert the mask, are all those entries in kernel == 0?
+            assumed_prop = s.pool.no_active / float(m.size)
+            assert s.pool.no_active == np.count_nonzero(m)
+
+            conn_prop = l.connectivity_level
+            if self.global_budget is not None:
+                # connectivity is only constrained for the whole model
+                pass
+            elif s.structure is not None:
+                # the connectivity level is rounded to the structure
+                assert s.structure.is_valid(s.flat_mask)
+                if conn_prop and not self.soft_limit:
+                    assert abs(s.pool.no_active - conn_prop * m.size) <= \
+                        s.structure.group_size, \
+                        "{} vs. {}".format(assumed_prop, conn_prop)
+            elif conn_prop and not l.connectivity_decay:
+                assert (np.isclose(assumed_prop, conn_prop, 0.0001)), \
+                    "{} vs. {}".format(assumed_prop, conn_prop)
+
+            # Check that the mask has not changed since it was last set
+            assert np.all(K.get_value(l.mask) == m)
+        if self.global_budget is not None:
+            assert self._active_cost() <= self.connection_budget
+        for s in self.coo_states:
+            # every slot holds a different connection, the one recorded on
+            # the host
+            assert np.unique(s.flat_indices).size == s.flat_indices.size
+            indices = K.get_value(s.layer.kernel_indices)
+            assert np.all(np.ravel_multi_index(tuple(indices.T), s.shape) ==
+                          s.flat_indices)
+
+    def _rewire(self, states, post_kernels):
+        """Compute the new connectivity of the given layers.
+
+        Only the host-side state is modified, so this can run on a background
+        thread. The result is applied to the model by `_apply_rewiring`.
+        Each layer has its own state and RNG, so layers are processed
+        concurrently when a worker pool is available.
+        """
+        if self._layer_executor is not None and len(states) > 1:
+            results = list(self._layer_executor.map(
+                self._rewire_layer, states, post_kernels))
+        else:
+            results = [self._rewire_layer(s, post_k)
+                       for s, post_k in zip(states, post_kernels)]
+        if self.global_budget is not None:
+            results = self._regrow_globally(results)
+        return results
+
+    def _rewire_layer(self, s, post_k):
+        if self.profiler is None:
+            return self._rewire_layer_state(s, post_k)
+        start_time = time.perf_counter()
+        result = self._rewire_layer_state(s, post_k)
+        self.profiler.record_layer(s.layer.name,
+                                   time.perf_counter() - start_time,
+                                   result.number_rewired)
+        return result
+
+    def _rewire_layer_state(self, s, post_k):
+        # retrieve indices of synapses which require rewiring
+        # (only rewire active conns). This also records the new signs
+        need_rewiring = s.sign_bitmap.flips(post_k, s.packed_mask)
+
+        # update the mask by selecting other synapses to be active
+        number_needing_rewiring = need_rewiring.size
+        if self.adaptive_interval:
+            self._adapt_interval(s, number_needing_rewiring)
+        if self.layer_schedule == 'flip_rate':
+            s.flip_rate = .9 * s.flip_rate + .1 * number_needing_rewiring / \
+                float(max(s.pool.no_active, 1) * s.batches_since_rewiring)
+        s.batches_since_rewiring = 0
+        if number_needing_rewiring == 0:
+            return LayerRewiring(s, 0, need_rewiring, need_rewiring, None)
+
+        if s.structure is not None:
+            dropped, regrown, kernel_indices, kernel_values = \
+                s.structure.rewire(s, need_rewiring, np.ravel(post_k),
+                                   self.soft_limit, self.noise_coeff)
+            return LayerRewiring(s, number_needing_rewiring, dropped,
+                                 regrown, self._new_kernel(
+                                     post_k, kernel_indices, kernel_values))
+
+        s.deactivate(need_rewiring)
+        kernel_indices = kernel_values = None
+        if self.global_budget is not None:
+            # regrown by `_regrow_globally`, once every layer is pruned
+            chosen_partners = need_rewiring[:0]
+        elif not self.soft_limit:
+            # HARD REWIRING
+            chosen_partners = self.regrowth_policy.regrow(
+                s, number_needing_rewiring, s.regrowth_scores,
+                exclude=need_rewiring)
+        else:
+            # SOFT REWIRING
+            chosen_partners, kernel_indices, kernel_values = \
+                s.perturb_dormant(np.ravel(post_k), self.noise_coeff)
+
+        # enable the new connections
+        s.activate(chosen_partners)
+        return LayerRewiring(s, number_needing_rewiring,
+                             need_rewiring, chosen_partners,
+                             self._new_kernel(post_k, kernel_indices,
+                                              kernel_values))
+
+    @staticmethod
+    def _new_kernel(post_k, kernel_indices, kernel_values):
+        # soft rewiring changes (1 - connectivity) of the kernel entries, so
+        # the kernel is written whole rather than as (index, value) pairs
+        if kernel_indices is None:
+            return None
+        flat_kernel = post_k.reshape(-1)
+        flat_kernel[kernel_indices] = kernel_values
+        return flat_kernel.reshape(np.shape(post_k))
+
+    def _apply_rewiring(self, results):
+        """Write the masks (and kernels) computed by `_rewire` to the model.
+
+        Only the mask entries which changed are written. This also means
+        that rewiring computed asynchronously does not overwrite the
+        training update of the other kernel entries. Soft rewiring, which
+        changes every dormant kernel entry, writes the whole kernel.
+        """
+        for r in results:
+            l = r.state.layer
+            self._batch_rewires["rewirings_for_layer_{}".format(l.name)] += \
+                r.number_rewired
+            if r.dropped.size == 0 and r.regrown.size == 0:
                 continue
+            changed = np.concatenate((r.dropped, r.regrown))
+            # a connection may be dropped and regrown in the same step, the
+            # host copy of the mask holds its final value
+            scatter_update(l.mask, changed, r.state.flat_mask[changed])
+            if r.kernel is not None:
+                K.set_value(l.original_kernel, r.kernel)
+            self._record_delta(l, r.number_rewired, r.dropped, r.regrown,
+                               kernel=r.kernel)
+            self._log_event(events.REWIRE, r.state, r.dropped, r.regrown)
+
+    def _rewire_coo(self, s, values):
+        flipped = s.flips(values)
+        s.batches_since_rewiring = 0
+        self._batch_rewires["rewirings_for_layer_{}".format(s.layer.name)] += \
+            flipped.size
+        if flipped.size == 0:
+            return
+        dropped = s.flat_indices[flipped]
+        # a connection can be dropped and regrown in the same step, as with
+        # the dense format
+        regrown = s.sample_dormant(flipped.size,
+                                   np.delete(s.flat_indices, flipped))
+        self._apply_coo_swap(s, flipped, regrown)
+        self._record_delta(s.layer, flipped.size, dropped, regrown, flipped)
+        self._log_event(events.REWIRE, s, dropped, regrown)
+
+    def _apply_coo_swap(self, s, slots, regrown):
+        """Point the given slots of a 'coo' layer to new connections, with
+        a value of 0 and no optimizer state (e.g. momentum) carried over
+        from the connections they held."""
+        s.swap(slots, regrown)
+        slots = np.asarray(slots, dtype=np.int64)
+        # flat indices of the (row, column) pairs of the slots
+        index_entries = np.stack((2 * slots, 2 * slots + 1), axis=1)
+        scatter_update(s.layer.kernel_indices, index_entries,
+                       np.stack(np.unravel_index(regrown, s.shape),
+                                axis=1).ravel())
+        scatter_update(s.layer.kernel_values, slots, 0)
+        for w in self._optimizer_slots(s.layer.kernel_values):
+            scatter_update(w, slots, 0)
+
+    def _optimizer_slots(self, variable):
+        """Weights of the optimizer holding per-parameter state of a
+        trainable variable, found by its shape.
+
+        Optimizers create such weights for every parameter, in the order of
+        the trainable weights, so parameters of the same shape are told
+        apart by their rank among them. If the weights of that shape do not
+        follow this pattern, none are returned (with a warning), rather
+        than resetting the state of other parameters.
+        """
+        optimizer = getattr(self.model, 'optimizer', None)
+        if optimizer is None:
+            return []
+        shape = K.int_shape(variable)
+        params = [p for p in self.model.trainable_weights
+                  if K.int_shape(p) == shape]
+        owned = [p is variable for p in params]
+        if not any(owned):
+            return []
+        rank = owned.index(True)
+        slots = [w for w in optimizer.weights if K.int_shape(w) == shape]
+        if len(slots) % len(params) != 0:
+            # not created per parameter, so the owner is ambiguous
+            warnings.warn("The optimizer state of the rewired connections "
+                          "of a variable of shape {} is not reset, as its "
+                          "weights cannot be told apart from those of "
+                          "other parameters".format(shape))
+            return []
+        return slots[rank::len(params)]
 
-            post_m[need_rewiring] = 0
-            if not self.soft_limit:
-                # HARD REWIRING
-                rewiring_candidates = np.asarray(np.where(post_m == 0))
-                choices = np.random.choice(
-                    np.arange(rewiring_candidates[0].size),
-                    number_needing_rewiring,
-                    replace=False)
-                chosen_partners = tuple(rewiring_candidates[:, choices])
-            else:
-                # SOFT REWIRING
-                rewiring_candidates = np.where(post_m == 0)
-                noise = np.random.normal(scale=self.noise_coeff,
-                                         size=post_k.shape)
-                # Apply noise only to dormant connections
-                post_post_k = pre_k + (noise * post_m)
-                post_post_sign = np.sign(post_post_k)
-                sign_diff = post_post_sign * pre_sign
-                # Disregard active connections, only focus on dormant ones
-                rew_candidates_mask = np.zeros(post_k.shape).astype(bool)
-                rew_candidates_mask[rewiring_candidates] = True
-                sign_diff[np.invert(rew_candidates_mask)] = 0
-                chosen_partners = np.where(sign_diff < 0)
-
-            new_m = post_m
-            new_m[chosen_partners] = 1
-            # enable the new connections
-            K.set_value(l.mask, new_m)
-            if self.soft_limit:
-                # masked pre inactive (dormant) connections
-                masked_pres = post_post_k * (~rew_candidates_mask)
-                # clip masked_pres so that they don't drift too far from 0
-                masked_pres = np.clip(masked_pres, -1.5, 1.5)
-                # add to masked post actives
-                masked_posts = post_k * (rew_candidates_mask)
-                K.set_value(l.original_kernel, masked_pres + masked_posts)
+    def _apply_pending_rewiring(self):
+        if self._pending_rewiring is not None:
+            results = self._pending_rewiring.result()
+            self._pending_rewiring = None
+            self._apply_rewiring(results)
 
     def on_epoch_end(self, epoch, logs=None):
         logs = logs or {}
+        # the epoch statistics must include any rewiring still in flight
+        self._apply_pending_rewiring()
         print("\nEpoch {:3} results:".format(epoch))
+        # retrieve the weights of every sparse layer, including the ones
+        # rewired inside the train step
+        kernels, masks, layers = \
+            RewiringCallback.get_kernels_and_masks(self.model)
         total_num_of_conns = 0
         total_num_active_conns = 0
-        for k, m, l in zip(self.post_kernels, self.post_masks, self.layers):
+        for k, m, l in zip(kernels, masks, layers):
+            if getattr(l, "in_graph_rewiring", False):
+                # collect (and reset) the rewirings counted in-graph
+                self._batch_rewires["rewirings_for_layer_{}".format(l.name)] += \
+                    int(K.get_value(l.rewirings))
+                K.set_value(l.rewirings, 0)
             # report
             total_num_of_conns += m.size
             curr_no_active_connections = np.count_nonzero(m)
             total_num_active_conns += curr_no_active_connections
-            conn_level = l.connectivity_level or curr_no_active_connections / float(m.size)
+            # measured, as structured rewiring and global budgets do not
+            # follow the connectivity level of the layer
+            conn_level = curr_no_active_connections / float(m.size)
             self._data['no_connections_{}'.format(l.name)] = curr_no_active_connections
             self._data['no_rewires_for_layer_{}'.format(l.name)] = \
                 self._batch_rewires["rewirings_for_layer_{}".format(l.name)]
             self._data['proportion_connections_{}'.format(l.name)] = conn_level
+            if self.adaptive_interval and self._layer_state(l) is not None:
+                self._data['rewire_interval_{}'.format(l.name)] = \
+                    self._layer_state(l).interval
             print("Layer {:10} has {:8} connections, corresponding to "
                   "{:>5.1%} of "
                   "the total connectivity".format(
@@ -159,29 +1056,65 @@ class RewiringCallback(Callback):
             if hasattr(l, "connectivity_decay") and l.connectivity_decay:
                 l.connectivity_level -= l.connectivity_level * l.connectivity_decay
                 new_number_of_active_conns = l.get_number_of_active_connections()
-                if new_number_of_active_conns != curr_no_active_connections:
+                # with data parallelism, connections are chosen by rank 0
+                if new_number_of_active_conns != curr_no_active_connections \
+                        and not self._is_follower:
                     # how many connections do we need to make dormant to have
                     # the correct number of active connections?
                     no_diff = curr_no_active_connections - new_number_of_active_conns
                     # candidates for making dormant to be chosen from currently
                     # active connections
-                    rewiring_candidates = np.where(m == 1)
-                    # retrieve candidate weights to be argsorted
-                    candidate_weights = K.abs(k[rewiring_candidates])
-                    argsorted_weights = K.get_value(tf.argsort(candidate_weights)[:no_diff])
-                    # de-activate the first no_diff connections
-                    # (i.e. the ones with the lowest weights)
-
-                    choices = np.asarray(rewiring_candidates)[:, argsorted_weights]
-                    chosen_partners = tuple(choices)
-                    m[chosen_partners] = 0
-                    K.set_value(l.mask, m)
+                    s = self._layer_state(l)
+                    if s is not None:
+                        rewiring_candidates = s.pool.active()
+                    else:
+                        rewiring_candidates = np.flatnonzero(m)
+                    # de-activate the no_diff connections with the lowest
+                    # weights, found with a partial selection rather than
+                    # sorting every active weight
+                    candidate_weights = np.abs(
+                        np.ravel(k)[rewiring_candidates])
+                    if 0 < no_diff < candidate_weights.size:
+                        lowest_weights = np.argpartition(
+                            candidate_weights, no_diff - 1)[:no_diff]
+                        chosen_partners = rewiring_candidates[lowest_weights]
+                    else:
+                        chosen_partners = np.array(
+                            rewiring_candidates[:max(no_diff, 0)])
+                    scatter_update(l.mask, chosen_partners, 0)
+                    if s is not None:
+                        s.deactivate(chosen_partners)
+                        self._log_event(events.DECAY, s, chosen_partners)
+                    self._record_delta(l, 0, chosen_partners, [])
+        for l in RewiringCallback.get_coo_layers(self.model):
+            # the number of connections of a 'coo' layer is fixed
+            no_active = K.int_shape(l.kernel_values)[0]
+            size = int(np.prod(l.kernel_shape))
+            total_num_of_conns += size
+            total_num_active_conns += no_active
+            self._data['no_connections_{}'.format(l.name)] = no_active
+            self._data['no_rewires_for_layer_{}'.format(l.name)] = \
+                self._batch_rewires["rewirings_for_layer_{}".format(l.name)]
+            self._data['proportion_connections_{}'.format(l.name)] = \
+                no_active / float(size)
+            print("Layer {:10} has {:8} connections, corresponding to "
+                  "{:>5.1%} of "
+                  "the total connectivity".format(
+                l.name, no_active, no_active / float(size)))
+        self._synchronise()
+        invalidate_kernel_caches(self.model)
+        # so that the state of the layers can be checkpointed without their
+        # pools, whose order determines the connections sampled
+        for s in self.layer_states:
+            s.reset_pools()
         global_conn_lvl = total_num_active_conns / float(total_num_of_conns)
         print("Total stats: {:8} active connections, corresponding to {:>5.1%} "
               "of total connectivity".format(
             total_num_active_conns,
             global_conn_lvl))
         self._data['global_connectivity_lvl'] = global_conn_lvl
+        if self.global_budget is not None and self.layer_states:
+            self._data['active_connection_cost'] = self._active_cost()
         logs.update(dict(logs.items() | self._data.items()))
         return logs
 
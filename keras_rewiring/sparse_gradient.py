@@ -0,0 +1,121 @@
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+
+# maximum number of elements of the intermediate products of
+# `sampled_matmul`, the rows of the operands are processed in chunks below it
+SAMPLED_MATMUL_CHUNK_ELEMENTS = 2 ** 24
+
+
+def gradient_positions(mask, dormant_rate=None):
+    """(row, column) indices of the kernel entries whose gradient is
+    computed, in the 2D view (prod(shape[:-1]), shape[-1]) of the kernel.
+
+    These are the active connections plus, if `dormant_rate` is positive, a
+    random sample of that proportion of the kernel entries (so that a
+    regrowth policy can score dormant connections).
+    """
+    shape = K.int_shape(mask)
+    positions = K.reshape(mask, (-1, shape[-1])) > 0
+    if dormant_rate is not None:
+        positions = tf.logical_or(positions, tf.cond(
+            dormant_rate > 0,
+            lambda: tf.random.uniform(tf.shape(positions)) < dormant_rate,
+            lambda: tf.zeros_like(positions)))
+    return tf.where(positions)
+
+
+def sampled_matmul(a, b, indices):
+    """Entries of `a^T . b` at the given (row, column) indices only (SDDMM).
+
+    The cost is proportional to the number of indices rather than to the
+    size of the product.
+
+    :param a: tensor of shape (n, rows)
+    :param b: tensor of shape (n, columns)
+    :param indices: int64 tensor of shape (nnz, 2)
+    :return: tensor of shape (nnz,)
+    """
+    rows, cols = indices[:, 0], indices[:, 1]
+    nnz = tf.shape(indices)[0]
+    n = tf.shape(a)[0]
+    chunk = tf.maximum(1, SAMPLED_MATMUL_CHUNK_ELEMENTS // tf.maximum(nnz, 1))
+
+    def accumulate(start, total):
+        a_chunk = tf.gather(a[start:start + chunk], rows, axis=1)
+        b_chunk = tf.gather(b[start:start + chunk], cols, axis=1)
+        return start + chunk, total + tf.reduce_sum(a_chunk * b_chunk, axis=0)
+
+    _, total = tf.while_loop(lambda start, _: start < n, accumulate,
+                             [tf.constant(0), tf.zeros([nnz], dtype=a.dtype)])
+    return total
+
+
+def _scatter_kernel_gradient(indices, values, kernel):
+    shape = K.int_shape(kernel)
+    gradient = tf.scatter_nd(
+        indices, values,
+        tf.constant([int(np.prod(shape[:-1])), shape[-1]], dtype=tf.int64))
+    return K.reshape(gradient, shape)
+
+
+def masked_matmul(inputs, masked_kernel, mask, dormant_rate=None):
+    """`K.dot(inputs, masked_kernel)`, computing the gradient of the kernel
+    only at the positions given by `gradient_positions`.
+
+    The gradient with respect to the inputs is dense, as usual.
+    """
+    input_dim = K.int_shape(masked_kernel)[0]
+
+    @tf.custom_gradient
+    def _matmul(x, kernel):
+        def grad(dy):
+            dx = tf.matmul(dy, kernel, transpose_b=True)
+            indices = gradient_positions(mask, dormant_rate)
+            return dx, _scatter_kernel_gradient(
+                indices, sampled_matmul(x, dy, indices), kernel)
+
+        return tf.matmul(x, kernel), grad
+
+    if K.ndim(inputs) == 2:
+        return _matmul(inputs, masked_kernel)
+    # any leading dimensions of the inputs are flattened into the batch
+    output = _matmul(K.reshape(inputs, (-1, input_dim)), masked_kernel)
+    return K.reshape(output, tf.concat(
+        [tf.shape(inputs)[:-1], tf.shape(output)[-1:]], axis=0))
+
+
+def masked_conv2d(inputs, masked_kernel, mask, strides, padding,
+                  dilation_rate, dormant_rate=None):
+    """`K.conv2d` (channels last), computing the gradient of the kernel only
+    at the positions given by `gradient_positions`.
+
+    The kernel gradient is an SDDMM between the image patches of the inputs
+    (whose entries are ordered as the flattened kernel) and the gradient of
+    the outputs.
+    """
+    kernel_h, kernel_w, _, filters = K.int_shape(masked_kernel)
+    strides = [1] + list(strides) + [1]
+    dilations = [1] + list(dilation_rate) + [1]
+    padding = padding.upper()
+
+    @tf.custom_gradient
+    def _conv(x, kernel):
+        def grad(dy):
+            dx = tf.compat.v1.nn.conv2d_backprop_input(
+                tf.shape(x), kernel, dy, strides=strides, padding=padding,
+                dilations=dilations)
+            patches = tf.compat.v1.extract_image_patches(
+                x, ksizes=[1, kernel_h, kernel_w, 1], strides=strides,
+                rates=dilations, padding=padding)
+            indices = gradient_positions(mask, dormant_rate)
+            values = sampled_matmul(
+                K.reshape(patches, (-1, K.int_shape(patches)[-1])),
+                K.reshape(dy, (-1, filters)), indices)
+            return dx, _scatter_kernel_gradient(indices, values, kernel)
+
+        return tf.compat.v1.nn.conv2d(x, kernel, strides=strides,
+                                      padding=padding,
+                                      dilations=dilations), grad
+
+    return _conv(inputs, masked_kernel)
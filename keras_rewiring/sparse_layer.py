@@ -6,12 +6,142 @@ import keras
 import tensorflow as tf
 import keras.backend as K
 from keras.utils import conv_utils
+from keras_rewiring.in_graph_rewiring import add_in_graph_rewiring
+from keras_rewiring.sparse_gradient import masked_matmul, masked_conv2d
+
+
+def apply_mask(kernel, mask, layer=None):
+    """Kernel multiplied by its mask, which is cast to the type of the
+    kernel as part of the forward pass (so the mask variable can be stored
+    in a smaller type).
+
+    If a layer is given, the functions in its `kernel_gradient_hooks` are
+    called with the gradient of the masked kernel whenever the backward pass
+    is built (i.e. by the optimizer), and the ops they return run before
+    the gradient of the kernel is used (see `GradientMagnitudeRegrowth`).
+    """
+    cast_mask = K.cast(mask, K.dtype(kernel))
+    if layer is None:
+        return kernel * cast_mask
+
+    @tf.custom_gradient
+    def masked(k, m):
+        def grad(dy):
+            hooks = [hook(dy) for hook in
+                     getattr(layer, 'kernel_gradient_hooks', [])]
+            with tf.control_dependencies(hooks):
+                return dy * m, None
+        return k * m, grad
+
+    return masked(kernel, cast_mask)
+
+
+def add_kernel_cache(layer, kernel, mask):
+    """Masked kernel which, outside of training, is only computed again
+    after the kernel or the mask changed.
+
+    The last masked kernel is kept in `layer.kernel_cache`, and is valid
+    while `layer.kernel_cache_valid` is set. Every training step clears the
+    flag, and so has to any write to the kernel or the mask from the host
+    outside of training: `Layer.set_weights` of the sparse layers does, and
+    the weights of a whole model are loaded with `set_weights` and
+    `load_weights` of this module, otherwise `invalidate_kernel_caches` has
+    to be called.
+
+    :return: the masked kernel tensor
+    """
+    layer.kernel_cache = K.zeros(K.int_shape(kernel), dtype=K.dtype(kernel),
+                                 name=layer.name + '_kernel_cache')
+    layer.kernel_cache_valid = K.variable(
+        False, dtype='bool', name=layer.name + '_kernel_cache_valid')
+
+    def training_kernel():
+        # the kernel is updated by the optimizer after this step
+        with tf.control_dependencies(
+                [K.update(layer.kernel_cache_valid, False)]):
+            return apply_mask(kernel, mask, layer)
+
+    def refresh_cache():
+        masked_kernel = apply_mask(kernel, mask)
+        with tf.control_dependencies(
+                [K.update(layer.kernel_cache, masked_kernel)]):
+            with tf.control_dependencies(
+                    [K.update(layer.kernel_cache_valid, True)]):
+                return tf.identity(masked_kernel)
+
+    def inference_kernel():
+        # the masked kernel is computed inside the branches, so that it is
+        # skipped when the cache is valid
+        return tf.cond(layer.kernel_cache_valid,
+                       lambda: tf.identity(layer.kernel_cache),
+                       refresh_cache)
+
+    return K.in_train_phase(training_kernel, inference_kernel)
+
+
+def invalidate_kernel_caches(model):
+    """Recompute the cached masked kernels of the layers of a model at
+    their next inference step.
+
+    Has to be called after the kernels or masks are written from the host
+    (e.g. with `K.set_value`) once the model has been used for inference.
+    """
+    K.batch_set_value([(l.kernel_cache_valid, False) for l in model.layers
+                       if getattr(l, "kernel_cache_valid", None) is not None])
+
+
+def set_weights(model, weights):
+    """`model.set_weights`, which writes the weights of all the layers at
+    once rather than through `Layer.set_weights`, followed by
+    `invalidate_kernel_caches`."""
+    model.set_weights(weights)
+    invalidate_kernel_caches(model)
+
+
+def load_weights(model, filepath, *args, **kwargs):
+    """`model.load_weights`, followed by `invalidate_kernel_caches`."""
+    model.load_weights(filepath, *args, **kwargs)
+    invalidate_kernel_caches(model)
 
 
 class Sparse(Layer):
+    """Densely-connected layer whose connectivity is given by a mask.
+
+    With `kernel_format='dense'` the full kernel and a mask of the same shape
+    are stored, and the kernel is multiplied by the mask. With
+    `kernel_format='coo'` only the active connections are stored, as the
+    values and (row, column) indices of a sparse kernel, and the forward pass
+    is a sparse-dense matrix multiplication, so memory and compute scale with
+    the number of active connections. The number of active connections of a
+    'coo' layer is fixed (`connectivity_level` of the kernel entries), and
+    `RewiringCallback` rewires it by overwriting the indices of the slots of
+    the connections to replace, so the optimizer state and checkpoints are
+    also proportional to the number of active connections.
+
+    Masks are stored as `mask_dtype` (the float type of Keras by default);
+    'uint8' masks take a quarter of the size of float32 masks. Models saved
+    with either type can be loaded into layers of the other, as the weights
+    are cast to the type of the variables.
+
+    With `cache_kernel=True` (dense format), the masked kernel is cached
+    for inference (`predict`, `evaluate`), see `add_kernel_cache`.
+
+    With `sparse_gradient=True` (dense format), the gradient of the kernel
+    is only computed for the active connections (see `sparse_gradient`),
+    rather than for the whole kernel and then masked. This is implied by
+    the 'coo' format.
+    """
+
+    KERNEL_FORMATS = ('dense', 'coo')
 
     def __init__(self, units, connectivity_level=None,
                  connectivity_decay=None,
+                 in_graph_rewiring=False,
+                 rewiring_noise_coeff=10 ** -6,
+                 kernel_format='dense',
+                 sparse_gradient=False,
+                 mask_dtype=None,
+                 cache_kernel=False,
                  activation=None,
                  use_bias=True,
                  kernel_initializer='glorot_uniform',
@@ -37,6 +167,19 @@ class Sparse(Layer):
         self.supports_masking = True
         self.connectivity_level = connectivity_level
         self.connectivity_decay = connectivity_decay
+        self.in_graph_rewiring = in_graph_rewiring
+        self.rewiring_noise_coeff = rewiring_noise_coeff
+        if kernel_format not in Sparse.KERNEL_FORMATS:
+            raise ValueError("Unknown kernel format {}, expected one of "
+                             "{}".format(kernel_format, Sparse.KERNEL_FORMATS))
+        if kernel_format == 'coo' and (connectivity_decay or
+                                       in_graph_rewiring or cache_kernel):
+            raise ValueError("Connectivity decay, in-graph rewiring and "
+                             "kernel caching require the dense kernel format")
+        self.kernel_format = kernel_format
+        self.sparse_gradient = sparse_gradient
+        self.mask_dtype = mask_dtype or K.floatx()
+        self.cache_kernel = cache_kernel
 
     def build(self, input_shape):
         # Create a trainable weight variable for this layer.
@@ -44,6 +187,9 @@ class Sparse(Layer):
         input_dim = input_shape[-1]
 
         self.kernel_shape = (input_dim, self.units)
+        if self.kernel_format == 'coo':
+            self._build_coo(input_shape)
+            return
         self.kernel = self.add_weight(name='kernel',
                                       shape=self.kernel_shape,
                                       initializer=self.kernel_initializer,
@@ -70,11 +216,13 @@ class Sparse(Layer):
         _pre_mask[:number_of_active_synapses] = 1
 
         np.random.shuffle(_pre_mask)
-        _pre_mask = _pre_mask.astype(bool).reshape(self.kernel_shape).astype(float)
+        _pre_mask = _pre_mask.astype(bool).reshape(self.kernel_shape).astype(
+            self.mask_dtype)
         # set this as the mask
         self.mask = self.add_weight(shape=_pre_mask.shape,
                                     initializer=initializers.constant(_pre_mask),
                                     name='mask',
+                                    dtype=self.mask_dtype,
                                     trainable=False)
         # self.mask = K.variable(_pre_mask,
         #                        dtype=tf.bool,
@@ -89,17 +237,68 @@ class Sparse(Layer):
         self.original_kernel = self.kernel
 
         # apply mask
-        self.kernel = self.kernel * self.mask
+        if self.cache_kernel:
+            self.kernel = add_kernel_cache(self, self.kernel, self.mask)
+        else:
+            self.kernel = apply_mask(self.kernel, self.mask, self)
         # self.kernel = tf.boolean_mask(self.kernel, self.mask)
 
         if self.connectivity_level:
             self.add_update(updates=K.update(self.original_kernel, self.kernel))
 
+        if self.in_graph_rewiring:
+            add_in_graph_rewiring(self, self.original_kernel, self.mask)
+
+        if self.sparse_gradient:
+            self.add_dormant_gradient_rate()
+
         # self.add_update(updates=K.update(self.sign, K.sign(self.original_kernel)))
         self.input_spec = InputSpec(min_ndim=2, axes={-1: input_dim})
         # Be sure to call this at the end
         super(Sparse, self).build(input_shape)
 
+    def _build_coo(self, input_shape):
+        input_dim = input_shape[-1]
+        number_of_active_synapses = self.get_number_of_active_connections()
+        # the same distribution of active connections as the dense mask, in
+        # row-major order
+        active = np.sort(np.random.choice(
+            np.prod(self.kernel_shape), number_of_active_synapses,
+            replace=False))
+        indices = np.stack(np.unravel_index(active, self.kernel_shape),
+                           axis=1).astype(np.int64)
+
+        def initialise_values(shape, dtype=None):
+            # the values of the active entries of a kernel initialised as
+            # in the dense format, so that the initial scale is the same
+            return tf.gather_nd(
+                self.kernel_initializer(self.kernel_shape, dtype=dtype),
+                indices)
+
+        self.kernel_values = self.add_weight(
+            name='kernel_values',
+            shape=(number_of_active_synapses,),
+            initializer=initialise_values,
+            trainable=True,
+            regularizer=self.kernel_regularizer,
+            constraint=self.kernel_constraint)
+        if self.use_bias:
+            self.bias = self.add_weight(shape=(self.units,),
+                                        initializer=self.bias_initializer,
+                                        name='bias',
+                                        regularizer=self.bias_regularizer,
+                                        constraint=self.bias_constraint)
+        else:
+            self.bias = None
+        self.kernel_indices = self.add_weight(
+            shape=indices.shape,
+            initializer=initializers.constant(indices),
+            name='kernel_indices',
+            dtype='int64',
+            trainable=False)
+        self.input_spec = InputSpec(min_ndim=2, axes={-1: input_dim})
+        super(Sparse, self).build(input_shape)
+
     def add_update(self, updates, inputs=None):
         super(Sparse, self).add_update(updates, inputs)
 
@@ -108,12 +307,85 @@ class Sparse(Layer):
         return int((self.connectivity_level or 1) *
                    total_number_of_matrix_entries)
 
+    def add_dormant_gradient_rate(self):
+        # proportion of the kernel entries whose gradient is computed on
+        # top of the active ones, set by a regrowth policy which needs it
+        self.dormant_gradient_rate = K.variable(
+            0., name=self.name + '_dormant_gradient_rate')
+
+    def invalidate_kernel_cache(self):
+        if getattr(self, "kernel_cache_valid", None) is not None:
+            K.set_value(self.kernel_cache_valid, False)
+
+    def set_weights(self, weights):
+        super(Sparse, self).set_weights(weights)
+        self.invalidate_kernel_cache()
+
+    def get_dense_kernel_and_mask(self):
+        """Current (unmasked) kernel and mask, as NumPy arrays.
+
+        In the 'coo' format, the kernel is 0 outside the active connections.
+        """
+        if self.kernel_format == 'dense':
+            return tuple(K.batch_get_value([self.original_kernel, self.mask]))
+        values, indices = K.batch_get_value([self.kernel_values,
+                                             self.kernel_indices])
+        kernel = np.zeros(self.kernel_shape, dtype=values.dtype)
+        mask = np.zeros(self.kernel_shape, dtype=self.mask_dtype)
+        kernel[indices[:, 0], indices[:, 1]] = values
+        mask[indices[:, 0], indices[:, 1]] = 1
+        return kernel, mask
+
+    def set_dense_kernel_and_mask(self, kernel, mask):
+        """Load a kernel and mask (e.g. from a layer in the dense format).
+
+        In the 'coo' format, the mask has to have exactly as many active
+        connections as the layer.
+        """
+        if self.kernel_format == 'dense':
+            K.batch_set_value([(self.original_kernel, kernel),
+                               (self.mask, mask)])
+            self.invalidate_kernel_cache()
+            return
+        active = np.flatnonzero(mask)
+        if active.size != K.int_shape(self.kernel_values)[0]:
+            raise ValueError(
+                "Layer {} has {} active connections, the mask has {}".format(
+                    self.name, K.int_shape(self.kernel_values)[0],
+                    active.size))
+        indices = np.stack(np.unravel_index(active, self.kernel_shape),
+                           axis=1)
+        K.batch_set_value([(self.kernel_values, np.ravel(kernel)[active]),
+                           (self.kernel_indices, indices)])
+
+    def _coo_dot(self, inputs):
+        kernel = tf.SparseTensor(self.kernel_indices, self.kernel_values,
+                                 dense_shape=self.kernel_shape)
+        # inputs . kernel == (kernel^T . inputs^T)^T, with any leading
+        # dimensions of the inputs flattened into the batch
+        flat_inputs = K.reshape(inputs, (-1, self.kernel_shape[0]))
+        output = K.transpose(tf.sparse.sparse_dense_matmul(
+            kernel, flat_inputs, adjoint_a=True, adjoint_b=True))
+        if K.ndim(inputs) == 2:
+            return output
+        return K.reshape(output, tf.concat(
+            [tf.shape(inputs)[:-1], [self.units]], axis=0))
+
     def call(self, inputs, **kwargs):
-        output = K.dot(inputs, self.kernel)
+        if self.kernel_format == 'coo':
+            output = self._coo_dot(inputs)
+        elif self.sparse_gradient:
+            output = masked_matmul(inputs, self.kernel, self.mask,
+                                   self.dormant_gradient_rate)
+        else:
+            output = K.dot(inputs, self.kernel)
         if self.use_bias:
             output = K.bias_add(output, self.bias, data_format='channels_last')
         if self.activation is not None:
             output = self.activation(output)
+        if self.cache_kernel:
+            # the kernel depends on the learning phase
+            output._uses_learning_phase = True
 
         return output
 
@@ -139,6 +411,12 @@ class Sparse(Layer):
             'bias_constraint': constraints.serialize(self.bias_constraint),
             'connectivity_level': self.connectivity_level,
             'connectivity_decay': self.connectivity_decay,
+            'in_graph_rewiring': self.in_graph_rewiring,
+            'rewiring_noise_coeff': self.rewiring_noise_coeff,
+            'kernel_format': self.kernel_format,
+            'sparse_gradient': self.sparse_gradient,
+            'mask_dtype': self.mask_dtype,
+            'cache_kernel': self.cache_kernel,
         }
 
         base_config = super(Sparse, self).get_config()
@@ -209,6 +487,11 @@ class _SparseConv(Layer):
                  kernel_size,
                  connectivity_level=None,
                  connectivity_decay=None,
+                 in_graph_rewiring=False,
+                 rewiring_noise_coeff=10 ** -6,
+                 sparse_gradient=False,
+                 mask_dtype=None,
+                 cache_kernel=False,
                  strides=1,
                  padding='valid',
                  data_format=None,
@@ -230,11 +513,20 @@ class _SparseConv(Layer):
                                                       'kernel_size')
         self.connectivity_level = connectivity_level
         self.connectivity_decay = connectivity_decay
+        self.in_graph_rewiring = in_graph_rewiring
+        self.rewiring_noise_coeff = rewiring_noise_coeff
+        self.sparse_gradient = sparse_gradient
+        self.mask_dtype = mask_dtype or K.floatx()
+        self.cache_kernel = cache_kernel
         self.strides = conv_utils.normalize_tuple(strides, rank, 'strides')
         self.padding = conv_utils.normalize_padding(padding)
         self.data_format = K.normalize_data_format(data_format)
         self.dilation_rate = conv_utils.normalize_tuple(dilation_rate, rank,
                                                         'dilation_rate')
+        if self.sparse_gradient and (
+                rank != 2 or self.data_format == 'channels_first'):
+            raise ValueError("Sparse gradients are only supported by "
+                             "channels last 2D convolutions")
         self.activation = activations.get(activation)
         self.use_bias = use_bias
         self.kernel_initializer = initializers.get(kernel_initializer)
@@ -275,20 +567,31 @@ class _SparseConv(Layer):
         _pre_mask[:number_of_active_synapses] = 1
 
         np.random.shuffle(_pre_mask)
-        _pre_mask = _pre_mask.astype(bool).reshape(self.kernel_shape).astype(float)
+        _pre_mask = _pre_mask.astype(bool).reshape(self.kernel_shape).astype(
+            self.mask_dtype)
         # set this as the mask
         # K.set_value(self.mask, _pre_mask)
         # self.mask = K.variable(_pre_mask, name="mask")
         self.mask = self.add_weight(shape=_pre_mask.shape,
                                     initializer=initializers.constant(_pre_mask),
                                     name='mask',
+                                    dtype=self.mask_dtype,
                                     trainable=False)
 
         # apply mask
-        self.kernel = self.kernel * self.mask
+        if self.cache_kernel:
+            self.kernel = add_kernel_cache(self, self.kernel, self.mask)
+        else:
+            self.kernel = apply_mask(self.kernel, self.mask, self)
         if self.connectivity_level:
             self.add_update(updates=K.update(self.original_kernel, self.kernel))
 
+        if self.in_graph_rewiring:
+            add_in_graph_rewiring(self, self.original_kernel, self.mask)
+
+        if self.sparse_gradient:
+            self.add_dormant_gradient_rate()
+
         if self.use_bias:
             self.bias = self.add_weight(shape=(self.filters,),
                                         initializer=self.bias_initializer,
@@ -312,6 +615,18 @@ class _SparseConv(Layer):
         return int((self.connectivity_level or 1) *
                    total_number_of_matrix_entries)
 
+    def add_dormant_gradient_rate(self):
+        self.dormant_gradient_rate = K.variable(
+            0., name=self.name + '_dormant_gradient_rate')
+
+    def invalidate_kernel_cache(self):
+        if getattr(self, "kernel_cache_valid", None) is not None:
+            K.set_value(self.kernel_cache_valid, False)
+
+    def set_weights(self, weights):
+        super(_SparseConv, self).set_weights(weights)
+        self.invalidate_kernel_cache()
+
     def call(self, inputs):
         if self.rank == 1:
             outputs = K.conv1d(
@@ -321,7 +636,12 @@ class _SparseConv(Layer):
                 padding=self.padding,
                 data_format=self.data_format,
                 dilation_rate=self.dilation_rate[0])
-        if self.rank == 2:
+        if self.rank == 2 and self.sparse_gradient:
+            outputs = masked_conv2d(inputs, self.kernel, self.mask,
+                                    self.strides, self.padding,
+                                    self.dilation_rate,
+                                    self.dormant_gradient_rate)
+        elif self.rank == 2:
             outputs = K.conv2d(
                 inputs,
                 self.kernel,
@@ -345,7 +665,10 @@ class _SparseConv(Layer):
                 data_format=self.data_format)
 
         if self.activation is not None:
-            return self.activation(outputs)
+            outputs = self.activation(outputs)
+        if self.cache_kernel:
+            # the kernel depends on the learning phase
+            outputs._uses_learning_phase = True
         return outputs
 
     def compute_output_shape(self, input_shape):
@@ -395,6 +718,11 @@ class _SparseConv(Layer):
             'bias_constraint': constraints.serialize(self.bias_constraint),
             'connectivity_level': self.connectivity_level,
             'connectivity_decay': self.connectivity_decay,
+            'in_graph_rewiring': self.in_graph_rewiring,
+            'rewiring_noise_coeff': self.rewiring_noise_coeff,
+            'sparse_gradient': self.sparse_gradient,
+            'mask_dtype': self.mask_dtype,
+            'cache_kernel': self.cache_kernel,
         }
         base_config = super(_SparseConv, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -462,6 +790,11 @@ class SparseConv2D(_SparseConv):
                  kernel_size,
                  connectivity_level=None,
                  connectivity_decay=None,
+                 in_graph_rewiring=False,
+                 rewiring_noise_coeff=10 ** -6,
+                 sparse_gradient=False,
+                 mask_dtype=None,
+                 cache_kernel=False,
                  strides=1,
                  padding='valid',
                  data_format=None,
@@ -481,6 +814,11 @@ class SparseConv2D(_SparseConv):
                                            kernel_size=kernel_size,
                                            connectivity_level=connectivity_level,
                                            connectivity_decay=connectivity_decay,
+                                           in_graph_rewiring=in_graph_rewiring,
+                                           rewiring_noise_coeff=rewiring_noise_coeff,
+                                           sparse_gradient=sparse_gradient,
+                                           mask_dtype=mask_dtype,
+                                           cache_kernel=cache_kernel,
                                            strides=strides,
                                            padding=padding,
                                            data_format=data_format,
@@ -607,6 +945,9 @@ class SparseDepthwiseConv2D(SparseConv2D):
             activity_regularizer=activity_regularizer,
             bias_constraint=bias_constraint,
             **kwargs)
+        if self.sparse_gradient:
+            raise ValueError("Sparse gradients are not supported by "
+                             "SparseDepthwiseConv2D")
         self.depth_multiplier = depth_multiplier
         self.depthwise_initializer = initializers.get(depthwise_initializer)
         self.depthwise_regularizer = regularizers.get(depthwise_regularizer)
@@ -659,21 +1000,31 @@ class SparseDepthwiseConv2D(SparseConv2D):
         _pre_mask[:number_of_active_synapses] = 1
 
         np.random.shuffle(_pre_mask)
-        _pre_mask = _pre_mask.astype(bool).reshape(self.kernel_shape).astype(float)
+        _pre_mask = _pre_mask.astype(bool).reshape(self.kernel_shape).astype(
+            self.mask_dtype)
         # set this as the mask
         # K.set_value(self.mask, _pre_mask)
         # self.mask = K.variable(_pre_mask, name="mask")
         self.mask = self.add_weight(shape=_pre_mask.shape,
                                     initializer=initializers.constant(_pre_mask),
                                     name='mask',
+                                    dtype=self.mask_dtype,
                                     trainable=False)
 
         # apply mask
-        self.depthwise_kernel = self.depthwise_kernel * self.mask
+        if self.cache_kernel:
+            self.depthwise_kernel = add_kernel_cache(
+                self, self.depthwise_kernel, self.mask)
+        else:
+            self.depthwise_kernel = apply_mask(self.depthwise_kernel,
+                                               self.mask, self)
         if self.connectivity_level:
             # if target-based rewiring enabled
             self.add_update(updates=K.update(self.original_kernel, self.depthwise_kernel))
 
+        if self.in_graph_rewiring:
+            add_in_graph_rewiring(self, self.original_kernel, self.mask)
+
         # Set input spec.
         self.input_spec = InputSpec(ndim=4, axes={channel_axis: input_dim})
         super(_SparseConv, self).build(input_shape)
@@ -694,7 +1045,10 @@ class SparseDepthwiseConv2D(SparseConv2D):
                 data_format=self.data_format)
 
         if self.activation is not None:
-            return self.activation(outputs)
+            outputs = self.activation(outputs)
+        if self.cache_kernel:
+            # the kernel depends on the learning phase
+            outputs._uses_learning_phase = True
 
         return outputs
 
@@ -0,0 +1,218 @@
+import json
+import queue
+import threading
+import h5py
+import numpy as np
+import keras
+from keras import backend as K
+from keras.callbacks import CSVLogger, ModelCheckpoint
+
+
+class BackgroundWriter(object):
+    """Serialise snapshots to disk on a background thread.
+
+    The training thread takes snapshots (copies of weights, masks or logs)
+    and submits the functions writing them, which run in order on a single
+    thread. At most `max_pending` writes can be waiting, submitting more
+    blocks the training thread until the writer catches up. An exception
+    raised by a write is re-raised on the training thread by the next call
+    to `submit` or `flush`.
+    """
+
+    def __init__(self, max_pending=2):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                function, args = job
+                function(*args)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, function, *args):
+        """Call `function(*args)` on the background thread."""
+        self._raise_error()
+        self._queue.put((function, args))
+
+    def flush(self):
+        """Wait for every submitted write to complete."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+
+class BackgroundCSVLogger(CSVLogger):
+    """`CSVLogger` writing its rows on a `BackgroundWriter`."""
+
+    def __init__(self, filename, background_writer, separator=',',
+                 append=False):
+        super(BackgroundCSVLogger, self).__init__(filename,
+                                                  separator=separator,
+                                                  append=append)
+        self.background_writer = background_writer
+
+    def on_epoch_end(self, epoch, logs=None):
+        # the logs are updated in place by the following epochs
+        self.background_writer.submit(
+            super(BackgroundCSVLogger, self).on_epoch_end,
+            epoch, dict(logs or {}))
+
+    def on_train_end(self, logs=None):
+        self.background_writer.flush()
+        super(BackgroundCSVLogger, self).on_train_end(logs)
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if hasattr(obj, 'get_config'):
+        return {'class_name': obj.__class__.__name__,
+                'config': obj.get_config()}
+    if callable(obj):
+        return obj.__name__
+    raise TypeError("{} is not JSON serialisable".format(type(obj)))
+
+
+def _unique_names(weights):
+    names = []
+    for i, w in enumerate(weights):
+        name = str(getattr(w, 'name', None) or 'param_{}'.format(i))
+        if name in names:
+            name += '_{}'.format(i)
+        names.append(name)
+    return names
+
+
+def snapshot_model(model, include_optimizer=True):
+    """Copy what `model.save` (or `model.save_weights`, if
+    `include_optimizer` is False) writes, so that `write_model_snapshot`
+    can serialise it while training continues.
+
+    The weights are read from the device in a single call.
+    """
+    layers = [(l.name, l.trainable_weights + l.non_trainable_weights)
+              for l in model.layers]
+    optimizer_weights = []
+    if include_optimizer and model.optimizer is not None:
+        optimizer_weights = getattr(model.optimizer, 'weights', [])
+    values = K.batch_get_value(
+        [w for _, weights in layers for w in weights] + optimizer_weights)
+    snapshot = {'layers': [], 'model_config': None,
+                'training_config': None, 'optimizer_weights': None}
+    position = 0
+    for name, weights in layers:
+        snapshot['layers'].append(
+            (name, _unique_names(weights),
+             values[position:position + len(weights)]))
+        position += len(weights)
+    if include_optimizer:
+        snapshot['model_config'] = json.dumps(
+            {'class_name': model.__class__.__name__,
+             'config': model.get_config()}, default=_json_default)
+        if model.optimizer is not None:
+            snapshot['training_config'] = json.dumps(
+                {'optimizer_config': {
+                    'class_name': model.optimizer.__class__.__name__,
+                    'config': model.optimizer.get_config()},
+                 'loss': model.loss,
+                 'metrics': model._compile_metrics,
+                 'weighted_metrics': model._compile_weighted_metrics,
+                 'sample_weight_mode': model.sample_weight_mode,
+                 'loss_weights': model.loss_weights},
+                default=_json_default)
+            snapshot['optimizer_weights'] = (
+                _unique_names(optimizer_weights), values[position:])
+    return snapshot
+
+
+def _write_weights(group, names, values):
+    group.attrs['weight_names'] = [n.encode('utf8') for n in names]
+    for name, value in zip(names, values):
+        group.create_dataset(name, data=value)
+
+
+def write_model_snapshot(filepath, snapshot):
+    """Write the result of `snapshot_model` in the layout of `model.save`
+    (or `model.save_weights`), to be read back with `load_model` (or
+    `model.load_weights`)."""
+    with h5py.File(filepath, mode='w') as f:
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+        f.attrs['backend'] = K.backend().encode('utf8')
+        if snapshot['model_config'] is None:
+            weights_group = f
+        else:
+            f.attrs['model_config'] = snapshot['model_config'].encode('utf8')
+            weights_group = f.create_group('model_weights')
+            weights_group.attrs['keras_version'] = \
+                str(keras.__version__).encode('utf8')
+            weights_group.attrs['backend'] = K.backend().encode('utf8')
+        weights_group.attrs['layer_names'] = \
+            [name.encode('utf8') for name, _, _ in snapshot['layers']]
+        for name, weight_names, values in snapshot['layers']:
+            _write_weights(weights_group.create_group(name),
+                           weight_names, values)
+        if snapshot['training_config'] is not None:
+            f.attrs['training_config'] = \
+                snapshot['training_config'].encode('utf8')
+        if snapshot['optimizer_weights'] is not None:
+            _write_weights(f.create_group('optimizer_weights'),
+                           *snapshot['optimizer_weights'])
+
+
+def save_model_in_background(model, filepath, background_writer,
+                             include_optimizer=True):
+    """`model.save` writing the file on a `BackgroundWriter`."""
+    background_writer.submit(write_model_snapshot, filepath,
+                             snapshot_model(model, include_optimizer))
+
+
+class BackgroundModelCheckpoint(ModelCheckpoint):
+    """`ModelCheckpoint` writing its files on a `BackgroundWriter`.
+
+    Only a snapshot of the weights is taken on the training thread.
+    """
+
+    def __init__(self, filepath, background_writer, **kwargs):
+        super(BackgroundModelCheckpoint, self).__init__(filepath, **kwargs)
+        self.background_writer = background_writer
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        self.epochs_since_last_save += 1
+        if self.epochs_since_last_save < self.period:
+            return
+        self.epochs_since_last_save = 0
+        filepath = self.filepath.format(epoch=epoch + 1, **logs)
+        if self.save_best_only:
+            current = logs.get(self.monitor)
+            if current is None or not self.monitor_op(current, self.best):
+                return
+            self.best = current
+        if self.verbose > 0:
+            print('\nEpoch %05d: saving model to %s' % (epoch + 1, filepath))
+        save_model_in_background(self.model, filepath,
+                                 self.background_writer,
+                                 include_optimizer=not self.save_weights_only)
+
+    def on_train_end(self, logs=None):
+        self.background_writer.flush()
@@ -0,0 +1,471 @@
+import json
+import os
+import h5py
+import numpy as np
+from keras import backend as K
+from keras_rewiring.utilities.sign_bitmap import SignBitmap
+from keras_rewiring.sparse_layer import invalidate_kernel_caches
+
+FORMAT_NAME = 'keras_rewiring_compact_checkpoint'
+DELTA_FORMAT_NAME = 'keras_rewiring_delta_checkpoint'
+FORMAT_VERSION = 1
+# arrays stored for every sparse kernel (deltas store the changed indices
+# of the mask rather than the mask itself)
+SPARSE_ARRAYS = ('mask_bits', 'changed_indices', 'values', 'extra_indices',
+                 'extra_values')
+# those of them which are compressed (kernel values hardly compress)
+INDEX_ARRAYS = ('mask_bits', 'changed_indices', 'extra_indices')
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError("{} is not JSON serialisable".format(type(obj)))
+
+
+def _index_dtype(size):
+    return np.int32 if size < 2 ** 31 else np.int64
+
+
+def encode_sparse_kernel(kernel, mask):
+    """Compact encoding of a kernel and its (binary) mask.
+
+    The mask is stored as a bitset and the kernel as the values of the active
+    entries, in the order of the set bits. Inactive entries are generally 0,
+    the few which are not (e.g. connections dropped since the last batch or
+    dormant connections in soft rewiring) are stored with their indices.
+    """
+    flat_kernel = np.ravel(kernel)
+    active = np.ravel(mask) != 0
+    extra_indices = np.flatnonzero(~active & (flat_kernel != 0))
+    return {'mask_bits': np.packbits(active),
+            'values': flat_kernel[active],
+            'extra_indices': extra_indices.astype(
+                _index_dtype(flat_kernel.size)),
+            'extra_values': flat_kernel[extra_indices]}
+
+
+def decode_sparse_kernel(encoded, shape, kernel_dtype, mask_dtype):
+    """Inverse of `encode_sparse_kernel`.
+
+    :return: kernel and mask
+    :rtype: tuple
+    """
+    size = int(np.prod(shape))
+    active = np.unpackbits(encoded['mask_bits'], count=size).astype(bool)
+    kernel = np.zeros(size, dtype=kernel_dtype)
+    kernel[active] = encoded['values']
+    kernel[encoded['extra_indices']] = encoded['extra_values']
+    return kernel.reshape(shape), active.astype(mask_dtype).reshape(shape)
+
+
+def snapshot_model_state(model, epoch, rewiring_callback=None):
+    """Copy of everything needed to resume training, as NumPy arrays.
+
+    This has to run on the training thread, but the snapshot can then be
+    written by `write_compact_checkpoint` from any thread.
+
+    :param epoch: number of epochs completed
+    :type epoch: int
+    :param rewiring_callback: if provided, its statistics and host-side
+        state (including the RNG state of every layer) are included
+    :type rewiring_callback: keras_rewiring.rewiring_callback.RewiringCallback
+    :return: snapshot of the state of the model
+    :rtype: dict
+    """
+    layers = [l for l in model.layers if l.weights]
+    # retrieve all weights in a single call to the backend
+    values = K.batch_get_value([w for l in layers for w in l.weights])
+    layer_snapshots = []
+    position = 0
+    for l in layers:
+        weights = values[position:position + len(l.weights)]
+        position += len(l.weights)
+        layer_snapshot = {'name': l.name, 'weights': weights}
+        if hasattr(l, "mask"):
+            kernel_index = [w is l.original_kernel
+                            for w in l.weights].index(True)
+            mask_index = [w is l.mask for w in l.weights].index(True)
+            kernel, mask = weights[kernel_index], weights[mask_index]
+            layer_snapshot['sparse'] = dict(
+                encode_sparse_kernel(kernel, mask),
+                kernel_index=kernel_index, mask_index=mask_index,
+                shape=kernel.shape,
+                kernel_dtype=kernel.dtype.str, mask_dtype=mask.dtype.str)
+            layer_snapshot['weights'] = [
+                None if i in (kernel_index, mask_index) else w
+                for i, w in enumerate(weights)]
+            layer_snapshot['connectivity_level'] = l.connectivity_level
+            if getattr(l, "in_graph_rewiring", False):
+                layer_snapshot['kernel_sign'] = \
+                    K.get_value(l.kernel_sign).astype(np.int8)
+        layer_snapshots.append(layer_snapshot)
+
+    optimizer_weights = []
+    if getattr(model, "optimizer", None) is not None:
+        optimizer_weights = K.batch_get_value(model.optimizer.weights)
+
+    snapshot = {'epoch': epoch,
+                'layers': layer_snapshots,
+                'optimizer_weights': optimizer_weights,
+                'numpy_random_state': np.random.get_state(),
+                'callback_state': None}
+    if rewiring_callback is not None:
+        snapshot['callback_state'] = rewiring_callback.get_state()
+    return snapshot
+
+
+def _write_arrays(group, arrays, compression=None):
+    for name, value in arrays.items():
+        if value is not None:
+            group.create_dataset(name, data=value, compression=compression)
+
+
+def write_snapshot(group, snapshot):
+    """Write a snapshot produced by `snapshot_model_state` (or a delta
+    produced by `snapshot_delta`) to an HDF5 group."""
+    group.attrs['epoch'] = snapshot['epoch']
+    layers_group = group.create_group('layers')
+    layers_group.attrs['names'] = json.dumps(
+        [l['name'] for l in snapshot['layers']])
+    for l in snapshot['layers']:
+        g = layers_group.create_group(l['name'])
+        g.attrs['no_weights'] = len(l['weights'])
+        _write_arrays(g, {'weight_{}'.format(i): w
+                          for i, w in enumerate(l['weights'])})
+        if 'sparse' in l:
+            sparse = l['sparse']
+            sg = g.create_group('sparse')
+            _write_arrays(sg, {k: sparse[k] for k in SPARSE_ARRAYS
+                               if k in sparse and k in INDEX_ARRAYS},
+                          compression='gzip')
+            _write_arrays(sg, {k: sparse[k] for k in SPARSE_ARRAYS
+                               if k in sparse and k not in INDEX_ARRAYS})
+            for k in ('kernel_index', 'mask_index', 'kernel_dtype',
+                      'mask_dtype'):
+                sg.attrs[k] = sparse[k]
+            sg.attrs['shape'] = np.asarray(sparse['shape'], dtype=np.int64)
+            g.attrs['connectivity_level'] = json.dumps(
+                l['connectivity_level'], default=_json_default)
+        if 'kernel_sign' in l:
+            g.create_dataset('kernel_sign', data=l['kernel_sign'],
+                             compression='gzip')
+
+    og = group.create_group('optimizer')
+    og.attrs['no_weights'] = len(snapshot['optimizer_weights'])
+    _write_arrays(og, {'weight_{}'.format(i): w for i, w in
+                       enumerate(snapshot['optimizer_weights'])})
+
+    # (name, keys, position, has_gauss, cached_gaussian)
+    random_state = snapshot['numpy_random_state']
+    rg = group.create_group('numpy_random_state')
+    rg.create_dataset('keys', data=random_state[1])
+    rg.attrs['state'] = json.dumps(
+        [random_state[0]] + list(random_state[2:]),
+        default=_json_default)
+
+    callback_state = snapshot['callback_state']
+    if callback_state is not None:
+        cg = group.create_group('callback')
+        cg.attrs['statistics'] = json.dumps(
+            {'epoch_data': callback_state['epoch_data'],
+             'batch_data': callback_state['batch_data']},
+            default=_json_default)
+        for name, s in callback_state['layers'].items():
+            lg = cg.create_group(name)
+            lg.attrs['state'] = json.dumps(
+                {k: v for k, v in s.items()
+                 if not isinstance(v, np.ndarray)},
+                default=_json_default)
+            # e.g. the scores of a regrowth policy, which are dense
+            _write_arrays(lg, {k: v for k, v in s.items()
+                               if isinstance(v, np.ndarray)},
+                          compression='gzip')
+
+
+def read_snapshot(group):
+    """Inverse of `write_snapshot`."""
+    layers = []
+    for name in json.loads(group['layers'].attrs['names']):
+        g = group['layers'][name]
+        weights = [g['weight_{}'.format(i)][()]
+                   if 'weight_{}'.format(i) in g else None
+                   for i in range(g.attrs['no_weights'])]
+        l = {'name': name, 'weights': weights}
+        if 'sparse' in g:
+            sg = g['sparse']
+            l['sparse'] = {k: sg[k][()] for k in sg.keys()}
+            l['sparse'].update({k: sg.attrs[k] for k in sg.attrs.keys()})
+            l['sparse']['shape'] = tuple(int(d) for d in
+                                         sg.attrs['shape'])
+            l['connectivity_level'] = json.loads(
+                g.attrs['connectivity_level'])
+        if 'kernel_sign' in g:
+            l['kernel_sign'] = g['kernel_sign'][()]
+        layers.append(l)
+
+    og = group['optimizer']
+    optimizer_weights = [og['weight_{}'.format(i)][()]
+                         for i in range(og.attrs['no_weights'])]
+
+    rg = group['numpy_random_state']
+    state = json.loads(rg.attrs['state'])
+    numpy_random_state = (state[0], rg['keys'][()]) + tuple(state[1:])
+
+    callback_state = None
+    if 'callback' in group:
+        cg = group['callback']
+        callback_state = json.loads(cg.attrs['statistics'])
+        callback_state['layers'] = {}
+        for name in cg.keys():
+            lg = cg[name]
+            s = json.loads(lg.attrs['state'])
+            s.update({k: lg[k][()] for k in lg.keys()})
+            callback_state['layers'][name] = s
+
+    return {'epoch': int(group.attrs['epoch']),
+            'layers': layers,
+            'optimizer_weights': optimizer_weights,
+            'numpy_random_state': numpy_random_state,
+            'callback_state': callback_state}
+
+
+def _check_format(f, filename, formats):
+    if f.attrs.get('format') not in formats:
+        raise ValueError("{} is not a compact checkpoint".format(filename))
+    return f.attrs['format']
+
+
+def write_compact_checkpoint(filename, snapshot):
+    """Write a snapshot produced by `snapshot_model_state` to an HDF5 file."""
+    with h5py.File(filename, 'w') as f:
+        f.attrs['format'] = FORMAT_NAME
+        f.attrs['version'] = FORMAT_VERSION
+        write_snapshot(f, snapshot)
+
+
+def read_compact_checkpoint(filename):
+    """Read a file written by `write_compact_checkpoint` into a snapshot."""
+    with h5py.File(filename, 'r') as f:
+        _check_format(f, filename, (FORMAT_NAME,))
+        return read_snapshot(f)
+
+
+def snapshot_delta(snapshot, previous_mask_bits, include_optimizer=False):
+    """Delta of a snapshot with respect to the masks of a previous one.
+
+    Masks are replaced by the indices of the entries which changed, the
+    other arrays (e.g. active kernel values) are kept as they are. Unless
+    `include_optimizer` is set, the state only needed to resume training
+    exactly (optimizer weights, host-side rewiring state of the layers and
+    in-graph kernel signs) is dropped, and only the rewiring statistics of
+    the callback are kept.
+
+    :param previous_mask_bits: packed mask of every sparse layer, by name
+    :type previous_mask_bits: dict
+    :param include_optimizer: keep the state needed to resume training
+        exactly from the epoch of this snapshot
+    :type include_optimizer: bool
+    :return: the delta and the packed masks of `snapshot`
+    :rtype: tuple
+    """
+    layers = []
+    mask_bits = {}
+    for l in snapshot['layers']:
+        if 'sparse' in l:
+            sparse = dict(l['sparse'])
+            mask_bits[l['name']] = sparse.pop('mask_bits')
+            changed = SignBitmap.unpack_indices(np.bitwise_xor(
+                previous_mask_bits[l['name']], mask_bits[l['name']]))
+            sparse['changed_indices'] = changed.astype(
+                _index_dtype(np.prod(sparse['shape'])))
+            l = dict(l, sparse=sparse)
+        if not include_optimizer:
+            l = {k: v for k, v in l.items() if k != 'kernel_sign'}
+        layers.append(l)
+    delta = dict(snapshot, layers=layers)
+    if not include_optimizer:
+        delta['optimizer_weights'] = []
+        if delta['callback_state'] is not None:
+            delta['callback_state'] = dict(delta['callback_state'],
+                                           layers={})
+    return delta, mask_bits
+
+
+def apply_snapshot_delta(snapshot, delta):
+    """Snapshot obtained by applying a delta from `snapshot_delta`."""
+    previous_layers = {l['name']: l for l in snapshot['layers']}
+    layers = []
+    for l in delta['layers']:
+        if 'sparse' in l:
+            sparse = dict(l['sparse'])
+            size = int(np.prod(sparse['shape']))
+            active = np.unpackbits(
+                previous_layers[l['name']]['sparse']['mask_bits'],
+                count=size).astype(bool)
+            active[sparse.pop('changed_indices')] ^= True
+            sparse['mask_bits'] = np.packbits(active)
+            l = dict(l, sparse=sparse)
+        layers.append(l)
+    return dict(delta, layers=layers)
+
+
+def _delta_group_name(epoch):
+    return 'epoch_{}'.format(epoch)
+
+
+def delta_checkpoint_epochs(filename):
+    """Epochs which can be reconstructed from a delta checkpoint file."""
+    with h5py.File(filename, 'r') as f:
+        _check_format(f, filename, (DELTA_FORMAT_NAME,))
+        return [int(f['base'].attrs['epoch'])] + \
+            sorted(int(name[len('epoch_'):]) for name in f.keys()
+                   if name.startswith('epoch_'))
+
+
+def read_delta_checkpoint(filename, epoch=None):
+    """Reconstruct the snapshot of a given epoch (by default the last one)
+    from a file written by `DeltaCheckpointWriter`."""
+    epochs = delta_checkpoint_epochs(filename)
+    epoch = epochs[-1] if epoch is None else epoch
+    if epoch not in epochs:
+        raise ValueError("Epoch {} is not in {} (available: {})".format(
+            epoch, filename, epochs))
+    with h5py.File(filename, 'r') as f:
+        snapshot = read_snapshot(f['base'])
+        for e in epochs[1:]:
+            if e > epoch:
+                break
+            snapshot = apply_snapshot_delta(
+                snapshot, read_snapshot(f[_delta_group_name(e)]))
+    return snapshot
+
+
+class DeltaCheckpointWriter(object):
+    """Incremental checkpoints of a training run, in a single HDF5 file.
+
+    The first snapshot written is stored in full, the following ones as
+    deltas (see `snapshot_delta`), so every epoch can be reconstructed with
+    `read_delta_checkpoint` at a fraction of the cost of full checkpoints.
+    Writing to an existing file continues its history from the last epoch
+    before the one written, e.g. when resuming.
+    """
+
+    def __init__(self, filename, include_optimizer=False):
+        self.filename = filename
+        self.include_optimizer = include_optimizer
+        self._mask_bits = None
+
+    @staticmethod
+    def _packed_masks(snapshot):
+        return {l['name']: l['sparse']['mask_bits']
+                for l in snapshot['layers'] if 'sparse' in l}
+
+    def write(self, snapshot):
+        stale_epochs = []
+        if self._mask_bits is None and os.path.exists(self.filename):
+            # continue from the last epoch before this one, the history
+            # after it (e.g. from before resuming) is discarded
+            epochs = delta_checkpoint_epochs(self.filename)
+            previous = [e for e in epochs if e < snapshot['epoch']]
+            if not previous:
+                raise ValueError(
+                    "{} has no epoch before epoch {}".format(
+                        self.filename, snapshot['epoch']))
+            self._mask_bits = self._packed_masks(
+                read_delta_checkpoint(self.filename, previous[-1]))
+            stale_epochs = [e for e in epochs if e > previous[-1]]
+        with h5py.File(self.filename, 'a') as f:
+            for e in stale_epochs:
+                del f[_delta_group_name(e)]
+            if self._mask_bits is None:
+                f.attrs['format'] = DELTA_FORMAT_NAME
+                f.attrs['version'] = FORMAT_VERSION
+                write_snapshot(f.create_group('base'), snapshot)
+                self._mask_bits = self._packed_masks(snapshot)
+                return
+            delta, self._mask_bits = snapshot_delta(
+                snapshot, self._mask_bits, self.include_optimizer)
+            write_snapshot(
+                f.create_group(_delta_group_name(snapshot['epoch'])), delta)
+
+
+def restore_model_state(model, snapshot, rewiring_callback=None):
+    """Load a snapshot into a model (built with the same architecture).
+
+    :return: number of epochs completed when the snapshot was taken, i.e.
+        the `initial_epoch` to resume training from
+    :rtype: int
+    """
+    weight_values = []
+    for l in snapshot['layers']:
+        layer = model.get_layer(l['name'])
+        weights = list(l['weights'])
+        if 'sparse' in l:
+            sparse = l['sparse']
+            kernel, mask = decode_sparse_kernel(
+                sparse, sparse['shape'],
+                np.dtype(sparse['kernel_dtype']),
+                np.dtype(sparse['mask_dtype']))
+            weights[sparse['kernel_index']] = kernel
+            weights[sparse['mask_index']] = mask
+            layer.connectivity_level = l['connectivity_level']
+        if 'kernel_sign' in l:
+            weight_values.append((layer.kernel_sign,
+                                  l['kernel_sign'].astype(K.floatx())))
+        weight_values.extend(zip(layer.weights, weights))
+
+    if snapshot['optimizer_weights']:
+        # the optimizer weights only exist once the train function is built
+        model._make_train_function()
+        weight_values.extend(zip(model.optimizer.weights,
+                                 snapshot['optimizer_weights']))
+    K.batch_set_value(weight_values)
+    invalidate_kernel_caches(model)
+
+    if rewiring_callback is not None and \
+            snapshot['callback_state'] is not None:
+        # the callback restores the global RNG once it has rebuilt the
+        # state of every layer (which draws from it)
+        rewiring_callback.set_state(snapshot['callback_state'],
+                                    snapshot['numpy_random_state'])
+    else:
+        np.random.set_state(snapshot['numpy_random_state'])
+    return snapshot['epoch']
+
+
+def read_compact_checkpoint_epoch(filename):
+    """Number of epochs completed when a compact checkpoint was saved (the
+    last epoch for delta checkpoints)."""
+    with h5py.File(filename, 'r') as f:
+        if _check_format(f, filename, (FORMAT_NAME, DELTA_FORMAT_NAME)) == \
+                FORMAT_NAME:
+            return int(f.attrs['epoch'])
+    return delta_checkpoint_epochs(filename)[-1]
+
+
+def save_compact_checkpoint(filename, model, epoch, rewiring_callback=None):
+    write_compact_checkpoint(
+        filename, snapshot_model_state(model, epoch, rewiring_callback))
+
+
+def load_compact_checkpoint(filename, model, rewiring_callback=None,
+                            epoch=None):
+    """Restore a model from a compact or delta checkpoint.
+
+    :param epoch: epoch to restore from a delta checkpoint (the last one
+        by default)
+    :type epoch: int
+    :return: number of epochs completed when the checkpoint was saved
+    :rtype: int
+    """
+    with h5py.File(filename, 'r') as f:
+        file_format = _check_format(f, filename,
+                                    (FORMAT_NAME, DELTA_FORMAT_NAME))
+    if file_format == FORMAT_NAME:
+        snapshot = read_compact_checkpoint(filename)
+    else:
+        snapshot = read_delta_checkpoint(filename, epoch)
+    return restore_model_state(model, snapshot, rewiring_callback)
@@ -0,0 +1,207 @@
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+import keras
+from keras.callbacks import Callback
+from keras_rewiring.sparse_layer import set_weights
+
+
+class Communicator(object):
+    """Collective operations between the replicas of a data-parallel run.
+
+    Rank 0 is the root: it decides the rewiring of every layer and its
+    decisions (and initial weights) are broadcast to the other replicas.
+    """
+
+    rank = 0
+    size = 1
+
+    @property
+    def is_root(self):
+        return self.rank == 0
+
+    def allreduce_mean(self, arrays):
+        """Element-wise mean of a list of arrays over all the replicas.
+
+        Every replica receives exactly the same result.
+        """
+        raise NotImplementedError
+
+    def broadcast(self, obj=None):
+        """Send a (picklable) object from rank 0 to every replica."""
+        raise NotImplementedError
+
+
+class LocalCommunicator(Communicator):
+    """Replicas running as processes on a single host.
+
+    Every replica is connected to rank 0 by a `multiprocessing` pipe and
+    rank 0 does the reductions, which makes this a stand-in for
+    `MPICommunicator` when mpi4py is not available.
+    """
+
+    def __init__(self, rank, size, connections):
+        """
+        :param connections: rank 0 holds a connection to every other rank
+            (in rank order), the other ranks a single connection to rank 0
+        :type connections: list
+        """
+        self.rank = rank
+        self.size = size
+        self.connections = connections
+
+    def allreduce_mean(self, arrays):
+        if self.size == 1:
+            return arrays
+        if not self.is_root:
+            self.connections[0].send(arrays)
+            return self.connections[0].recv()
+        # summing in rank order makes the result reproducible
+        total = [np.array(a, copy=True) for a in arrays]
+        for c in self.connections:
+            for t, a in zip(total, c.recv()):
+                t += a
+        for t in total:
+            t /= self.size
+        for c in self.connections:
+            c.send(total)
+        return total
+
+    def broadcast(self, obj=None):
+        if self.size == 1:
+            return obj
+        if not self.is_root:
+            return self.connections[0].recv()
+        for c in self.connections:
+            c.send(obj)
+        return obj
+
+
+class MPICommunicator(Communicator):
+    """Replicas running as MPI processes, possibly on several nodes.
+
+    Requires mpi4py, which is only imported when this class is used.
+    """
+
+    def __init__(self, comm=None):
+        from mpi4py import MPI
+        self._sum = MPI.SUM
+        self.comm = comm or MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+
+    def allreduce_mean(self, arrays):
+        if self.size == 1:
+            return arrays
+        # a single reduction for all the arrays
+        flat = np.concatenate([np.ravel(a) for a in arrays])
+        total = np.empty_like(flat)
+        self.comm.Allreduce(flat, total, op=self._sum)
+        total /= self.size
+        splits = np.cumsum([np.size(a) for a in arrays])[:-1]
+        return [t.reshape(np.shape(a))
+                for t, a in zip(np.split(total, splits), arrays)]
+
+    def broadcast(self, obj=None):
+        return self.comm.bcast(obj, root=0)
+
+
+def allreduce_gradients(grads, communicator):
+    """Average gradient tensors over the replicas.
+
+    The reduction of all the gradients happens in a single `py_func`, i.e. a
+    single message per replica per training step.
+    """
+    if communicator.size == 1:
+        return grads
+    grads = [tf.convert_to_tensor(g) for g in grads]
+    averaged = tf.compat.v1.py_func(
+        lambda *arrays: communicator.allreduce_mean(list(arrays)),
+        grads, [g.dtype for g in grads], stateful=True)
+    for a, g in zip(averaged, grads):
+        a.set_shape(g.shape)
+    return averaged
+
+
+def distributed_optimizer(optimizer, communicator):
+    """Wrap a Keras optimizer so that it applies gradients averaged over
+    all the replicas.
+
+    The returned optimizer is an instance of a subclass of the class of
+    `optimizer` (with the same name and config), so models compiled with it
+    are saved as usual.
+    """
+    optimizer = keras.optimizers.get(optimizer)
+    base = optimizer.__class__
+
+    class _DistributedOptimizer(base):
+        def get_gradients(self, loss, params):
+            grads = super(_DistributedOptimizer, self).get_gradients(
+                loss, params)
+            return allreduce_gradients(grads, communicator)
+
+    _DistributedOptimizer.__name__ = base.__name__
+    return _DistributedOptimizer.from_config(optimizer.get_config())
+
+
+def synchronise_random_seed(communicator):
+    """Use the same TF graph-level seed on every replica.
+
+    Has to be called before the model is built so that random ops which
+    modify the weights (e.g. the noise of `NoisySGD`) are identical.
+    """
+    seed = communicator.broadcast(
+        np.random.randint(2 ** 31 - 1) if communicator.is_root else None)
+    tf.compat.v1.set_random_seed(seed)
+    return seed
+
+
+class BroadcastWeightsCallback(Callback):
+    """Start every replica from the weights (including masks) of rank 0.
+
+    Has to come before `RewiringCallback` in the callback list.
+    """
+
+    def __init__(self, communicator):
+        super(BroadcastWeightsCallback, self).__init__()
+        self.communicator = communicator
+
+    def on_train_begin(self, logs=None):
+        weights = self.communicator.broadcast(
+            self.model.get_weights() if self.communicator.is_root else None)
+        if not self.communicator.is_root:
+            set_weights(self.model, weights)
+
+
+def _run_replica(target, rank, size, connection, args):
+    target(*args, communicator=LocalCommunicator(rank, size, [connection]))
+
+
+def launch_local_replicas(target, num_replicas, *args):
+    """Run `target(*args, communicator=...)` on `num_replicas` processes.
+
+    The calling process is rank 0, the other replicas are spawned (rather
+    than forked, which is not safe with TensorFlow) and joined once rank 0
+    returns.
+
+    :return: the result of `target` on rank 0
+    """
+    context = multiprocessing.get_context('spawn')
+    pipes = [context.Pipe() for _ in range(num_replicas - 1)]
+    processes = [
+        context.Process(target=_run_replica,
+                        args=(target, rank, num_replicas, child, args))
+        for rank, (_, child) in enumerate(pipes, 1)]
+    for p in processes:
+        p.start()
+    try:
+        return target(*args, communicator=LocalCommunicator(
+            0, num_replicas, [parent for parent, _ in pipes]))
+    except BaseException:
+        # the other replicas would otherwise wait for rank 0 forever
+        for p in processes:
+            p.terminate()
+        raise
+    finally:
+        for p in processes:
+            p.join()
@@ -0,0 +1,264 @@
+import os
+import struct
+import zlib
+from collections import namedtuple
+import numpy as np
+
+MAGIC = b'KRWEVT'
+FORMAT_VERSION = 1
+
+# record kinds
+LAYER = 0
+INITIAL = 1
+REWIRE = 2
+DECAY = 3
+KIND_NAMES = {INITIAL: 'initial', REWIRE: 'rewire', DECAY: 'decay'}
+
+_CHUNK_HEADER = struct.Struct('<II')
+_LAYER_HEADER = struct.Struct('<BHBH')
+_EVENT_HEADER = struct.Struct('<BIIHBII')
+# indices are sorted and stored as the differences between consecutive ones,
+# in the smallest of these types that can hold every difference of a record
+_DELTA_DTYPES = (np.dtype('<u1'), np.dtype('<u2'), np.dtype('<u4'))
+
+# A change in the connectivity of a layer, taking effect after `batch`
+# batches of `epoch`. `dropped` and `regrown` hold sorted flat indices into
+# the mask, an 'initial' event holds every active connection in `regrown`
+RewiringEvent = namedtuple('RewiringEvent',
+                           ['kind', 'epoch', 'batch', 'layer', 'dropped',
+                            'regrown'])
+
+
+def _encode_indices(indices):
+    indices = [np.sort(np.asarray(i, dtype=np.int64).ravel())
+               for i in indices]
+    deltas = [np.diff(i, prepend=0) for i in indices]
+    largest = max([d.max() for d in deltas if d.size] or [0])
+    for code, dtype in enumerate(_DELTA_DTYPES):
+        if largest <= np.iinfo(dtype).max:
+            break
+    return code, b''.join(d.astype(dtype).tobytes() for d in deltas)
+
+
+class RewiringEventLog(object):
+    """Compressed binary log of the connections dropped and regrown by a
+    `RewiringCallback`.
+
+    Records are packed with `struct` (indices sorted and delta-encoded) into
+    an in-memory buffer, which is compressed with zlib and appended to the
+    file as a chunk whenever it exceeds `chunk_size` bytes, so memory use is
+    bounded regardless of the length of training. If a `BackgroundWriter`
+    is provided, chunks are compressed and written by it.
+
+    Every layer is introduced by its kernel shape and its active connections
+    when training begins, so the evolution of the connectivity can be
+    replayed with `replay_event_log` without the model.
+
+    A run resumed from a checkpoint taken after `resume_epoch` epochs adds
+    its events to the existing log, after cutting off the events of the
+    epochs from `resume_epoch` on (which were abandoned) and any chunk left
+    incomplete by the interrupted run.
+    """
+
+    def __init__(self, filename, chunk_size=2 ** 20, compression_level=6,
+                 background_writer=None, resume_epoch=None):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.background_writer = background_writer
+        kept_records = b''
+        if resume_epoch is not None and os.path.isfile(filename) and \
+                os.path.getsize(filename) > 0:
+            length, kept_records = _resume_point(filename, resume_epoch)
+            os.truncate(filename, length)
+            self._file = open(filename, 'ab')
+        else:
+            self._file = open(filename, 'wb')
+            self._file.write(MAGIC + struct.pack('<B', FORMAT_VERSION))
+        # records of the chunk which was cut, preceding the first event cut
+        self._buffer = bytearray(kept_records)
+        self._layer_ids = {}
+
+    def _layer_id(self, name, shape):
+        if name not in self._layer_ids:
+            encoded_name = name.encode('utf-8')
+            self._layer_ids[name] = len(self._layer_ids)
+            self._buffer += _LAYER_HEADER.pack(
+                LAYER, self._layer_ids[name], len(shape), len(encoded_name))
+            self._buffer += struct.pack('<{}I'.format(len(shape)), *shape)
+            self._buffer += encoded_name
+        return self._layer_ids[name]
+
+    def record(self, kind, epoch, batch, name, shape, dropped=(),
+               regrown=()):
+        """Append an event for the layer `name`, whose mask has the given
+        shape."""
+        layer_id = self._layer_id(name, shape)
+        code, payload = _encode_indices((dropped, regrown))
+        self._buffer += _EVENT_HEADER.pack(kind, epoch, batch, layer_id, code,
+                                           np.size(dropped), np.size(regrown))
+        self._buffer += payload
+        if len(self._buffer) >= self.chunk_size:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        if not self._buffer:
+            return
+        raw, self._buffer = bytes(self._buffer), bytearray()
+        if self.background_writer is None:
+            self._write_chunk(raw)
+        else:
+            self.background_writer.submit(self._write_chunk, raw)
+
+    def _write_chunk(self, raw):
+        compressed = zlib.compress(raw, self.compression_level)
+        self._file.write(_CHUNK_HEADER.pack(len(compressed), len(raw)))
+        self._file.write(compressed)
+
+    def flush(self):
+        """Write the buffered events, so that the file can be read."""
+        self._write_buffer()
+        if self.background_writer is not None:
+            self.background_writer.flush()
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def _read_header(f, filename):
+    header = f.read(len(MAGIC) + 1)
+    if len(header) < len(MAGIC) + 1 or header[:len(MAGIC)] != MAGIC:
+        raise ValueError(
+            "{} is not a rewiring event log".format(filename))
+    if header[len(MAGIC)] > FORMAT_VERSION:
+        raise ValueError("Unsupported event log version {}".format(
+            header[len(MAGIC)]))
+
+
+def _read_chunks(f):
+    """Chunks of an open log, after its header.
+
+    :return: a generator of `(position, raw)`, where `position` is the
+        offset of the chunk in the file and `raw` its decompressed records
+    """
+    while True:
+        position = f.tell()
+        chunk_header = f.read(_CHUNK_HEADER.size)
+        if len(chunk_header) < _CHUNK_HEADER.size:
+            return
+        compressed_size, raw_size = _CHUNK_HEADER.unpack(chunk_header)
+        compressed = f.read(compressed_size)
+        if len(compressed) < compressed_size:
+            # chunk cut short by an interrupted run
+            return
+        raw = zlib.decompress(compressed)
+        assert len(raw) == raw_size
+        yield position, raw
+
+
+def _decode_records(raw):
+    """Decode the records of a chunk.
+
+    :return: a generator of `(offset, layer, event)`, where `offset` is the
+        start of the record in `raw` and either `layer` is
+        `(layer_id, name, shape)` or `event` is
+        `(kind, epoch, batch, layer_id, dropped, regrown)`
+    """
+    offset = 0
+    while offset < len(raw):
+        start = offset
+        if raw[offset] == LAYER:
+            _, layer_id, ndim, name_length = \
+                _LAYER_HEADER.unpack_from(raw, offset)
+            offset += _LAYER_HEADER.size
+            shape = struct.unpack_from('<{}I'.format(ndim), raw, offset)
+            offset += 4 * ndim
+            name = raw[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            yield start, (layer_id, name, shape), None
+            continue
+        kind, epoch, batch, layer_id, code, no_dropped, no_regrown = \
+            _EVENT_HEADER.unpack_from(raw, offset)
+        offset += _EVENT_HEADER.size
+        dtype = _DELTA_DTYPES[code]
+        indices = []
+        for count in (no_dropped, no_regrown):
+            deltas = np.frombuffer(raw, dtype=dtype, count=count,
+                                   offset=offset)
+            offset += count * dtype.itemsize
+            indices.append(np.cumsum(deltas, dtype=np.int64))
+        yield start, None, (kind, epoch, batch, layer_id) + tuple(indices)
+
+
+def _resume_point(filename, epoch):
+    """Where a run resumed after `epoch` epochs continues a log.
+
+    :return: the length of the log up to the chunk holding its first event
+        of `epoch` or later (or up to the end of its last complete chunk),
+        and the records of that chunk preceding the event
+    :rtype: tuple
+    """
+    with open(filename, 'rb') as f:
+        _read_header(f, filename)
+        end = f.tell()
+        for position, raw in _read_chunks(f):
+            for offset, _, event in _decode_records(raw):
+                if event is not None and event[1] >= epoch:
+                    return position, raw[:offset]
+            end = f.tell()
+    return end, b''
+
+
+def _read_records(filename):
+    """Decode a log one chunk at a time.
+
+    :return: a generator of `(layer_shapes, event)`, where `layer_shapes`
+        holds the kernel shape of every layer introduced so far
+    """
+    layers = {}
+    layer_shapes = {}
+    with open(filename, 'rb') as f:
+        _read_header(f, filename)
+        for _, raw in _read_chunks(f):
+            for _, layer, event in _decode_records(raw):
+                if layer is not None:
+                    layer_id, name, shape = layer
+                    layers[layer_id] = name
+                    layer_shapes[name] = shape
+                    continue
+                kind, epoch, batch, layer_id, dropped, regrown = event
+                yield layer_shapes, RewiringEvent(
+                    KIND_NAMES[kind], epoch, batch, layers[layer_id],
+                    dropped, regrown)
+
+
+def read_event_log(filename):
+    """Iterate over the `RewiringEvent`s in a log."""
+    for _, event in _read_records(filename):
+        yield event
+
+
+def replay_event_log(filename, layers=None):
+    """Replay the evolution of the connectivity recorded in a log.
+
+    :param layers: names of the layers to replay (all of them if None)
+    :type layers: list
+    :return: a generator of `(event, masks)` after every event, where
+        `masks` maps layer names to boolean masks (updated in place, so copy
+        the ones which have to be kept)
+    """
+    masks = {}
+    for layer_shapes, event in _read_records(filename):
+        if layers is not None and event.layer not in layers:
+            continue
+        if event.kind == 'initial':
+            masks[event.layer] = np.zeros(layer_shapes[event.layer],
+                                          dtype=bool)
+        flat_mask = masks[event.layer].reshape(-1)
+        # in this order, as a connection can be dropped and regrown in the
+        # same rewiring step
+        flat_mask[event.dropped] = False
+        flat_mask[event.regrown] = True
+        yield event, masks
@@ -20,7 +20,8 @@ def path_leaf(path):
 class ImagenetDataGenerator(object):
     def __init__(self, mode, batch, root_path,
                  img_size=(224, 224),
-                 shuffle=True, steps_per_epoch=None):
+                 shuffle=True, steps_per_epoch=None,
+                 shard_index=0, num_shards=1):
         self.mode = mode
         self.batch = batch
         self.root_path = root_path
@@ -37,6 +38,16 @@ class ImagenetDataGenerator(object):
 
         self.image_paths, self.cls_dict = \
             self._path_management()
+        if num_shards > 1:
+            # data-parallel training: every replica uses a disjoint subset of
+            # the same size, so that they all train for the same number of
+            # steps
+            shard_size = len(self.image_paths) // num_shards
+            self.image_paths = \
+                self.image_paths[shard_index::num_shards][:shard_size]
+        self.number_of_samples = len(self.image_paths)
+        if not self.steps_per_epoch:
+            self.steps_per_epoch = self.number_of_samples // self.batch
 
     def __call__(self):
         return self.imagenet_generator()
@@ -122,9 +133,6 @@ class ImagenetDataGenerator(object):
         else:
             raise ValueError("Invalid mode selected {}".format(self.mode))
 
-        self.number_of_samples = len(images)
-        if not self.steps_per_epoch:
-            self.steps_per_epoch = self.number_of_samples // self.batch
         images = np.asarray(images)
         classes = np.asarray(classes)
         img_names = np.copy(images)
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class ConnectionIndexPool(object):
+    """Active and dormant connection indices of a layer.
+
+    All flat indices of a kernel are stored in a single array partitioned
+    into active (`indices[:no_active]`) and dormant (`indices[no_active:]`)
+    connections, together with the position of every index in that array.
+    Moving k connections between the two partitions is done by swapping them
+    across the boundary, so activating, deactivating and sampling
+    connections cost O(k) rather than O(kernel entries). Both arrays are
+    int32 unless the kernel has 2 ** 31 entries or more.
+    """
+
+    def __init__(self, flat_mask):
+        active = np.flatnonzero(flat_mask)
+        dormant = np.flatnonzero(np.asarray(flat_mask) == 0)
+        self.size = active.size + dormant.size
+        self.no_active = active.size
+        dtype = np.int32 if self.size < 2 ** 31 else np.int64
+        self.indices = np.concatenate((active, dormant)).astype(dtype)
+        self.positions = np.empty(self.size, dtype=dtype)
+        self.positions[self.indices] = np.arange(self.size, dtype=dtype)
+
+    @property
+    def no_dormant(self):
+        return self.size - self.no_active
+
+    def active(self):
+        return self.indices[:self.no_active]
+
+    def dormant(self):
+        return self.indices[self.no_active:]
+
+    def _swap_to_region(self, flat_indices, start, stop):
+        # move flat_indices (which are all outside of [start, stop) or
+        # already in it) so that they occupy positions [start, stop)
+        positions = self.positions[flat_indices]
+        inside = (positions >= start) & (positions < stop)
+        occupied = np.zeros(stop - start, dtype=bool)
+        occupied[positions[inside] - start] = True
+        free_positions = start + np.flatnonzero(~occupied)
+        moving_positions = positions[~inside]
+        moving = self.indices[moving_positions]
+        displaced = self.indices[free_positions]
+        self.indices[free_positions] = moving
+        self.indices[moving_positions] = displaced
+        self.positions[moving] = free_positions
+        self.positions[displaced] = moving_positions
+
+    def deactivate(self, flat_indices):
+        """Make currently active connections dormant."""
+        flat_indices = np.asarray(flat_indices, dtype=np.int64)
+        if flat_indices.size == 0:
+            return
+        boundary = self.no_active - flat_indices.size
+        self._swap_to_region(flat_indices, boundary, self.no_active)
+        self.no_active = boundary
+
+    def activate(self, flat_indices):
+        """Make currently dormant connections active."""
+        flat_indices = np.asarray(flat_indices, dtype=np.int64)
+        if flat_indices.size == 0:
+            return
+        boundary = self.no_active + flat_indices.size
+        self._swap_to_region(flat_indices, self.no_active, boundary)
+        self.no_active = boundary
+
+    def sample_dormant(self, k, rng=None):
+        """Sample k distinct dormant connections uniformly at random.
+
+        :param k: number of connections to sample
+        :type k: int
+        :param rng: random number generator to use
+        :type rng: np.random.Generator
+        :return: flat indices of the chosen connections
+        :rtype: np.ndarray
+        """
+        rng = rng or np.random.default_rng()
+        no_dormant = self.no_dormant
+        if k > no_dormant:
+            raise ValueError("Cannot sample {} connections out of {} dormant "
+                             "ones".format(k, no_dormant))
+        if 4 * k > no_dormant:
+            choices = rng.choice(no_dormant, k, replace=False)
+        else:
+            # rejection sampling -- expected O(k) when k << no_dormant
+            choices = np.unique(rng.integers(0, no_dormant, size=k))
+            while choices.size < k:
+                choices = np.unique(np.concatenate(
+                    (choices,
+                     rng.integers(0, no_dormant, size=k - choices.size))))
+            # np.unique sorts, restore a random order
+            rng.shuffle(choices)
+        return self.indices[self.no_active + choices]
@@ -8,6 +8,7 @@ def load_and_preprocess_dataset(dataset_name, categorical_output=True,
                                 batch_size=100, path=None,
                                 steps_per_epoch=None,
                                 val_steps_per_epoch=None,
+                                shard_index=0, num_shards=1,
                                 ):
     path = path or ''
     # Dataset selection
@@ -76,7 +77,9 @@ def load_and_preprocess_dataset(dataset_name, categorical_output=True,
             print("Generators being set up for", steps_per_epoch,
                   "steps_per_epoch")
         train_gen = ImagenetDataGenerator("train", batch_size, path,
-                                          steps_per_epoch=steps_per_epoch)
+                                          steps_per_epoch=steps_per_epoch,
+                                          shard_index=shard_index,
+                                          num_shards=num_shards)
         val_gen = ImagenetDataGenerator("val", batch_size, path,
                                         steps_per_epoch=val_steps_per_epoch)
 
@@ -116,6 +119,12 @@ def load_and_preprocess_dataset(dataset_name, categorical_output=True,
         # convert class vectors to binary class matrices
         y_train = keras.utils.to_categorical(y_train, num_classes)
         y_test = keras.utils.to_categorical(y_test, num_classes)
+    if num_shards > 1:
+        # data-parallel training: every replica uses a disjoint subset of
+        # the same size, so that they all train for the same number of steps
+        shard_size = len(x_train) // num_shards
+        x_train = x_train[shard_index::num_shards][:shard_size]
+        y_train = y_train[shard_index::num_shards][:shard_size]
 
     return {'train': (x_train, y_train),
             'test': (x_test, y_test),
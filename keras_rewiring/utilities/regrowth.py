@@ -0,0 +1,126 @@
+import numpy as np
+from keras import backend as K
+
+
+class RandomRegrowth(object):
+    """Regrow dormant connections uniformly at random (Deep R).
+
+    Base class of the regrowth policies of `RewiringCallback`, which are used
+    by hard, unstructured rewiring. A policy can provide a variable per layer
+    (`score_variable`) whose value is retrieved together with the kernel at
+    every rewiring step of the layer and passed to `regrow`.
+    """
+
+    def attach(self, model):
+        """Set up the scores of the layers of a model. Has to be called
+        before training starts, i.e. before the train function of the
+        model is built."""
+
+    def score_variable(self, layer):
+        return None
+
+    def regrow(self, state, number, scores=None, exclude=None):
+        """Choose `number` dormant connections of a layer to make active.
+
+        :param state: host-side rewiring state of the layer
+        :type state: keras_rewiring.rewiring_callback.LayerRewiringState
+        :param scores: value of the score variable of the layer at its last
+            rewiring step (if any)
+        :type scores: np.ndarray
+        :param exclude: dormant connections which should only be chosen if
+            there are not enough others, i.e. the ones dropped by the same
+            rewiring step. Random regrowth samples among all the dormant
+            connections, as in Deep R.
+        :type exclude: np.ndarray
+        :return: flat indices of the chosen connections
+        :rtype: np.ndarray
+        """
+        return state.pool.sample_dormant(number, state.rng)
+
+
+class GradientMagnitudeRegrowth(RandomRegrowth):
+    """Regrow the dormant connections with the largest gradients.
+
+    The magnitude of the gradient of the loss with respect to the dense
+    (masked) kernel, which is non-zero for dormant connections too, is
+    accumulated in-graph as an exponential moving average, in the backward
+    pass of the optimizer (through the `kernel_gradient_hooks` of the sparse
+    layers), so only the accumulator is retrieved, once per rewiring step of
+    a layer. Layers
+    regrown before their scores are available (e.g. by a global budget)
+    fall back to random regrowth.
+
+    Layers with `sparse_gradient=True` only compute the gradient of their
+    active connections, plus a random sample of `dormant_sample_rate` of the
+    kernel entries at every batch, so the scores of their dormant
+    connections are accumulated from these samples.
+
+    The connections dropped by a rewiring step are not regrown by it (their
+    gradients are typically the largest). The accumulators are saved with
+    the state of the `RewiringCallback`, so they carry on when training is
+    resumed from a compact checkpoint.
+    """
+
+    def __init__(self, decay=.9, dormant_sample_rate=.1):
+        """
+        :param decay: of the moving average, per batch
+        :type decay: float
+        :param dormant_sample_rate: proportion of the kernel entries of the
+            layers with sparse gradients whose gradient is sampled per batch
+        :type dormant_sample_rate: float
+        """
+        self.decay = decay
+        self.dormant_sample_rate = dormant_sample_rate
+        self.accumulators = {}
+
+    @staticmethod
+    def masked_kernel(layer):
+        # the masked kernel tensor computed by the sparse layers in `build`
+        if hasattr(layer, "depthwise_kernel"):
+            return layer.depthwise_kernel
+        return layer.kernel
+
+    def attach(self, model):
+        if getattr(model, "train_function", None) is not None:
+            raise ValueError("A gradient regrowth policy has to be attached "
+                             "before the model is trained")
+        layers = [l for l in model.layers if hasattr(l, "mask") and
+                  not getattr(l, "in_graph_rewiring", False) and
+                  l.name not in self.accumulators]
+        for l in layers:
+            if getattr(l, "sparse_gradient", False) and \
+                    hasattr(l, "dormant_gradient_rate"):
+                K.set_value(l.dormant_gradient_rate, self.dormant_sample_rate)
+            accumulator = K.zeros(K.int_shape(l.mask),
+                                  name=l.name + '_grad_magnitude')
+            # the average is updated from the gradient of the masked kernel
+            # computed by the optimizer, so it shares its backward pass
+            l.kernel_gradient_hooks = \
+                getattr(l, "kernel_gradient_hooks", []) + \
+                [self._accumulate(accumulator)]
+            self.accumulators[l.name] = accumulator
+
+    def _accumulate(self, accumulator):
+        def hook(gradient):
+            return K.update(accumulator,
+                            self.decay * accumulator +
+                            (1 - self.decay) * K.abs(gradient))
+        return hook
+
+    def score_variable(self, layer):
+        return self.accumulators.get(layer.name)
+
+    def regrow(self, state, number, scores=None, exclude=None):
+        if scores is None:
+            return super(GradientMagnitudeRegrowth, self).regrow(
+                state, number)
+        candidates = state.pool.dormant()
+        if number >= candidates.size:
+            return np.array(candidates)
+        candidate_scores = np.ravel(scores)[candidates]
+        if exclude is not None and np.size(exclude):
+            # positions of the excluded connections among the candidates
+            candidate_scores[state.pool.positions[exclude] -
+                             state.pool.no_active] = -np.inf
+        largest = np.argpartition(-candidate_scores, number - 1)[:number]
+        return candidates[largest]
@@ -1,7 +1,7 @@
 import os
 import keras
 from keras.models import Sequential
-from keras.layers import Dense, Conv2D
+from keras.layers import Dense, Conv2D, DepthwiseConv2D
 from keras.utils import CustomObjectScope
 from keras_rewiring.optimizers.noisy_sgd import NoisySGD
 from keras_rewiring.sparse_layer import \
@@ -10,6 +10,7 @@ from keras.models import load_model
 from keras import backend as K
 import ntpath
 import json
+import hashlib
 import h5py
 import numpy as np
 
@@ -37,7 +38,9 @@ def replace_dense_with_sparse(
         conn_decay=None,
         custom_object={},
         no_cache=False, threshold=True, random_weights=True,
-        freeze_weight=False):
+        freeze_weight=False, in_graph_rewiring=False,
+        kernel_format='dense', sparse_gradient=False, mask_dtype=None,
+        cache_kernel=False):
     '''
     Model is defined in Howard et al (2017)
     MobileNets: Efficient Convolutional Neural Networks for Mobile Vision
@@ -71,7 +74,22 @@ def replace_dense_with_sparse(
     mean_no_conn = np.mean(number_of_connections_per_layer)
 
     # https://stackoverflow.com/questions/8384737/extract-file-name-from-path-no-matter-what-the-os-path-format
-    converted_model_filename = model.name + "_converted_to_sparse"
+    # the cached model is only valid for the same conversion options
+    options = json.dumps({
+        'batch_size': batch_size,
+        'builtin_sparsity': builtin_sparsity,
+        'conn_decay': conn_decay,
+        'threshold': threshold,
+        'random_weights': random_weights,
+        'freeze_weight': freeze_weight,
+        'in_graph_rewiring': in_graph_rewiring,
+        'kernel_format': kernel_format,
+        'sparse_gradient': sparse_gradient,
+        'mask_dtype': mask_dtype,
+        'cache_kernel': cache_kernel,
+    }, sort_keys=True, default=str)
+    converted_model_filename = model.name + "_converted_to_sparse_" + \
+        hashlib.sha1(options.encode('utf-8')).hexdigest()[:12]
     file_path = os.path.join(_cache, converted_model_filename + ".h5")
     if not no_cache and os.path.exists(file_path):
         print("Using cached version of", converted_model_filename)
@@ -110,12 +128,20 @@ def replace_dense_with_sparse(
                 ((threshold and len(curr_weights) > 0 and curr_weights[0].size > mean_no_conn)
                  or not threshold)):
             layer_config['connectivity_decay'] = conn_decay.pop(0)
+        if in_graph_rewiring:
+            layer_config['in_graph_rewiring'] = True
+        if sparse_gradient and not isinstance(layer, DepthwiseConv2D):
+            layer_config['sparse_gradient'] = True
+        layer_config['mask_dtype'] = mask_dtype
+        if cache_kernel:
+            layer_config['cache_kernel'] = True
         if isinstance(layer, Conv2D):
             if (threshold and curr_weights[0].size > mean_no_conn) or not threshold:
                 curr_sparse_layer = SparseConv2D(**layer_config)
         elif isinstance(layer, Dense):
             if (threshold and curr_weights[0].size > mean_no_conn) or not threshold:
-                curr_sparse_layer = Sparse(**layer_config)
+                curr_sparse_layer = Sparse(kernel_format=kernel_format,
+                                           **layer_config)
 
         if curr_sparse_layer is not None:
             layer_to_add = curr_sparse_layer
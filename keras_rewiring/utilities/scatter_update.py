@@ -0,0 +1,42 @@
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+
+
+def scatter_update(variable, flat_indices, values):
+    """Write values to a subset of the entries of a backend variable.
+
+    Only the given entries are transferred, so the cost scales with the
+    number of entries written rather than with the size of the variable.
+
+    :param variable: variable to update in place
+    :param flat_indices: indices into the flattened variable
+    :type flat_indices: np.ndarray
+    :param values: new values (broadcast to the shape of `flat_indices`)
+    """
+    flat_indices = np.asarray(flat_indices, dtype=np.int64).reshape(-1)
+    if flat_indices.size == 0:
+        return
+    shape = K.int_shape(variable)
+    indices = np.stack(np.unravel_index(flat_indices, shape), axis=-1)
+    values = np.broadcast_to(
+        np.asarray(values, dtype=K.dtype(variable)), flat_indices.shape)
+    if tf.executing_eagerly():
+        tf.compat.v1.scatter_nd_update(variable, indices, values)
+        return
+    # graph mode: build the update op once per variable and feed it
+    # (same approach as `K.batch_set_value`)
+    if not hasattr(variable, '_scatter_placeholders'):
+        indices_placeholder = tf.compat.v1.placeholder(
+            tf.int64, shape=(None, len(shape)))
+        values_placeholder = tf.compat.v1.placeholder(
+            variable.dtype.base_dtype, shape=(None,))
+        scatter_op = tf.compat.v1.scatter_nd_update(
+            variable, indices_placeholder, values_placeholder)
+        variable._scatter_placeholders = (
+            indices_placeholder, values_placeholder, scatter_op)
+    indices_placeholder, values_placeholder, scatter_op = \
+        variable._scatter_placeholders
+    K.get_session().run(scatter_op,
+                        feed_dict={indices_placeholder: indices,
+                                   values_placeholder: values})
@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class SignBitmap(object):
+    """Packed record of the sign of every entry of a kernel.
+
+    Two bits are stored per entry (strictly positive / strictly negative),
+    packed 8 entries per byte, so a zero weight (e.g. a freshly regrown
+    connection) is never considered to have changed sign. Comparing a new
+    kernel against the bitmap replaces keeping a full copy of the kernel
+    from the beginning of the batch.
+    """
+
+    def __init__(self, size):
+        self.size = int(size)
+        no_bytes = (self.size + 7) // 8
+        self.positive = np.zeros(no_bytes, dtype=np.uint8)
+        self.negative = np.zeros(no_bytes, dtype=np.uint8)
+        # preallocated buffers, reused for every update
+        self._bool_buffer = np.empty(self.size, dtype=bool)
+        self._changed = np.empty(no_bytes, dtype=np.uint8)
+        self._scratch = np.empty(no_bytes, dtype=np.uint8)
+
+    @staticmethod
+    def pack(flags):
+        return np.packbits(flags)
+
+    @staticmethod
+    def unpack_indices(packed):
+        """Flat indices of the set bits in a packed bitmap.
+
+        Only bytes containing at least one set bit are expanded, so the cost
+        beyond the byte scan is proportional to the number of set bits.
+        """
+        nonzero_bytes = np.flatnonzero(packed)
+        if nonzero_bytes.size == 0:
+            return nonzero_bytes
+        bits = np.unpackbits(packed[nonzero_bytes][:, None], axis=1)
+        rows, cols = np.nonzero(bits)
+        return nonzero_bytes[rows] * 8 + cols
+
+    def _pack_signs(self, kernel):
+        flat_kernel = np.ravel(kernel)
+        np.greater(flat_kernel, 0, out=self._bool_buffer)
+        positive = np.packbits(self._bool_buffer)
+        np.less(flat_kernel, 0, out=self._bool_buffer)
+        negative = np.packbits(self._bool_buffer)
+        return positive, negative
+
+    def update(self, kernel):
+        self.positive, self.negative = self._pack_signs(kernel)
+
+    def flips(self, kernel, packed_mask=None, update=True):
+        """Flat indices of entries whose sign changed since the last update.
+
+        :param kernel: current value of the kernel
+        :type kernel: np.ndarray
+        :param packed_mask: if provided, only report entries set in this
+            (packed) mask
+        :type packed_mask: np.ndarray
+        :param update: record the signs of `kernel` in the bitmap
+        :type update: bool
+        :return: flat indices of the entries which changed sign
+        :rtype: np.ndarray
+        """
+        positive, negative = self._pack_signs(kernel)
+        changed = np.bitwise_and(self.positive, negative, out=self._changed)
+        np.bitwise_or(changed,
+                      np.bitwise_and(self.negative, positive,
+                                     out=self._scratch),
+                      out=changed)
+        if packed_mask is not None:
+            np.bitwise_and(changed, packed_mask, out=changed)
+        if update:
+            self.positive, self.negative = positive, negative
+        return SignBitmap.unpack_indices(changed)
+
+    def set(self, flat_indices, values):
+        """Record new values for a few entries of the kernel."""
+        SignBitmap.assign_bits(self.positive, flat_indices, values > 0)
+        SignBitmap.assign_bits(self.negative, flat_indices, values < 0)
+
+    @staticmethod
+    def get_bits(packed, flat_indices):
+        """Values of individual bits of a packed bitmap."""
+        flat_indices = np.asarray(flat_indices)
+        return ((packed[flat_indices >> 3] >> (7 - (flat_indices & 7))) &
+                1).astype(bool)
+
+    @staticmethod
+    def assign_bits(packed, flat_indices, flags):
+        """Set (or clear) individual bits in a packed bitmap, in place."""
+        flat_indices = np.asarray(flat_indices)
+        flags = np.broadcast_to(np.asarray(flags, dtype=bool),
+                                flat_indices.shape)
+        byte_indices = flat_indices >> 3
+        bits = (np.uint8(1) << (7 - (flat_indices & 7))).astype(np.uint8)
+        np.bitwise_and.at(packed, byte_indices[~flags],
+                          np.invert(bits[~flags]))
+        np.bitwise_or.at(packed, byte_indices[flags], bits[flags])
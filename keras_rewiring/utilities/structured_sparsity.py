@@ -0,0 +1,292 @@
+import numpy as np
+from keras_rewiring.utilities.index_pool import ConnectionIndexPool
+
+
+class _StructuredSparsity(object):
+    """Base class of the structured rewiring schemes.
+
+    Kernels are seen as 2D matrices of shape
+    (prod(kernel.shape[:-1]), kernel.shape[-1]), i.e. (inputs, outputs) for
+    Dense layers and (kernel_h * kernel_w * in_channels, filters) for
+    convolutions, and are partitioned into groups of entries. An instance
+    created by the user only holds the parameters of the scheme,
+    `bind(kernel_shape)` returns a copy specialised for a given kernel.
+
+    The structure only constrains the layout of the mask: the sparse layers
+    still compute the dense `kernel * mask` product, so training is neither
+    faster nor smaller than with unstructured rewiring. The resulting masks
+    can be exported to block-sparse or N:M kernels for inference.
+    """
+
+    def __init__(self):
+        self.rows = None
+        self.cols = None
+
+    def bind(self, kernel_shape):
+        bound = self.__class__.__new__(self.__class__)
+        bound.__dict__.update(self.__dict__)
+        bound.cols = int(kernel_shape[-1])
+        bound.rows = int(np.prod(kernel_shape[:-1]))
+        bound._check_shape(kernel_shape)
+        return bound
+
+    def _check_shape(self, kernel_shape):
+        raise NotImplementedError
+
+    @property
+    def group_size(self):
+        raise NotImplementedError
+
+    @property
+    def no_groups(self):
+        return self.rows * self.cols // self.group_size
+
+    def group_of(self, flat_indices):
+        """Group id of each of the given flat kernel indices."""
+        raise NotImplementedError
+
+    def members(self, groups):
+        """Flat kernel indices of the entries of each of the given groups.
+
+        :return: array of shape (len(groups), group_size)
+        :rtype: np.ndarray
+        """
+        raise NotImplementedError
+
+    def project(self, mask, kernel):
+        """Closest mask (keeping the largest weights) following the structure.
+
+        Entries active in `mask` are preferred, so projecting a mask which
+        already follows the structure leaves it unchanged.
+        """
+        raise NotImplementedError
+
+    def is_valid(self, flat_mask):
+        raise NotImplementedError
+
+    def initialise(self, state):
+        """Add any structure-specific data to a `LayerRewiringState`."""
+        pass
+
+    def rewire(self, state, flipped, flat_kernel, soft_limit, noise_coeff):
+        """Rewire a layer given the active connections which changed sign.
+
+        The host-side state is modified in place.
+
+        :return: dropped and regrown connections, and the kernel entries to
+            overwrite (or None) together with their new values
+        :rtype: tuple
+        """
+        raise NotImplementedError
+
+    def _group_scores(self, mask, kernel):
+        # rank entries by activity first, then by weight magnitude
+        flat_mask = np.ravel(mask)
+        flat_kernel = np.abs(np.ravel(kernel)).astype(np.float64)
+        scale = flat_kernel.max() + 1. if flat_kernel.size else 1.
+        return (flat_mask != 0) * scale + flat_kernel
+
+
+class NMSparsity(_StructuredSparsity):
+    """At most N active connections in every group of M consecutive inputs.
+
+    Groups are formed along the input axis of the 2D view of the kernel
+    (i.e. M consecutive rows of the same column), which is the pattern used
+    by N:M sparse tensor cores. Masks are projected onto at most N active
+    connections per group, keeping their number of active connections
+    (which therefore has to be at most N/M of the kernel). Hard rewiring
+    then replaces every dropped
+    connection by a random dormant connection of the same group, while soft
+    rewiring only activates a connection if its group has fewer than N
+    active ones.
+    """
+
+    def __init__(self, n, m):
+        super(NMSparsity, self).__init__()
+        if not 0 < n <= m:
+            raise ValueError("N:M sparsity requires 0 < N <= M, got "
+                             "{}:{}".format(n, m))
+        self.n = int(n)
+        self.m = int(m)
+
+    def _check_shape(self, kernel_shape):
+        if self.rows % self.m != 0:
+            raise ValueError(
+                "Kernel of shape {} has {} inputs per output, which is not "
+                "a multiple of M={}".format(kernel_shape, self.rows, self.m))
+
+    @property
+    def group_size(self):
+        return self.m
+
+    def group_of(self, flat_indices):
+        rows, cols = np.divmod(flat_indices, self.cols)
+        return (rows // self.m) * self.cols + cols
+
+    def members(self, groups):
+        block_rows, cols = np.divmod(np.asarray(groups), self.cols)
+        rows = block_rows[:, None] * self.m + np.arange(self.m)
+        return rows * self.cols + cols[:, None]
+
+    def project(self, mask, kernel):
+        no_active = np.count_nonzero(mask)
+        if no_active > self.n * self.no_groups:
+            raise ValueError(
+                "{}:{} sparsity allows at most {} active connections, the "
+                "mask has {}".format(self.n, self.m, self.n * self.no_groups,
+                                     no_active))
+        scores = self._group_scores(mask, kernel)
+        members = self.members(np.arange(self.no_groups))
+        # the n highest scoring entries of every group are the candidates,
+        # of which the no_active highest scoring ones are kept
+        top_n = np.argpartition(-scores[members], self.n - 1,
+                                axis=1)[:, :self.n]
+        candidates = np.take_along_axis(members, top_n, axis=1).ravel()
+        flat_mask = np.zeros(mask.size, dtype=mask.dtype)
+        if no_active > 0:
+            kept = np.argpartition(-scores[candidates],
+                                   no_active - 1)[:no_active]
+            flat_mask[candidates[kept]] = 1
+        return flat_mask.reshape(mask.shape)
+
+    def is_valid(self, flat_mask):
+        members = self.members(np.arange(self.no_groups))
+        return np.all(np.count_nonzero(flat_mask[members], axis=1) <= self.n)
+
+    def _limit_to_n(self, state, candidates):
+        # keep (a random selection of) the candidates that fit in their group
+        if candidates.size == 0:
+            return candidates
+        candidates = candidates[state.rng.permutation(candidates.size)]
+        groups, inverse = np.unique(self.group_of(candidates),
+                                    return_inverse=True)
+        no_active = np.count_nonzero(state.flat_mask[self.members(groups)],
+                                     axis=1)
+        order = np.argsort(inverse, kind='stable')
+        sorted_groups = inverse[order]
+        rank = np.arange(order.size) - np.searchsorted(sorted_groups,
+                                                       sorted_groups)
+        return candidates[order][rank < (self.n - no_active)[sorted_groups]]
+
+    def rewire(self, state, flipped, flat_kernel, soft_limit, noise_coeff):
+        state.deactivate(flipped)
+        if soft_limit:
+            candidates, kernel_indices, kernel_values = \
+                state.perturb_dormant(flat_kernel, noise_coeff)
+            regrown = self._limit_to_n(state, candidates)
+        else:
+            kernel_indices = kernel_values = None
+            groups, no_dropped = np.unique(self.group_of(flipped),
+                                           return_counts=True)
+            members = self.members(groups)
+            # random scores for the dormant members, the no_dropped highest
+            # of each group are regrown
+            scores = np.where(state.flat_mask[members] == 0,
+                              state.rng.random(members.shape), -1.)
+            order = np.argsort(-scores, axis=1)
+            regrown = np.take_along_axis(members, order, axis=1)[
+                np.arange(self.m) < no_dropped[:, None]]
+        state.activate(regrown)
+        return flipped, regrown, kernel_indices, kernel_values
+
+
+class BlockSparsity(_StructuredSparsity):
+    """Connections are active or dormant in whole rectangular tiles.
+
+    The 2D view of the kernel is tiled with blocks of shape `block_shape`.
+    An active block is dropped when more than `flip_threshold` of its
+    entries changed sign. Hard rewiring regrows the same number of random
+    dormant blocks, while soft rewiring adds noise to the dormant blocks and
+    activates those with more than `flip_threshold` of their entries
+    changing sign. As for `NMSparsity`, only the mask is block-structured,
+    the forward pass is not a block-sparse product.
+    """
+
+    def __init__(self, block_shape, flip_threshold=.5):
+        super(BlockSparsity, self).__init__()
+        self.block_shape = tuple(int(b) for b in block_shape)
+        if len(self.block_shape) != 2 or min(self.block_shape) < 1:
+            raise ValueError("Invalid block shape {}".format(block_shape))
+        self.flip_threshold = flip_threshold
+
+    def _check_shape(self, kernel_shape):
+        if self.rows % self.block_shape[0] or \
+                self.cols % self.block_shape[1]:
+            raise ValueError(
+                "Kernel of shape {} (seen as {}x{}) cannot be tiled with "
+                "blocks of shape {}".format(kernel_shape, self.rows,
+                                            self.cols, self.block_shape))
+        self.grid_cols = self.cols // self.block_shape[1]
+        block_rows = np.arange(self.block_shape[0])[:, None]
+        block_cols = np.arange(self.block_shape[1])
+        # flat offsets of the entries of a block relative to its corner
+        self._offsets = (block_rows * self.cols + block_cols).ravel()
+
+    @property
+    def group_size(self):
+        return self.block_shape[0] * self.block_shape[1]
+
+    def group_of(self, flat_indices):
+        rows, cols = np.divmod(flat_indices, self.cols)
+        return (rows // self.block_shape[0]) * self.grid_cols + \
+               cols // self.block_shape[1]
+
+    def members(self, groups):
+        grid_rows, grid_cols = np.divmod(np.asarray(groups), self.grid_cols)
+        corners = grid_rows * self.block_shape[0] * self.cols + \
+                  grid_cols * self.block_shape[1]
+        return corners[:, None] + self._offsets
+
+    def project(self, mask, kernel):
+        scores = self._group_scores(mask, kernel)
+        members = self.members(np.arange(self.no_groups))
+        # same number of active entries, rounded to whole blocks
+        no_blocks = int(round(np.count_nonzero(mask) /
+                              float(self.group_size)))
+        flat_mask = np.zeros(mask.size, dtype=mask.dtype)
+        if no_blocks > 0:
+            block_scores = scores[members].sum(axis=1)
+            kept = np.argpartition(-block_scores,
+                                   no_blocks - 1)[:no_blocks]
+            flat_mask[members[kept]] = 1
+        return flat_mask.reshape(mask.shape)
+
+    def is_valid(self, flat_mask):
+        no_active = np.count_nonzero(
+            flat_mask[self.members(np.arange(self.no_groups))], axis=1)
+        return np.all((no_active == 0) | (no_active == self.group_size))
+
+    def initialise(self, state):
+        # pool of active and dormant blocks
+        block_mask = state.flat_mask[self.members(
+            np.arange(self.no_groups))[:, 0]]
+        state.block_pool = ConnectionIndexPool(block_mask)
+
+    def rewire(self, state, flipped, flat_kernel, soft_limit, noise_coeff):
+        groups, no_flipped = np.unique(self.group_of(flipped),
+                                       return_counts=True)
+        dropped_blocks = groups[
+            no_flipped > self.flip_threshold * self.group_size]
+        state.block_pool.deactivate(dropped_blocks)
+        dropped = self.members(dropped_blocks).ravel()
+        state.deactivate(dropped)
+        kernel_indices = kernel_values = None
+        if soft_limit:
+            dormant_blocks = state.block_pool.dormant()
+            members = self.members(dormant_blocks)
+            dormant_k = flat_kernel[members]
+            noisy_k = dormant_k + noise_coeff * state.rng.standard_normal(
+                dormant_k.shape, dtype=dormant_k.dtype)
+            sign_changed = np.count_nonzero(noisy_k * dormant_k < 0, axis=1)
+            regrown_blocks = dormant_blocks[
+                sign_changed > self.flip_threshold * self.group_size]
+            kernel_indices = members.ravel()
+            kernel_values = np.clip(noisy_k, -1.5, 1.5).ravel()
+            state.sign_bitmap.set(kernel_indices, kernel_values)
+        else:
+            regrown_blocks = state.block_pool.sample_dormant(
+                dropped_blocks.size, state.rng)
+        state.block_pool.activate(regrown_blocks)
+        regrown = self.members(regrown_blocks).ravel()
+        state.activate(regrown)
+        return dropped, regrown, kernel_indices, kernel_values
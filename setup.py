@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='keras_rewiring',
     version='0.0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     url='https://github.com/pabogdan/keras_rewiring',
     license="GNU GPLv3.0",
     author='Petrut Antoniu Bogdan',
@@ -0,0 +1,185 @@
+import os
+import numpy as np
+from keras_rewiring.utilities.compact_checkpoint import \
+    encode_sparse_kernel, decode_sparse_kernel, snapshot_delta, \
+    apply_snapshot_delta, write_compact_checkpoint, \
+    read_compact_checkpoint, DeltaCheckpointWriter, read_delta_checkpoint, \
+    delta_checkpoint_epochs
+from keras_rewiring.utilities.sign_bitmap import SignBitmap
+
+SHAPE = (500, 400)
+
+
+def sparse_kernel(rng, connectivity=.1):
+    mask = (rng.random(SHAPE) < connectivity).astype(np.uint8)
+    kernel = (rng.standard_normal(SHAPE) * mask).astype(np.float32)
+    return kernel, mask
+
+
+def rewire(rng, kernel, mask, proportion=.01):
+    """Swap a proportion of the active connections for dormant ones."""
+    kernel, mask = kernel.copy(), mask.copy()
+    active = np.flatnonzero(mask)
+    dormant = np.flatnonzero(mask == 0)
+    number = int(proportion * active.size)
+    dropped = rng.choice(active, number, replace=False)
+    regrown = rng.choice(dormant, number, replace=False)
+    mask.reshape(-1)[dropped] = 0
+    mask.reshape(-1)[regrown] = 1
+    kernel.reshape(-1)[dropped] = 0
+    kernel += (rng.standard_normal(SHAPE) * mask).astype(np.float32)
+    return kernel, mask
+
+
+def snapshot(epoch, kernel, mask, rng):
+    """Snapshot as produced by `snapshot_model_state` for a model with a
+    single sparse layer, trained with momentum and gradient regrowth."""
+    active = SignBitmap.unpack_indices(np.packbits(mask.reshape(-1) != 0))
+    signs = np.ravel(kernel)[active]
+    layer_state = {
+        'interval': 1, 'batches_since_rewiring': 0, 'schedule_credit': 0.,
+        'flip_rate': 0., 'budget_credit': 0.,
+        'rng': np.random.default_rng(epoch).bit_generator.state,
+        'active_sign_positive': np.packbits(signs > 0),
+        'active_sign_negative': np.packbits(signs < 0),
+        'regrowth_scores': rng.random(SHAPE, dtype=np.float32),
+        'regrowth_accumulator': rng.random(SHAPE, dtype=np.float32)}
+    return {'epoch': epoch,
+            'layers': [{'name': 'sparse_1',
+                        'weights': [None, rng.standard_normal(SHAPE[1]),
+                                    None],
+                        'sparse': dict(encode_sparse_kernel(kernel, mask),
+                                       kernel_index=0, mask_index=2,
+                                       shape=SHAPE,
+                                       kernel_dtype=kernel.dtype.str,
+                                       mask_dtype=mask.dtype.str),
+                        'connectivity_level': .1}],
+            'optimizer_weights': [np.array(epoch),
+                                  rng.standard_normal(SHAPE),
+                                  rng.standard_normal(SHAPE[1])],
+            'numpy_random_state': np.random.RandomState(epoch).get_state(),
+            'callback_state': {'epoch_data': {'no_connections_sparse_1':
+                                                  int(mask.sum())},
+                               'batch_data': {},
+                               'layers': {'sparse_1': layer_state}}}
+
+
+def decoded(s):
+    sparse = s['layers'][0]['sparse']
+    return decode_sparse_kernel(sparse, SHAPE, np.float32, np.uint8)
+
+
+def test_sparse_kernel_round_trip():
+    rng = np.random.default_rng(0)
+    kernel, mask = sparse_kernel(rng)
+    # a dormant entry which is not 0, e.g. a connection just dropped
+    dormant = np.flatnonzero(mask == 0)[:3]
+    kernel.reshape(-1)[dormant] = 1.5
+    encoded = encode_sparse_kernel(kernel, mask)
+    assert encoded['values'].size == np.count_nonzero(mask)
+    assert np.array_equal(encoded['extra_indices'], dormant)
+    new_kernel, new_mask = decode_sparse_kernel(encoded, SHAPE, np.float32,
+                                                np.uint8)
+    assert np.array_equal(new_kernel, kernel)
+    assert np.array_equal(new_mask, mask)
+
+
+def test_delta_round_trip():
+    rng = np.random.default_rng(1)
+    kernel, mask = sparse_kernel(rng)
+    base = snapshot(1, kernel, mask, rng)
+    new_kernel, new_mask = rewire(rng, kernel, mask)
+    delta, mask_bits = snapshot_delta(
+        snapshot(2, new_kernel, new_mask, rng),
+        {'sparse_1': base['layers'][0]['sparse']['mask_bits']})
+    changed = delta['layers'][0]['sparse']['changed_indices']
+    assert np.array_equal(changed, np.flatnonzero(new_mask != mask))
+    assert 'mask_bits' not in delta['layers'][0]['sparse']
+    assert np.array_equal(mask_bits['sparse_1'],
+                          np.packbits(new_mask.reshape(-1) != 0))
+    restored_kernel, restored_mask = decoded(apply_snapshot_delta(base,
+                                                                  delta))
+    assert np.array_equal(restored_kernel, new_kernel)
+    assert np.array_equal(restored_mask, new_mask)
+
+
+def test_delta_keeps_only_the_statistics_of_the_callback():
+    rng = np.random.default_rng(2)
+    kernel, mask = sparse_kernel(rng)
+    full = snapshot(2, kernel, mask, rng)
+    previous = {'sparse_1': full['layers'][0]['sparse']['mask_bits']}
+    delta, _ = snapshot_delta(full, previous)
+    assert delta['optimizer_weights'] == []
+    assert delta['callback_state']['layers'] == {}
+    assert delta['callback_state']['epoch_data'] == \
+        full['callback_state']['epoch_data']
+    exact, _ = snapshot_delta(full, previous, include_optimizer=True)
+    assert len(exact['optimizer_weights']) == 3
+    assert exact['callback_state']['layers'].keys() == {'sparse_1'}
+
+
+def test_compact_checkpoint_round_trip(tmp_path):
+    rng = np.random.default_rng(3)
+    kernel, mask = sparse_kernel(rng)
+    s = snapshot(4, kernel, mask, rng)
+    filename = str(tmp_path / 'checkpoint.h5')
+    write_compact_checkpoint(filename, s)
+    restored = read_compact_checkpoint(filename)
+    assert restored['epoch'] == 4
+    restored_kernel, restored_mask = decoded(restored)
+    assert np.array_equal(restored_kernel, kernel)
+    assert np.array_equal(restored_mask, mask)
+    assert np.array_equal(restored['layers'][0]['weights'][1],
+                          s['layers'][0]['weights'][1])
+    for w, restored_w in zip(s['optimizer_weights'],
+                             restored['optimizer_weights']):
+        assert np.array_equal(w, restored_w)
+    state = s['callback_state']['layers']['sparse_1']
+    restored_state = restored['callback_state']['layers']['sparse_1']
+    assert restored_state.keys() == state.keys()
+    assert restored_state['rng'] == state['rng']
+    for k in ('active_sign_positive', 'active_sign_negative',
+              'regrowth_scores', 'regrowth_accumulator'):
+        assert np.array_equal(restored_state[k], state[k])
+    assert restored['numpy_random_state'][2:] == \
+        s['numpy_random_state'][2:]
+    assert np.array_equal(restored['numpy_random_state'][1],
+                          s['numpy_random_state'][1])
+
+
+def test_delta_checkpoint_reconstructs_every_epoch(tmp_path):
+    rng = np.random.default_rng(4)
+    filename = str(tmp_path / 'history.h5')
+    writer = DeltaCheckpointWriter(filename)
+    kernel, mask = sparse_kernel(rng)
+    history = {}
+    for epoch in range(1, 5):
+        writer.write(snapshot(epoch, kernel, mask, rng))
+        history[epoch] = kernel, mask
+        kernel, mask = rewire(rng, kernel, mask)
+    assert delta_checkpoint_epochs(filename) == [1, 2, 3, 4]
+    for epoch, (kernel, mask) in history.items():
+        restored_kernel, restored_mask = decoded(
+            read_delta_checkpoint(filename, epoch))
+        assert np.array_equal(restored_kernel, kernel)
+        assert np.array_equal(restored_mask, mask)
+
+
+def test_delta_is_much_smaller_than_a_compact_checkpoint(tmp_path):
+    rng = np.random.default_rng(5)
+    kernel, mask = sparse_kernel(rng)
+    filename = str(tmp_path / 'history.h5')
+    writer = DeltaCheckpointWriter(filename)
+    writer.write(snapshot(1, kernel, mask, rng))
+    base_size = os.path.getsize(filename)
+    kernel, mask = rewire(rng, kernel, mask)
+    s = snapshot(2, kernel, mask, rng)
+    writer.write(s)
+    delta_size = os.path.getsize(filename) - base_size
+    full_filename = str(tmp_path / 'checkpoint.h5')
+    write_compact_checkpoint(full_filename, s)
+    full_size = os.path.getsize(full_filename)
+    assert delta_size < full_size / 4
+    # little more than the active kernel values
+    values_size = s['layers'][0]['sparse']['values'].nbytes
+    assert delta_size < 2 * values_size
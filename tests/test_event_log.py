@@ -0,0 +1,100 @@
+import numpy as np
+from keras_rewiring.utilities import event_log as events
+from keras_rewiring.utilities.event_log import RewiringEventLog, \
+    read_event_log, replay_event_log
+
+SHAPE = (6, 5)
+
+
+def record_epoch(log, epoch, masks, rng):
+    """Record the initial masks (at the first epoch) and a few rewiring
+    steps, applying them to `masks`."""
+    for name, mask in masks.items():
+        if epoch == 0:
+            log.record(events.INITIAL, epoch, 0, name, SHAPE,
+                       regrown=np.flatnonzero(mask))
+        for batch in range(3):
+            dropped = rng.choice(np.flatnonzero(mask), 2, replace=False)
+            regrown = rng.choice(np.flatnonzero(mask == 0), 2, replace=False)
+            mask[dropped] = False
+            mask[regrown] = True
+            log.record(events.REWIRE, epoch, batch + 1, name, SHAPE,
+                       dropped, regrown)
+
+
+def initial_masks(rng):
+    return {name: rng.random(np.prod(SHAPE)) < .3
+            for name in ('dense_1', 'dense_2')}
+
+
+def final_masks(filename):
+    masks = {}
+    for _, m in replay_event_log(filename):
+        masks = {name: mask.reshape(-1).copy() for name, mask in m.items()}
+    return masks
+
+
+def test_events_round_trip(tmp_path):
+    filename = str(tmp_path / 'events.evt')
+    log = RewiringEventLog(filename, chunk_size=64)
+    log.record(events.INITIAL, 0, 0, 'dense_1', SHAPE, regrown=[0, 7, 29])
+    log.record(events.REWIRE, 0, 4, 'dense_1', SHAPE, [7], [3])
+    # a difference which does not fit in a byte
+    log.record(events.DECAY, 1, 0, 'conv_1', (3, 3, 16, 32), [1000, 5])
+    log.close()
+    logged = list(read_event_log(filename))
+    assert [(e.kind, e.epoch, e.batch, e.layer) for e in logged] == \
+        [('initial', 0, 0, 'dense_1'), ('rewire', 0, 4, 'dense_1'),
+         ('decay', 1, 0, 'conv_1')]
+    assert logged[0].regrown.tolist() == [0, 7, 29]
+    assert logged[1].dropped.tolist() == [7]
+    assert logged[1].regrown.tolist() == [3]
+    assert logged[2].dropped.tolist() == [5, 1000]
+    assert logged[2].regrown.size == 0
+
+
+def test_replay_reconstructs_the_masks(tmp_path):
+    rng = np.random.default_rng(0)
+    filename = str(tmp_path / 'events.evt')
+    log = RewiringEventLog(filename, chunk_size=100)
+    masks = initial_masks(rng)
+    for epoch in range(3):
+        record_epoch(log, epoch, masks, rng)
+    log.close()
+    replayed = final_masks(filename)
+    for name, mask in masks.items():
+        assert np.array_equal(replayed[name], mask)
+
+
+def test_resuming_drops_the_abandoned_epochs(tmp_path):
+    rng = np.random.default_rng(1)
+    filename = str(tmp_path / 'events.evt')
+    log = RewiringEventLog(filename, chunk_size=100)
+    masks = initial_masks(rng)
+    record_epoch(log, 0, masks, rng)
+    record_epoch(log, 1, masks, rng)
+    checkpointed = {name: mask.copy() for name, mask in masks.items()}
+    # epochs after the checkpoint, abandoned by the interrupted run, which
+    # also leaves an incomplete chunk behind
+    record_epoch(log, 2, masks, rng)
+    record_epoch(log, 3, masks, rng)
+    log.close()
+    with open(filename, 'ab') as f:
+        f.write(b'\x40\x00\x00\x00\x40\x00\x00\x00\x78')
+
+    log = RewiringEventLog(filename, chunk_size=100, resume_epoch=2)
+    masks = checkpointed
+    for name, mask in masks.items():
+        log.record(events.INITIAL, 2, 0, name, SHAPE,
+                   regrown=np.flatnonzero(mask))
+    record_epoch(log, 2, masks, rng)
+    log.close()
+    logged = list(read_event_log(filename))
+    epochs = [e.epoch for e in logged]
+    assert 3 not in epochs
+    assert epochs == sorted(epochs)
+    # only the events of the resumed run are left for epoch 2
+    assert epochs.count(2) == 2 + 2 * 3
+    replayed = final_masks(filename)
+    for name, mask in masks.items():
+        assert np.array_equal(replayed[name], mask)
@@ -0,0 +1,55 @@
+import numpy as np
+from keras_rewiring.utilities.index_pool import ConnectionIndexPool
+
+SIZE = 2000
+
+
+def check_partition(pool, flat_mask):
+    """The pool partitions every index into the active and dormant
+    connections of the mask, and its positions are consistent."""
+    assert pool.no_active == np.count_nonzero(flat_mask)
+    np.testing.assert_array_equal(np.sort(pool.active()),
+                                  np.flatnonzero(flat_mask))
+    np.testing.assert_array_equal(np.sort(pool.dormant()),
+                                  np.flatnonzero(flat_mask == 0))
+    np.testing.assert_array_equal(pool.indices[pool.positions],
+                                  np.arange(pool.size))
+
+
+def test_pool_follows_mask():
+    rng = np.random.default_rng(0)
+    flat_mask = (rng.random(SIZE) < .2).astype(np.uint8)
+    pool = ConnectionIndexPool(flat_mask)
+    assert pool.indices.dtype == np.int32
+    assert pool.positions.dtype == np.int32
+    check_partition(pool, flat_mask)
+    for _ in range(20):
+        dropped = rng.choice(pool.active(), 30, replace=False)
+        regrown = pool.sample_dormant(30, rng)
+        pool.deactivate(dropped)
+        pool.activate(regrown)
+        flat_mask[dropped] = 0
+        flat_mask[regrown] = 1
+        check_partition(pool, flat_mask)
+
+
+def test_dropped_connections_can_be_regrown():
+    rng = np.random.default_rng(1)
+    flat_mask = (rng.random(SIZE) < .2).astype(np.uint8)
+    pool = ConnectionIndexPool(flat_mask)
+    dropped = rng.choice(pool.active(), 10, replace=False)
+    pool.deactivate(dropped)
+    pool.activate(dropped)
+    check_partition(pool, flat_mask)
+
+
+def test_sample_dormant():
+    rng = np.random.default_rng(2)
+    flat_mask = rng.random(SIZE) < .5
+    pool = ConnectionIndexPool(flat_mask)
+    # rejection sampling (few) and sampling without replacement (many)
+    for k in (10, pool.no_dormant // 2, pool.no_dormant):
+        sample = pool.sample_dormant(k, rng)
+        assert sample.size == k
+        assert np.unique(sample).size == k
+        assert not np.any(flat_mask[sample])
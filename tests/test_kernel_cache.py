@@ -0,0 +1,59 @@
+import numpy as np
+import keras
+from keras import backend as K
+from keras_rewiring.sparse_layer import Sparse, set_weights, load_weights
+
+
+def cached_model():
+    model = keras.models.Sequential([
+        Sparse(8, connectivity_level=.5, cache_kernel=True,
+               input_shape=(16,))])
+    model.compile("sgd", "mse")
+    return model
+
+
+def expected_output(model, x):
+    """Output of the sparse layer computed from its current weights."""
+    layer = model.layers[0]
+    kernel, mask = layer.get_dense_kernel_and_mask()
+    return x.dot(kernel * mask) + K.get_value(layer.bias)
+
+
+def perturbed_weights(model, rng):
+    """Weights of the model with a new kernel and the same mask."""
+    weights = model.get_weights()
+    weights[0] = rng.standard_normal(weights[0].shape).astype(np.float32)
+    return weights
+
+
+def test_set_weights_after_predict_gives_fresh_outputs():
+    rng = np.random.default_rng(0)
+    model = cached_model()
+    x = rng.standard_normal((4, 16)).astype(np.float32)
+    model.predict(x)
+    set_weights(model, perturbed_weights(model, rng))
+    np.testing.assert_allclose(model.predict(x), expected_output(model, x),
+                               rtol=1e-5, atol=1e-5)
+
+
+def test_layer_set_weights_after_predict_gives_fresh_outputs():
+    rng = np.random.default_rng(1)
+    model = cached_model()
+    x = rng.standard_normal((4, 16)).astype(np.float32)
+    model.predict(x)
+    model.layers[0].set_weights(perturbed_weights(model, rng))
+    np.testing.assert_allclose(model.predict(x), expected_output(model, x),
+                               rtol=1e-5, atol=1e-5)
+
+
+def test_load_weights_after_predict_gives_fresh_outputs(tmp_path):
+    rng = np.random.default_rng(2)
+    model = cached_model()
+    x = rng.standard_normal((4, 16)).astype(np.float32)
+    filepath = str(tmp_path / "weights.h5")
+    model.save_weights(filepath)
+    saved = model.predict(x)
+    set_weights(model, perturbed_weights(model, rng))
+    assert not np.allclose(model.predict(x), saved)
+    load_weights(model, filepath)
+    np.testing.assert_allclose(model.predict(x), saved, rtol=1e-5, atol=1e-5)
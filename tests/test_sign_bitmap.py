@@ -0,0 +1,61 @@
+import numpy as np
+from keras_rewiring.utilities.sign_bitmap import SignBitmap
+
+SIZE = 1003
+
+
+def test_unpack_indices_round_trip():
+    rng = np.random.default_rng(0)
+    flags = rng.random(SIZE) < .1
+    np.testing.assert_array_equal(
+        SignBitmap.unpack_indices(SignBitmap.pack(flags)),
+        np.flatnonzero(flags))
+    assert SignBitmap.unpack_indices(
+        SignBitmap.pack(np.zeros(SIZE, dtype=bool))).size == 0
+
+
+def test_assign_and_get_bits():
+    rng = np.random.default_rng(1)
+    flags = rng.random(SIZE) < .5
+    packed = SignBitmap.pack(flags)
+    indices = rng.choice(SIZE, 100, replace=False)
+    values = rng.random(100) < .5
+    SignBitmap.assign_bits(packed, indices, values)
+    flags[indices] = values
+    np.testing.assert_array_equal(packed, SignBitmap.pack(flags))
+    np.testing.assert_array_equal(
+        SignBitmap.get_bits(packed, np.arange(SIZE)), flags)
+
+
+def test_flips_report_sign_changes():
+    rng = np.random.default_rng(2)
+    kernel = rng.standard_normal(SIZE)
+    kernel[:10] = 0
+    bitmap = SignBitmap(SIZE)
+    bitmap.update(kernel)
+    new_kernel = kernel.copy()
+    flipped = rng.choice(np.arange(10, SIZE), 50, replace=False)
+    new_kernel[flipped] *= -1
+    # entries becoming or leaving 0 have not changed sign
+    new_kernel[:5] = 1.
+    new_kernel[rng.choice(np.arange(10, SIZE), 5)] = 0
+    np.testing.assert_array_equal(bitmap.flips(new_kernel, update=False),
+                                  np.sort(flipped))
+    mask = np.zeros(SIZE, dtype=bool)
+    mask[flipped[:20]] = True
+    np.testing.assert_array_equal(
+        bitmap.flips(new_kernel, SignBitmap.pack(mask)),
+        np.sort(flipped[:20]))
+    # the signs of the new kernel were recorded
+    assert bitmap.flips(new_kernel).size == 0
+
+
+def test_set_records_new_values():
+    rng = np.random.default_rng(3)
+    kernel = rng.standard_normal(SIZE)
+    bitmap = SignBitmap(SIZE)
+    bitmap.update(kernel)
+    indices = rng.choice(SIZE, 30, replace=False)
+    kernel[indices] *= -1
+    bitmap.set(indices, kernel[indices])
+    assert bitmap.flips(kernel).size == 0
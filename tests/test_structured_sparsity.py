@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from keras_rewiring.utilities.index_pool import ConnectionIndexPool
+from keras_rewiring.utilities.sign_bitmap import SignBitmap
+from keras_rewiring.utilities.structured_sparsity import NMSparsity, \
+    BlockSparsity
+
+SHAPE = (3, 3, 8, 16)
+
+
+class State(object):
+    """The parts of `LayerRewiringState` used by the structures."""
+
+    def __init__(self, structure, mask, kernel, seed=0):
+        self.structure = structure
+        self.flat_mask = mask.reshape(-1).copy()
+        self.packed_mask = SignBitmap.pack(self.flat_mask != 0)
+        self.pool = ConnectionIndexPool(self.flat_mask)
+        self.sign_bitmap = SignBitmap(self.flat_mask.size)
+        self.sign_bitmap.update(kernel)
+        self.rng = np.random.default_rng(seed)
+        structure.initialise(self)
+
+    def deactivate(self, flat_indices):
+        self.flat_mask[flat_indices] = 0
+        SignBitmap.assign_bits(self.packed_mask, flat_indices, False)
+        self.pool.deactivate(flat_indices)
+
+    def activate(self, flat_indices):
+        self.flat_mask[flat_indices] = 1
+        SignBitmap.assign_bits(self.packed_mask, flat_indices, True)
+        self.pool.activate(flat_indices)
+
+    def perturb_dormant(self, flat_kernel, noise_coeff):
+        dormant = np.array(self.pool.dormant())
+        dormant_k = flat_kernel[dormant]
+        noisy_k = dormant_k + noise_coeff * self.rng.standard_normal(
+            dormant.size).astype(dormant_k.dtype)
+        return dormant[noisy_k * dormant_k < 0], dormant, \
+            np.clip(noisy_k, -1.5, 1.5)
+
+
+def check_rewiring(structure, mask, kernel, soft_limit):
+    state = State(structure, mask, kernel)
+    flat_kernel = kernel.reshape(-1)
+    for _ in range(10):
+        active = state.pool.active()
+        flipped = state.rng.choice(active, active.size // 10, replace=False)
+        dropped, regrown, _, _ = structure.rewire(
+            state, flipped, flat_kernel, soft_limit, 1.)
+        assert not np.any(state.flat_mask[np.setdiff1d(dropped, regrown)])
+        assert np.all(state.flat_mask[regrown])
+        assert structure.is_valid(state.flat_mask)
+        np.testing.assert_array_equal(np.sort(state.pool.active()),
+                                      np.flatnonzero(state.flat_mask))
+    return state
+
+
+def test_nm_projection():
+    rng = np.random.default_rng(0)
+    structure = NMSparsity(2, 4).bind(SHAPE)
+    kernel = rng.standard_normal(SHAPE).astype(np.float32)
+    mask = (rng.random(SHAPE) < .4).astype(np.uint8)
+    projected_mask = structure.project(mask, kernel)
+    assert structure.is_valid(projected_mask.reshape(-1))
+    assert not structure.is_valid(mask.reshape(-1))
+    # the number of active connections is kept
+    assert np.count_nonzero(projected_mask) == np.count_nonzero(mask)
+    np.testing.assert_array_equal(
+        structure.project(projected_mask, kernel), projected_mask)
+    with pytest.raises(ValueError):
+        structure.project(np.ones(SHAPE, dtype=np.uint8), kernel)
+    with pytest.raises(ValueError):
+        NMSparsity(2, 5).bind(SHAPE)
+
+
+@pytest.mark.parametrize("soft_limit", [False, True])
+def test_nm_rewiring_keeps_structure(soft_limit):
+    rng = np.random.default_rng(2)
+    structure = NMSparsity(2, 4).bind(SHAPE)
+    kernel = rng.standard_normal(SHAPE).astype(np.float32)
+    mask = structure.project((rng.random(SHAPE) < .3).astype(np.uint8),
+                             kernel)
+    state = check_rewiring(structure, mask, kernel, soft_limit)
+    if not soft_limit:
+        # hard rewiring regrows every dropped connection in its group
+        assert np.count_nonzero(state.flat_mask) == np.count_nonzero(mask)
+
+
+def test_block_projection():
+    rng = np.random.default_rng(3)
+    structure = BlockSparsity((4, 4)).bind(SHAPE)
+    kernel = rng.standard_normal(SHAPE).astype(np.float32)
+    mask = (rng.random(SHAPE) < .25).astype(np.uint8)
+    projected_mask = structure.project(mask, kernel)
+    assert structure.is_valid(projected_mask.reshape(-1))
+    assert not structure.is_valid(mask.reshape(-1))
+    no_blocks = np.count_nonzero(projected_mask) // structure.group_size
+    assert no_blocks == int(round(np.count_nonzero(mask) /
+                                  float(structure.group_size)))
+    np.testing.assert_array_equal(
+        structure.project(projected_mask, kernel), projected_mask)
+    with pytest.raises(ValueError):
+        BlockSparsity((5, 4)).bind(SHAPE)
+
+
+@pytest.mark.parametrize("soft_limit", [False, True])
+def test_block_rewiring_keeps_structure(soft_limit):
+    rng = np.random.default_rng(4)
+    structure = BlockSparsity((4, 4), flip_threshold=0.).bind(SHAPE)
+    kernel = rng.standard_normal(SHAPE).astype(np.float32)
+    mask = structure.project((rng.random(SHAPE) < .25).astype(np.uint8),
+                             kernel)
+    state = check_rewiring(structure, mask, kernel, soft_limit)
+    np.testing.assert_array_equal(
+        np.sort(state.block_pool.active()),
+        np.flatnonzero(state.flat_mask[structure.members(
+            np.arange(structure.no_groups))[:, 0]]))